@@ -187,6 +187,70 @@ else:
         EDDSA_PUBLIC_KEY = f.read()
 
 
+# Background jobs
+# JOB_BROKER decides who runs the queued jobs:
+#   "local": worker threads inside each web process, next to the `run_jobs` workers if any
+#   "db": `python manage.py run_jobs` worker processes only
+#   "eager": the enqueuing request itself, right away (used in CI)
+JOB_BROKER = "eager" if os.getenv("UNIT_TEST") else os.getenv("JOB_BROKER", "local")
+JOB_LOCAL_WORKERS = 2
+JOB_MAX_ATTEMPTS = 5
+JOB_RETRY_BACKOFF = 2.0 # seconds, doubled after each failed attempt
+JOB_LEASE = 10 * 60 # seconds a claimed job may run before another worker may reclaim it
+JOB_POLL_INTERVAL = 1.0
+JOB_LOCK_DIR = "/opt/tmp/locks" # lock files of the slots shared by the jobs of a node
+
+
+# Frame processing of animated images
+# Each web or `run_jobs` process lazily starts its own pool of FRAME_POOL_WORKERS processes, so the cores of
+# the node are split between the WEB_PROCESSES uWSGI processes started by start.sh
+WEB_PROCESSES = int(os.getenv("WEB_PROCESSES", 5))
+FRAME_POOL_WORKERS = max((os.cpu_count() or 1) // WEB_PROCESSES, 1)
+FRAME_BATCH_SIZE = 8 # frames sent to a pool worker at once
+
+
+# Object storage
+# STORAGE_BACKEND decides where the image objects are stored:
+#   "cos": the buckets of the COS server
+#   "local": the directories of STORAGE_LOCAL_ROOT, on a single machine without network
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "cos")
+STORAGE_LOCAL_ROOT = "/opt/tmp/storage"
+STORAGE_PART_SIZE = 8 * 1024 * 1024 # bytes of each part of a multipart upload
+STORAGE_UPLOAD_THREADS = 8 # parts uploaded at once by each process, shared by all its uploads
+
+
+# Write-behind counters
+# With COUNTER_WRITE_BEHIND, the likes, comments and views of images are appended to a table of pending
+# deltas, and each process flushes them to the images every COUNTER_FLUSH_INTERVAL seconds, at most
+# COUNTER_FLUSH_BATCH deltas per shard at once. Unit tests update the images right away.
+COUNTER_WRITE_BEHIND = not os.getenv("UNIT_TEST")
+COUNTER_SHARDS = 16
+COUNTER_FLUSH_INTERVAL = 0.5
+COUNTER_FLUSH_BATCH = 10000
+
+
+# Shared cache
+# CACHE_BACKEND decides where the Django cache, e.g. the cached responses and image metadata, is kept:
+#   "redis": the redis server at CACHE_LOCATION, shared by all nodes
+#   "file": the files of CACHE_LOCATION, shared by all workers of a single node
+#   "locmem": the memory of each process, for unit tests
+CACHE_BACKEND = "locmem" if os.getenv("UNIT_TEST") else os.getenv("CACHE_BACKEND", "file")
+CACHE_BACKENDS = {
+    "redis": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": os.getenv("CACHE_LOCATION", "redis://127.0.0.1:6379"),
+    },
+    "file": {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.getenv("CACHE_LOCATION", "/opt/tmp/django_cache"),
+    },
+    "locmem": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+}
+CACHES = {"default": CACHE_BACKENDS[CACHE_BACKEND]}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
 
@@ -4,6 +4,73 @@ FONT_SIZE = 15
 
 TMP_DIR = "/opt/tmp"
 
+# Uploaded images wait here for their background job; it must be shared with the `run_jobs` workers
+UPLOAD_SPOOL_DIR = "/opt/tmp/spool"
+
+# Chunked uploads
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+UPLOAD_MAX_SIZE = 256 * 1024 * 1024
+UPLOAD_SESSION_EXPIRY = 24 * 60 * 60
+
+# Local disk cache of raw and rough image bytes, shared by all workers on the node
+IMAGE_CACHE_DIR = "/opt/tmp/cache"
+IMAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# How raw and rough image bytes are served:
+#   "cache": from the local disk cache, handed to sendfile
+#   "stream": piped from the COS response body, skipping the local disk
+#   "redirect": not served at all, the client is redirected to a presigned url of the object
+IMAGE_SERVE_MODE = "cache"
+IMAGE_STREAM_CHUNK_SIZE = 64 * 1024
+
+# Presigned urls of the "redirect" serving mode are reused until IMAGE_REDIRECT_MARGIN seconds before they expire
+IMAGE_REDIRECT_EXPIRY = 60 * 60
+IMAGE_REDIRECT_MARGIN = 5 * 60
+
+# Width-bounded webp thumbnails stored next to the rough version of each uploaded image, in ascending order.
+# Only the widths below the width of the image itself are generated.
+THUMBNAIL_WIDTHS = [160, 320, 640, 1280]
+THUMBNAIL_QUALITY = 50
+
+# Variants of other formats or qualities are rendered from the original on their first request,
+# and kept in a local disk cache shared by all workers on the node. Their widths are snapped to the
+# thumbnail widths of the image, so each image has a bounded number of variants.
+VARIANT_CACHE_DIR = "/opt/tmp/variants"
+VARIANT_CACHE_MAX_BYTES = 1024 * 1024 * 1024
+VARIANT_FORMATS = ["webp", "jpeg", "png"]
+VARIANT_QUALITIES = [30, 50, 75, 90]
+
+# What serving an image needs to know about its hash (format, size, thumbnails) is cached by the Django cache
+# for IMAGE_META_TTL seconds, and in each process for IMAGE_META_LOCAL_TTL seconds. The local copies of
+# other processes are not dropped when the image is deleted, so they stay short-lived.
+IMAGE_META_TTL = 24 * 60 * 60
+IMAGE_META_LOCAL_TTL = 60
+
+# Seconds the responses of image info and image comments are cached for anonymous requests.
+# Writes drop them through their tags, the TTL only bounds how stale the counters of other nodes get.
+IMAGE_INFO_CACHE_TTL = 10
+IMAGE_COMMENTS_CACHE_TTL = 10
+
+# Image objects are keyed by their blake3 hash, so their bytes never change
+IMAGE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Video to GIF conversions run as background jobs, with at most VIDEO_CONVERT_SLOTS ffmpeg processes per node.
+# A job waiting VIDEO_SLOT_WAIT seconds for a slot is put back in the queue.
+VIDEO_CONVERT_SLOTS = 2
+VIDEO_SLOT_WAIT = 5
+VIDEO_PROGRESS_INTERVAL = 1.0 # seconds between two progress updates of a conversion
+# Quantize clips with a palette generated from their own frames: better colors, but about twice the CPU time,
+# and every frame of the clip is buffered by ffmpeg until the palette is ready at its end
+VIDEO_GIF_PALETTE = False
+
+# Super resolution, by the Baidu image definition enhancement API
+ENHANCE_API_URL = "https://aip.baidubce.com/rest/2.0/image-process/v1/image_definition_enhance"
+ENHANCE_CONCURRENCY = 4 # concurrent requests per process, within the QPS quota of the API
+ENHANCE_MAX_ATTEMPTS = 5
+ENHANCE_RETRY_BACKOFF = 0.5 # seconds, doubled after each failed attempt
+ENHANCE_TIMEOUT = 30
+ENHANCE_DEDUP_ENTRIES = 32
+
 IMAGE_CATEGORIES = [
     { "key": -1, "text": "请选择分区", "value": "wait" },
     { "key": 0, "text": "体育", "value": "sport" },
@@ -0,0 +1,83 @@
+import os
+import time
+import uuid
+import tempfile
+import cv2
+import ffmpeg
+from PIL import Image
+from django.core.management.base import BaseCommand
+from ImagesApp.views import gif_stream
+
+
+def opencv_clip_to_gif(video_name: str, gif_name: str, work_dir: str, start: float, end: float, resize: float):
+    """The former conversion of clips: cut and scale the clip through OpenCV, then convert it with ffmpeg."""
+    cap = cv2.VideoCapture(video_name)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+
+    start_frame = int(start * fps)
+    end_frame = int(end * fps)
+    new_frames = end_frame - start_frame + 1
+    new_width = int(width * resize)
+    new_height = int(height * resize)
+
+    convvideo_name = os.path.join(work_dir, str(uuid.uuid4()) + ".mp4")
+    out = cv2.VideoWriter(convvideo_name, cv2.VideoWriter_fourcc(*'MP4V'), fps, (new_width, new_height))
+    cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
+    for _ in range(new_frames):
+        ret, frame = cap.read()
+        if not ret: break
+        out.write(cv2.resize(frame, (new_width, new_height)))
+    cap.release()
+    out.release()
+
+    ffmpeg.input(convvideo_name).output(gif_name).overwrite_output().run(quiet=True)
+    os.remove(convvideo_name)
+
+
+def filter_graph_clip_to_gif(video_name: str, gif_name: str, work_dir: str, start: float, end: float, resize: float, palette: bool=False):
+    """The current conversion of clips, by a single ffmpeg filter graph."""
+    cap = cv2.VideoCapture(video_name)
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+    height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+    cap.release()
+
+    start_frame = int(start * fps)
+    new_frames = int(end * fps) - start_frame + 1
+    size = (int(width * resize), int(height * resize))
+    gif_stream(video_name, gif_name, fps, start_frame, new_frames, size, palette).overwrite_output().run(quiet=True)
+
+
+class Command(BaseCommand):
+    help = "Compare the OpenCV and the filter graph conversions of video clips to GIF."
+
+    def add_arguments(self, parser):
+        parser.add_argument("videos", nargs="+", help="sample video files")
+        parser.add_argument("--start", type=float, default=1.0, help="start of the clip, in seconds")
+        parser.add_argument("--end", type=float, default=4.0, help="end of the clip, in seconds")
+        parser.add_argument("--resize", type=float, default=0.5, help="scale of the clip")
+        parser.add_argument("--repeat", type=int, default=3, help="runs of each conversion, the best one is kept")
+
+    def handle(self, *args, **options):
+        converters = [
+            ("opencv", opencv_clip_to_gif),
+            ("filter graph", filter_graph_clip_to_gif),
+            ("palette", lambda *args: filter_graph_clip_to_gif(*args, palette=True)),
+        ]
+        with tempfile.TemporaryDirectory() as work_dir:
+            for video_name in options["videos"]:
+                self.stdout.write(video_name)
+                for label, convert_fn in converters:
+                    gif_name = os.path.join(work_dir, str(uuid.uuid4()) + ".gif")
+                    best = float("inf")
+                    for _ in range(options["repeat"]):
+                        begin = time.perf_counter()
+                        convert_fn(video_name, gif_name, work_dir, options["start"], options["end"], options["resize"])
+                        best = min(best, time.perf_counter() - begin)
+
+                    with Image.open(gif_name) as im:
+                        frames, size = im.n_frames, im.size
+                    self.stdout.write(f"  {label:>12}: {best:.3f}s, {frames} frames of {size[0]}x{size[1]}, {os.path.getsize(gif_name)} bytes")
+                    os.remove(gif_name)
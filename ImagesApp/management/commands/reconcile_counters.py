@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from utils.utils_counters import flush_counters, reconcile_counters
+
+
+class Command(BaseCommand):
+    help = "Recompute the likes, comments and views of every image from the rows they count."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--flush", action="store_true", help="also apply the pending counter deltas afterwards")
+
+    def handle(self, *args, **options):
+        images = reconcile_counters()
+        self.stdout.write(f"Reconciled the counters of {images} image(s)")
+        if options["flush"]:
+            flushed = 0
+            while True:
+                batch = flush_counters()
+                if batch == 0:
+                    break
+                flushed += batch
+            self.stdout.write(f"Applied {flushed} pending delta(s)")
@@ -0,0 +1,29 @@
+import signal
+import threading
+from django.core.management.base import BaseCommand
+from utils.utils_jobs import work
+import ImagesApp.views # registers the job handlers
+
+
+class Command(BaseCommand):
+    help = "Run background jobs queued in the database until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--kinds", nargs="*", default=None, help="only run jobs of these kinds")
+        parser.add_argument("--threads", type=int, default=1, help="number of jobs to run concurrently")
+        parser.add_argument("--poll", type=float, default=None, help="seconds to wait when there is nothing to run")
+
+    def handle(self, *args, **options):
+        stop_event = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stop_event.set())
+        signal.signal(signal.SIGINT, lambda *_: stop_event.set())
+
+        workers = [
+            threading.Thread(target=work, kwargs={"kinds": options["kinds"], "poll_interval": options["poll"], "stop_event": stop_event})
+            for _ in range(options["threads"])
+        ]
+        for worker in workers:
+            worker.start()
+        self.stdout.write(f"Running background jobs with {len(workers)} thread(s)")
+        for worker in workers:
+            worker.join()
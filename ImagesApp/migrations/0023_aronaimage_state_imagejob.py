@@ -0,0 +1,37 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:03
+
+from django.db import migrations, models
+import utils.utils_time
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0022_alter_aronaimage_uploader_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aronaimage',
+            name='state',
+            field=models.CharField(default='ready', max_length=255),
+        ),
+        migrations.CreateModel(
+            name='ImageJob',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('kind', models.CharField(max_length=255)),
+                ('payload', models.JSONField(default=dict)),
+                ('state', models.CharField(default='queued', max_length=255)),
+                ('attempts', models.IntegerField(default=0)),
+                ('max_attempts', models.IntegerField(default=5)),
+                ('run_after', models.FloatField(default=utils.utils_time.get_timestamp)),
+                ('created_time', models.FloatField(default=utils.utils_time.get_timestamp)),
+                ('finish_time', models.FloatField(default=None, null=True)),
+                ('error', models.TextField(default=str)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['id'], name='ImagesApp_i_id_7d19fa_idx'), models.Index(fields=['state', 'run_after'], name='ImagesApp_i_state_120836_idx')],
+            },
+        ),
+    ]
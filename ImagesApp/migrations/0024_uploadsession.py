@@ -0,0 +1,32 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+import utils.utils_time
+import uuid
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('UsersApp', '0005_user_last_view_folllowing_moment'),
+        ('ImagesApp', '0023_aronaimage_state_imagejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UploadSession',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, primary_key=True, serialize=False)),
+                ('hash', models.CharField(max_length=255)),
+                ('size', models.BigIntegerField()),
+                ('content_type', models.CharField(max_length=255)),
+                ('received', models.BigIntegerField(default=0)),
+                ('created_time', models.FloatField(default=utils.utils_time.get_timestamp)),
+                ('uploader', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='upload_sessions', to='UsersApp.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['uploader', 'hash'], name='ImagesApp_u_uploade_dbe23c_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0024_uploadsession'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='imageutilrecord',
+            name='progress',
+            field=models.FloatField(default=1.0),
+        ),
+        migrations.AddField(
+            model_name='imageutilrecord',
+            name='state',
+            field=models.CharField(default='done', max_length=255),
+        ),
+    ]
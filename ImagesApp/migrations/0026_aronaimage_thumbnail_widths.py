@@ -0,0 +1,19 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:34
+
+import django.contrib.postgres.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0025_imageutilrecord_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aronaimage',
+            name='thumbnail_widths',
+            field=django.contrib.postgres.fields.ArrayField(base_field=models.IntegerField(), default=list, size=None),
+        ),
+    ]
@@ -0,0 +1,47 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:47
+
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+import django.db.models.deletion
+
+
+def count_views(apps, schema_editor):
+    """Set the views of the existing images from their browse records, as `reconcile_counters` does.
+
+    No counter delta is pending yet, the table holding them is only created by this migration.
+    """
+    AronaImage = apps.get_model("ImagesApp", "AronaImage")
+    AronaImageBrowseRecord = apps.get_model("ImagesApp", "AronaImageBrowseRecord")
+
+    rows = AronaImageBrowseRecord.objects.filter(image=OuterRef("id")).order_by().values("image").annotate(total=Count("id")).values("total")
+    AronaImage.objects.update(views=Coalesce(Subquery(rows, output_field=IntegerField()), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0026_aronaimage_thumbnail_widths'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aronaimage',
+            name='views',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='ImageCounterDelta',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('field', models.CharField(max_length=255)),
+                ('delta', models.IntegerField()),
+                ('shard', models.IntegerField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='counter_deltas', to='ImagesApp.aronaimage')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['shard', 'id'], name='ImagesApp_i_shard_8e93bb_idx')],
+            },
+        ),
+        migrations.RunPython(count_views, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,4 @@
+import uuid
 from django.db import models
 from django.contrib.postgres import fields as postgres_models
 from UsersApp.models import User
@@ -14,6 +15,11 @@ class AronaImage(models.Model):
         hash: the hash value of the GIF, generated by blake3.
         uploader: the uploader of the GIF, i.e. the UUID of the user who uploaded the GIF.
         upload_time: the upload time of the GIF, i.e. the timestamp when the GIF is uploaded.
+        state: the processing state of the GIF, in [pending, ready, failed]. A pending GIF is still
+            being uploaded to COS by a background job.
+        thumbnail_widths: the widths of the stored webp thumbnails of the GIF, in ascending order.
+        likes, comments, views: the counters of the GIF, maintained through `utils_counters.add_counter`.
+            With write-behind counters, they lag behind their pending `ImageCounterDelta`s.
     """
     id = models.BigAutoField(primary_key=True)
     content_type = models.CharField(max_length=MAX_CHAR_LENGTH) # in [jpeg, png, gif]
@@ -24,10 +30,13 @@ class AronaImage(models.Model):
     height = models.IntegerField()
     likes = models.IntegerField(default=0)
     comments = models.IntegerField(default=0)
+    views = models.IntegerField(default=0)
     title = models.CharField(max_length=MAX_CHAR_LENGTH, default="Untitled")
     tags = postgres_models.ArrayField(models.CharField(max_length=MAX_CHAR_LENGTH), default=list)
     description = models.TextField(max_length=MAX_TEXT_LENGTH, default=str)
     category = models.CharField(max_length=MAX_CHAR_LENGTH, default="Uncategorized")
+    state = models.CharField(max_length=MAX_CHAR_LENGTH, default="ready")
+    thumbnail_widths = postgres_models.ArrayField(models.IntegerField(), default=list)
 
     def is_liked_by(self, user: User):
         from SocialApp.models import LikeImageRelation
@@ -40,6 +49,29 @@ class AronaImage(models.Model):
         ]
 
 
+class ImageCounterDelta(models.Model):
+    """A change to a counter of an image, not applied to the image yet.
+
+    Attributes:
+        id: the auto-incremented ID of the delta, serving as the primary key.
+        image: the image whose counter changes.
+        field: the counter, in [likes, comments, views].
+        delta: the change to the counter.
+        shard: the shard of the image, i.e. its ID modulo `settings.COUNTER_SHARDS`. Each shard is
+            flushed on its own.
+    """
+    id = models.BigAutoField(primary_key=True)
+    image = models.ForeignKey(AronaImage, on_delete=models.CASCADE, related_name="counter_deltas")
+    field = models.CharField(max_length=MAX_CHAR_LENGTH)
+    delta = models.IntegerField()
+    shard = models.IntegerField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shard', 'id']),
+        ]
+
+
 class AronaImageBrowseRecord(models.Model):
     """The browse record of the image.
 
@@ -67,14 +99,18 @@ class ImageUtilRecord(models.Model):
     Attributes:
         id: the auto-incremented ID of the record, serving as the primary key.
         user: the user who took usage of the utility.
-        result_url: the URL of the result file of the utility.
+        result_url: the URL of the result file of the utility, empty until the record is done.
         util_type: the type of the utility.
+        state: the state of the utility run in the background, in [pending, running, done, failed].
+        progress: the fraction of the work done, from 0 to 1.
     """
     id = models.BigAutoField(primary_key=True)
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="util_records")
     result_url = models.CharField(max_length=MAX_TEXT_LENGTH)
     result_type = models.CharField(max_length=MAX_CHAR_LENGTH)
     util_type = models.CharField(max_length=MAX_CHAR_LENGTH)
+    state = models.CharField(max_length=MAX_CHAR_LENGTH, default="done")
+    progress = models.FloatField(default=1.0)
     finish_time = models.FloatField(default=utils_time.get_timestamp)
     expiry = models.FloatField(default=timedelta(days=7).total_seconds())
 
@@ -82,4 +118,64 @@ class ImageUtilRecord(models.Model):
         indexes = [
             models.Index(fields=['id']),
             models.Index(fields=['user']),
+        ]
+
+
+class ImageJob(models.Model):
+    """A background job queued in the database.
+
+    Attributes:
+        id: the auto-incremented ID of the job, serving as the primary key.
+        kind: the kind of the job, deciding the handler to run it.
+        payload: the arguments of the job.
+        state: the state of the job, in [queued, running, done, failed].
+        attempts: the number of times the job has been started.
+        max_attempts: the number of times the job may be started before it is marked as failed.
+        run_after: the timestamp after which a queued job may be started. For a running job, the
+            timestamp its lease expires, after which another worker may take it over.
+        created_time: the timestamp when the job is queued.
+        finish_time: the timestamp when the job is done or failed.
+        error: the traceback of the last failed attempt.
+    """
+    id = models.BigAutoField(primary_key=True)
+    kind = models.CharField(max_length=MAX_CHAR_LENGTH)
+    payload = models.JSONField(default=dict)
+    state = models.CharField(max_length=MAX_CHAR_LENGTH, default="queued")
+    attempts = models.IntegerField(default=0)
+    max_attempts = models.IntegerField(default=5)
+    run_after = models.FloatField(default=utils_time.get_timestamp)
+    created_time = models.FloatField(default=utils_time.get_timestamp)
+    finish_time = models.FloatField(default=None, null=True)
+    error = models.TextField(default=str)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['id']),
+            models.Index(fields=['state', 'run_after']),
+        ]
+
+
+class UploadSession(models.Model):
+    """A resumable, chunked upload of an image.
+
+    Attributes:
+        id: the random UUID of the session, serving as the primary key.
+        uploader: the user who uploads the image.
+        hash: the blake3 hash of the image declared by the uploader.
+        size: the size of the image in bytes declared by the uploader.
+        content_type: the format of the image, in [jpeg, png, gif].
+        received: the number of bytes received so far, i.e. the offset of the next chunk.
+        created_time: the timestamp when the session is created.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4)
+    uploader = models.ForeignKey(User, on_delete=models.CASCADE, related_name="upload_sessions")
+    hash = models.CharField(max_length=MAX_CHAR_LENGTH)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=MAX_CHAR_LENGTH)
+    received = models.BigIntegerField(default=0)
+    created_time = models.FloatField(default=utils_time.get_timestamp)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['uploader', 'hash']),
         ]
\ No newline at end of file
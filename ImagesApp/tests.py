@@ -1,15 +1,58 @@
 import random
+import sys
 import uuid
+import base64
+import subprocess
+import threading
+from concurrent.futures import Future
+import tempfile
+import multiprocessing
+from unittest.mock import patch
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
 from PIL import Image
 from urllib.request import urlopen, Request
-from django.test import RequestFactory, Client, TestCase
-from ImagesApp.models import AronaImage
-from SocialApp.models import Comment
+from django.test import RequestFactory, Client, TestCase, override_settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.cache import cache
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from ImagesApp.models import AronaImage, ImageJob, UploadSession
+from SocialApp.models import Comment, LikeCommentRelation
 from UsersApp.models import User
 from ImagesApp.config import *
+from utils.utils_jobs import claim_job, run_job, node_slot
+from utils.utils_frames import iter_frames, write_animation, draw_text_gif_frames, GifWriter
+from utils.utils_enhance import EnhanceClient
+from utils.utils_storage import ObjectStorage, LocalStorage, CosStorage, PendingPut, wait_puts
+from qcloud_cos import CosConfig, CosS3Client
 from .views import *
+from . import views as images_views
 from SocialApp.views import *
 
+# Runs a frame pipeline in a fresh interpreter, and prints by how many KiB its peak RSS grew meanwhile.
+# Unlike tracemalloc, the peak RSS also covers the frame buffers Pillow allocates in C. It is read from
+# VmHWM, as ru_maxrss would carry the peak of the test runner over to the interpreter it executes.
+FRAME_PIPELINE_SCRIPT = """
+import sys
+from django.conf import settings
+settings.configure(FRAME_POOL_WORKERS=2, FRAME_BATCH_SIZE=4)
+from utils.utils_frames import iter_frames, write_animation, encode_webp_frames, draw_text_gif_frames, WebPAnimWriter, GifWriter
+
+def peak_rss():
+    with open("/proc/self/status") as status:
+        return next(int(line.split()[1]) for line in status if line.startswith("VmHWM:"))
+
+pipeline, src_name, dest_name, font = sys.argv[1:]
+before = peak_rss()
+with open(dest_name, "wb") as f:
+    if pipeline == "webp":
+        write_animation(f, WebPAnimWriter, iter_frames(src_name), encode_webp_frames, 50)
+    else:
+        write_animation(f, GifWriter, iter_frames(src_name), draw_text_gif_frames, "A.R.O.N.A", (10, 230), font, 8)
+print(peak_rss() - before)
+"""
+
 
 class ImagesTests(TestCase):
     # Initializer
@@ -20,6 +63,7 @@ class ImagesTests(TestCase):
                             email="test@sharklasers.com", mail_code="231425", salt="1919810")
         self.user = User.objects.filter(username="test").first()
         self.jwt = os.getenv("TEST_JWT")
+        cache.clear()
 
         if not os.path.exists(self.path):
             os.mkdir(self.path)
@@ -318,7 +362,7 @@ class ImagesTests(TestCase):
         json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
 
         # check the response
-        expected_keys = {"msg", "id", "hash", "contentType", "uploader", "uploadTime", "likes", "comments", "width", "height", "title", "tags", "description", "category", "isLiked"}
+        expected_keys = {"msg", "id", "hash", "contentType", "uploader", "uploadTime", "likes", "comments", "views", "width", "height", "title", "tags", "description", "category", "state", "isLiked"}
         self.assertTrue(expected_keys == set(json_response.keys()))
         self.assertEqual(response.status_code, 200)
 
@@ -336,7 +380,7 @@ class ImagesTests(TestCase):
         json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
 
         # check the response
-        expected_keys = {"msg", "id", "hash", "contentType", "uploader", "uploadTime", "likes", "comments", "width", "height", "title", "tags", "description", "category", "isLiked"}
+        expected_keys = {"msg", "id", "hash", "contentType", "uploader", "uploadTime", "likes", "comments", "views", "width", "height", "title", "tags", "description", "category", "state", "isLiked"}
         self.assertTrue(expected_keys == set(json_response.keys()))
         self.assertEqual(response.status_code, 200)
 
@@ -764,6 +808,42 @@ class ImagesTests(TestCase):
         self.assertEqual(len(json_response['result'][0]['replies']), 1)
 
 
+    def test_get_image_comments_constant_queries(self):
+        replier = User.objects.create(username="replier", password="114514", email="replier@sharklasers.com", mail_code="231425", salt="1919810")
+        uploaded = AronaImage.objects.create(content_type="png", hash=self.illegalize_hash(blake3(b"comments").hexdigest()), uploader=self.user,
+                                             width=200, height=100, state="ready")
+
+        def get_comments():
+            request = self.factory.get(f"/image/{uploaded.id}/comments", HTTP_AUTHORIZATION=f"Bearer {self.jwt}")
+            with CaptureQueriesContext(connection) as queries:
+                response = image_comments(request, uploaded.id)
+            return json.loads(response.content), len(queries)
+
+        comment = Comment.objects.create(content="test1", poster=self.user, belong_to_image=uploaded)
+        reply = Comment.objects.create(content="test2", poster=replier, belong_to_image=uploaded, belong_to_comment=comment,
+                                       reply_to_comment=comment, reply_to_user_username=self.user.username)
+        LikeCommentRelation.objects.create(user=self.user, comment=reply)
+        json_response, small_page_queries = get_comments()
+
+        # check that the replies carry their own posters and likes
+        self.assertEqual(json_response["result"][0]["poster"]["username"], "test")
+        self.assertFalse(json_response["result"][0]["isLiked"])
+        self.assertEqual(json_response["result"][0]["replies"][0]["poster"]["username"], "replier")
+        self.assertTrue(json_response["result"][0]["replies"][0]["isLiked"])
+
+        # check that a full page of comments with replies takes as many queries as a single comment
+        for i in range(COMMENT_PER_PAGE):
+            comment = Comment.objects.create(content=f"comment{i}", poster=replier, belong_to_image=uploaded)
+            for j in range(3):
+                Comment.objects.create(content=f"reply{j}", poster=self.user, belong_to_image=uploaded, belong_to_comment=comment,
+                                       reply_to_comment=comment, reply_to_user_username=replier.username)
+            LikeCommentRelation.objects.create(user=self.user, comment=comment)
+        json_response, full_page_queries = get_comments()
+        self.assertEqual(len(json_response["result"]), COMMENT_PER_PAGE)
+        self.assertTrue(all(len(result["replies"]) == 3 and result["isLiked"] for result in json_response["result"]))
+        self.assertEqual(full_page_queries, small_page_queries)
+
+
     def test_get_image_comments_with_invalid_jwt(self):
         url = "https://i.imgloc.com/2023/05/24/VDw3ca.gif"
         change_to_tmp_dir()
@@ -806,4 +886,799 @@ class ImagesTests(TestCase):
 
         # check the response
         self.assertEqual(json_response, {"msg": "Image not found"})
-        self.assertEqual(response.status_code, 404)
\ No newline at end of file
+        self.assertEqual(response.status_code, 404)
+
+    def test_image_cache_fill_and_hit(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 1024)
+        image_hash = blake3(b"arona").hexdigest()
+        fetches = []
+
+        def fetch(dest_name):
+            fetches.append(dest_name)
+            with open(dest_name, "wb") as f:
+                f.write(b"arona")
+
+        self.assertIsNone(cache.get(image_hash, "raw"))
+        with cache.open(image_hash, "raw", fetch) as f:
+            self.assertEqual(f.read(), b"arona")
+        with cache.open(image_hash, "raw", fetch) as f:
+            self.assertEqual(f.read(), b"arona")
+
+        # check that the second open is served from the cache
+        self.assertEqual(len(fetches), 1)
+        self.assertIsNone(cache.get(image_hash, "rough"))
+
+
+    def test_image_cache_delete_all(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 1024)
+        image_hash, other_hash = blake3(b"arona").hexdigest(), blake3(b"plana").hexdigest()
+
+        def fetch(dest_name):
+            with open(dest_name, "wb") as f:
+                f.write(b"arona")
+
+        for variant in ["100w-50q.webp", "400w-75q.png"]:
+            cache.fill(image_hash, variant, fetch)
+            cache.fill(other_hash, variant, fetch)
+        cache.delete_all(image_hash)
+
+        # check that every variant of the hash is dropped, and only of that hash
+        self.assertIsNone(cache.get(image_hash, "100w-50q.webp"))
+        self.assertIsNone(cache.get(image_hash, "400w-75q.png"))
+        self.assertIsNotNone(cache.get(other_hash, "100w-50q.webp"))
+        self.assertIsNotNone(cache.get(other_hash, "400w-75q.png"))
+
+
+    def test_image_cache_evicts_least_recently_used(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 250)
+        hashes = [blake3(str(i).encode()).hexdigest() for i in range(3)]
+
+        def fetch(dest_name):
+            with open(dest_name, "wb") as f:
+                f.write(b"x" * 100)
+
+        cache.fill(hashes[0], "raw", fetch)
+        cache.fill(hashes[1], "raw", fetch)
+        os.utime(cache.path(hashes[0], "raw"), (time.time() + 10, time.time() + 10))
+        cache.fill(hashes[2], "raw", fetch)
+
+        # check that the least recently used entry is evicted
+        self.assertIsNotNone(cache.get(hashes[0], "raw"))
+        self.assertIsNone(cache.get(hashes[1], "raw"))
+        self.assertIsNotNone(cache.get(hashes[2], "raw"))
+
+
+    def test_image_cache_scans_only_over_max_bytes(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 250)
+        hashes = [blake3(str(i).encode()).hexdigest() for i in range(4)]
+
+        def fetch(dest_name):
+            with open(dest_name, "wb") as f:
+                f.write(b"x" * 100)
+
+        with patch("utils.utils_cache.os.walk", wraps=os.walk) as walk:
+            cache.fill(hashes[0], "raw", fetch)
+            cache.fill(hashes[1], "raw", fetch)
+            # check that the first fill scans the cache for its size, and the next one below max_bytes does not
+            self.assertEqual(walk.call_count, 1)
+            cache.delete(hashes[1], "raw")
+            cache.fill(hashes[2], "raw", fetch)
+            # check that a deleted entry is taken out of the total
+            self.assertEqual(walk.call_count, 1)
+            cache.fill(hashes[3], "raw", fetch)
+            # check that a fill over max_bytes scans and evicts
+            self.assertEqual(walk.call_count, 2)
+        self.assertEqual(sum(cache.get(image_hash, "raw") is not None for image_hash in hashes), 2)
+
+
+    def test_image_cache_coalesces_misses(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 1024)
+        image_hash = blake3(b"arona").hexdigest()
+        fetches = []
+        barrier = threading.Barrier(8)
+        results = []
+
+        def fetch(dest_name):
+            fetches.append(dest_name)
+            time.sleep(0.1)
+            with open(dest_name, "wb") as f:
+                f.write(b"arona")
+
+        def read():
+            barrier.wait()
+            with cache.open(image_hash, "raw", fetch) as f:
+                results.append(f.read())
+
+        threads = [threading.Thread(target=read) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # check that the concurrent misses share a single fetch
+        self.assertEqual(len(fetches), 1)
+        self.assertEqual(results, [b"arona"] * 8)
+
+    def test_image_cache_coalesces_misses_across_processes(self):
+        cache = DiskCache(os.path.join(self.path, str(uuid.uuid4())), 1024)
+        image_hash = blake3(b"arona").hexdigest()
+        fetch_log = os.path.join(self.path, str(uuid.uuid4()))
+        context = multiprocessing.get_context("fork")
+        barrier = context.Barrier(4)
+
+        def fetch(dest_name):
+            with open(fetch_log, "a") as log:
+                log.write(f"{os.getpid()}\n")
+            time.sleep(0.2)
+            with open(dest_name, "wb") as f:
+                f.write(b"arona")
+
+        def read():
+            barrier.wait()
+            with cache.open(image_hash, "raw", fetch) as f:
+                assert f.read() == b"arona"
+
+        workers = [context.Process(target=read) for _ in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        with open(fetch_log) as log:
+            fetches = log.read().split()
+        os.remove(fetch_log)
+
+        # check that the worker processes missing the same entry share a single fetch
+        self.assertEqual([worker.exitcode for worker in workers], [0] * 4)
+        self.assertEqual(len(fetches), 1)
+
+    def test_image_not_modified(self):
+        image_hash = blake3(b"arona").hexdigest()
+        request = self.factory.get(f"/image/raw/{image_hash}", HTTP_IF_NONE_MATCH=f'"{image_hash}"')
+        response = image(request, image_hash)
+
+        # check that the image is answered without being looked up
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], f'"{image_hash}"')
+        self.assertIn("immutable", response["Cache-Control"])
+
+        request = self.factory.get(f"/image/rough/{image_hash}", HTTP_IF_NONE_MATCH=f'W/"{image_hash}"')
+        response = rough_image(request, image_hash)
+        self.assertEqual(response.status_code, 304)
+
+        request = self.factory.get(f"/image/raw/{image_hash}", HTTP_IF_NONE_MATCH=f'"{self.illegalize_hash(image_hash)}"')
+        response = image(request, image_hash)
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_parse_range(self):
+        self.assertEqual(parse_range("bytes=0-99", 1000), (0, 99))
+        self.assertEqual(parse_range("bytes=900-", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=-100", 1000), (900, 999))
+        self.assertEqual(parse_range("bytes=500-5000", 1000), (500, 999))
+        self.assertEqual(parse_range("bytes=-5000", 1000), (0, 999))
+        self.assertIsNone(parse_range("bytes=99-0", 1000))
+        self.assertRaises(ValueError, parse_range, "bytes=1000-", 1000)
+        self.assertRaises(ValueError, parse_range, "bytes=-0", 1000)
+
+
+    def test_local_storage(self):
+        data = random.randbytes(1000)
+        with tempfile.TemporaryDirectory() as root:
+            local = LocalStorage(root, part_size=64)
+            local.put_stream("test-bucket", "arona", io.BytesIO(data), "image/png")
+
+            # check the streamed reads, whole and ranged
+            chunks, headers = local.open_stream("test-bucket", "arona", chunk_size=100)
+            self.assertEqual(b"".join(chunks), data)
+            self.assertEqual(headers["Content-Length"], "1000")
+            chunks, headers = local.open_stream("test-bucket", "arona", "bytes=-100", chunk_size=30)
+            self.assertEqual(b"".join(chunks), data[900:])
+            self.assertEqual(headers["Content-Range"], "bytes 900-999/1000")
+            self.assertRaises(RangeNotSatisfiable, local.open_stream, "test-bucket", "arona", "bytes=1000-")
+
+            dest_name = os.path.join(root, "dest")
+            local.get_file("test-bucket", "arona", dest_name)
+            with open(dest_name, "rb") as f:
+                self.assertEqual(f.read(), data)
+            self.assertTrue(local.presigned_url("test-bucket", "arona", 60).startswith("file://"))
+            self.assertRaises(ValueError, local.path, "test-bucket", "../arona")
+
+            # check that missing keys are skipped by batch deletes
+            local.delete_many("test-bucket", ["arona", "plana"])
+            self.assertRaises(FileNotFoundError, local.open_stream, "test-bucket", "arona")
+
+    def test_cos_storage_parallel_multipart(self):
+        stub = {"objects": {}, "parts": {}, "active": 0, "max_active": 0}
+        stub_lock = threading.Lock()
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def reply(self, body: bytes=b"", etag: str=None):
+                self.send_response(200)
+                if etag is not None:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_PUT(self):
+                key, _, query = self.path[1:].partition("?")
+                data = self.rfile.read(int(self.headers["Content-Length"]))
+                params = parse_qs(query)
+                if "partNumber" not in params:
+                    stub["objects"][key] = data
+                    return self.reply(etag='"object"')
+                with stub_lock:
+                    stub["active"] += 1
+                    stub["max_active"] = max(stub["max_active"], stub["active"])
+                time.sleep(0.05)
+                with stub_lock:
+                    stub["active"] -= 1
+                    stub["parts"][int(params["partNumber"][0])] = data
+                self.reply(etag=f'"part-{params["partNumber"][0]}"')
+
+            def do_POST(self):
+                key, _, query = self.path[1:].partition("?")
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if query.startswith("uploads"):
+                    return self.reply(f"<InitiateMultipartUploadResult><Key>{key}</Key><UploadId>arona</UploadId></InitiateMultipartUploadResult>".encode())
+                stub["objects"][key] = b"".join(stub["parts"][i] for i in sorted(stub["parts"]))
+                self.reply(f"<CompleteMultipartUploadResult><Key>{key}</Key><ETag>\"object\"</ETag></CompleteMultipartUploadResult>".encode())
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stub_client = CosS3Client(CosConfig(Region="ap-beijing", SecretId="test", SecretKey="test", Scheme="http", Domain=f"127.0.0.1:{server.server_port}"))
+        cos = CosStorage(stub_client, part_size=1024)
+
+        large, small = random.randbytes(6000), random.randbytes(100)
+        with tempfile.TemporaryDirectory() as root:
+            for name, data in [("large", large), ("small", small)]:
+                with open(os.path.join(root, name), "wb") as f:
+                    f.write(data)
+            wait_puts(cos.begin_put("test-bucket", "large", os.path.join(root, "large"), "image/gif"),
+                      cos.begin_put("test-bucket", "small", os.path.join(root, "small"), "image/webp"))
+        server.shutdown()
+        server.server_close()
+
+        # check that the large object goes up as parts in parallel, and the small one at once
+        self.assertEqual(len(stub["parts"]), 6)
+        self.assertGreater(stub["max_active"], 1)
+        self.assertEqual(stub["objects"]["large"], large)
+        self.assertEqual(stub["objects"]["small"], small)
+
+    def test_pending_put_aborted_on_failed_completion(self):
+        future = Future()
+        future.set_result("part")
+        aborted = []
+
+        def complete(results):
+            raise ConnectionError("complete_multipart_upload failed")
+
+        # check that a put whose completion fails is aborted, not left orphaned
+        with self.assertRaises(ConnectionError):
+            PendingPut([future], complete_fn=complete, abort_fn=lambda: aborted.append(True)).wait()
+        self.assertEqual(aborted, [True])
+
+
+    def test_incomplete_storage_rejected(self):
+        class PutOnlyStorage(ObjectStorage):
+            def put_stream(self, bucket: str, key: str, f, content_type: str):
+                pass
+
+        # check that a backend missing part of the interface fails when created, not on its first use
+        with self.assertRaises(TypeError):
+            PutOnlyStorage()
+
+
+    def test_presigned_url_memo(self):
+        memo = ExpiringMemo(max_entries=2)
+        calls = []
+
+        def sign():
+            calls.append(None)
+            return f"https://example.com/{len(calls)}"
+
+        self.assertEqual(memo.get_or_set("a", sign, 60), "https://example.com/1")
+        self.assertEqual(memo.get_or_set("a", sign, 60), "https://example.com/1")
+        self.assertEqual(memo.get_or_set("b", sign, 0), "https://example.com/2")
+        self.assertEqual(memo.get_or_set("b", sign, 60), "https://example.com/3")
+
+        # check that the least recently used entry is dropped
+        memo.set("c", "https://example.com/c", 60)
+        self.assertIsNone(memo.get("a"))
+        self.assertEqual(memo.get("b"), "https://example.com/3")
+
+
+    def test_job_retried_until_done(self):
+        attempts = []
+
+        @job_handler("test_flaky")
+        def flaky(job):
+            attempts.append(job.attempts)
+            if len(attempts) < 3:
+                raise RuntimeError("flaky")
+
+        job = enqueue("test_flaky", {}, max_attempts=5)
+
+        # check that the job is retried after failures
+        self.assertEqual(attempts, [1, 2, 3])
+        self.assertEqual(ImageJob.objects.get(id=job.id).state, "done")
+
+
+    def test_job_failed_after_max_attempts(self):
+        failures = []
+
+        def on_failure(job):
+            failures.append(job.id)
+
+        @job_handler("test_broken", on_failure=on_failure)
+        def broken(job):
+            raise RuntimeError("broken")
+
+        job = enqueue("test_broken", {}, max_attempts=2)
+        job = ImageJob.objects.get(id=job.id)
+
+        # check that the failure is recorded
+        self.assertEqual(job.state, "failed")
+        self.assertEqual(job.attempts, 2)
+        self.assertIn("RuntimeError", job.error)
+        self.assertEqual(failures, [job.id])
+
+
+    def test_job_claimed_once(self):
+        job = ImageJob.objects.create(kind="test_claim")
+        self.assertEqual(claim_job(["test_claim"]).id, job.id)
+
+        # check that a running job is not claimed again before its lease expires
+        self.assertIsNone(claim_job(["test_claim"]))
+        ImageJob.objects.filter(id=job.id).update(run_after=utils_time.get_timestamp() - 1)
+        self.assertEqual(claim_job(["test_claim"]).attempts, 2)
+
+
+    @override_settings(JOB_BROKER="db")
+    def test_job_deferred_without_node_slot(self):
+        @job_handler("test_slot")
+        def needs_slot(job):
+            with node_slot("test", 1, 0.1):
+                pass
+
+        job = enqueue("test_slot", {})
+        before = utils_time.get_timestamp()
+        with node_slot("test", 1, 0):
+            run_job(claim_job(["test_slot"]))
+        job = ImageJob.objects.get(id=job.id)
+
+        # check that the job waits in the queue without using up an attempt
+        self.assertEqual(job.state, "queued")
+        self.assertEqual(job.attempts, 0)
+        self.assertGreater(job.run_after, before)
+
+        # check that the job runs once the slot is released
+        ImageJob.objects.filter(id=job.id).update(run_after=before)
+        run_job(claim_job(["test_slot"]))
+        self.assertEqual(ImageJob.objects.get(id=job.id).state, "done")
+
+
+    def test_failed_upload_fails_adopted_images(self):
+        change_to_tmp_dir()
+        spool_name = str(uuid.uuid4()) + ".png"
+        open(spool_name, "wb").close()
+        image_hash = blake3(b"failed upload").hexdigest()
+        original, adopted = [AronaImage.objects.create(content_type="png", hash=image_hash, uploader=self.user, width=1, height=1, state="pending")
+                             for _ in range(2)]
+
+        with patch.object(images_views, "fput_object", side_effect=RuntimeError("COS is down")):
+            enqueue("process_upload", {"id": original.id, "path": spool_name, "meta": {"hash": image_hash}}, max_attempts=1)
+
+        # check that the images adopted while the upload was pending fail along with it
+        self.assertEqual(AronaImage.objects.get(id=original.id).state, "failed")
+        self.assertEqual(AronaImage.objects.get(id=adopted.id).state, "failed")
+        self.assertFalse(os.path.exists(spool_name))
+
+
+    def test_deleted_upload_processed_for_adopted_images(self):
+        change_to_tmp_dir()
+        spool_name = str(uuid.uuid4()) + ".png"
+        Image.new("RGB", (8, 8)).save(spool_name)
+        image_hash = blake3(b"deleted upload").hexdigest()
+        original, adopted = [AronaImage.objects.create(content_type="png", hash=image_hash, uploader=self.user, width=8, height=8, state="pending")
+                             for _ in range(2)]
+        original_id = original.id
+        original.delete()
+
+        with tempfile.TemporaryDirectory() as root, patch.object(images_views, "storage", LocalStorage(root)), patch.object(images_views, "index_image"):
+            enqueue("process_upload", {"id": original_id, "path": spool_name, "meta": {"hash": image_hash}}, max_attempts=1)
+
+        # check that the bytes are still processed for the image adopted while the upload was pending
+        self.assertEqual(AronaImage.objects.get(id=adopted.id).state, "ready")
+        self.assertFalse(os.path.exists(spool_name))
+
+
+    def test_eager_job_deferred_without_node_slot(self):
+        runs = []
+
+        @job_handler("test_eager_slot")
+        def needs_slot(job):
+            runs.append(job.attempts)
+            with node_slot("test", 1, 0):
+                pass
+
+        with node_slot("test", 1, 0):
+            job = enqueue("test_eager_slot", {}, max_attempts=3)
+
+        # check that a job deferred over and over is left queued instead of being run forever
+        self.assertEqual(len(runs), 3)
+        self.assertEqual(ImageJob.objects.get(id=job.id).state, "queued")
+
+
+    def test_video2gif_queued(self):
+        video = SimpleUploadedFile("test.mp4", b"not a video", content_type="video/mp4")
+        request = self.factory.post("/image/convert", data={"video": video}, HTTP_AUTHORIZATION=f"Bearer {self.jwt}")
+        response = video2gif(request)
+        json_response = json.loads(response.content.decode(response.charset))
+
+        # check the response
+        self.assertEqual(response.status_code, 202)
+
+        # check that the record follows its conversion job, which cannot convert a broken video
+        record_id = json_response["id"]
+        request = self.factory.get(f"/image/utilities/{record_id}", HTTP_AUTHORIZATION=f"Bearer {self.jwt}")
+        response = util_result(request, record_id)
+        json_response = json.loads(response.content.decode(response.charset))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((json_response["id"], json_response["state"], json_response["url"]), (record_id, "failed", ""))
+        self.assertEqual(ImageJob.objects.get(kind="convert_video").state, "failed")
+
+
+    def test_gif_stream_single_pass(self):
+        args = gif_stream("clip.mp4", "clip.gif", 25, 50, 26, (320, 180), palette=True).compile()
+        graph = args[args.index("-filter_complex") + 1]
+
+        # check that the clip is seeked to, trimmed, scaled and quantized by a single ffmpeg command
+        self.assertEqual(args.count("-i"), 1)
+        self.assertEqual(args[args.index("-ss") + 1], "2.0")
+        for node in ["trim=end_frame=26", "scale=320:180", "palettegen", "paletteuse"]:
+            self.assertIn(node, graph)
+
+
+    def test_ingest_upload(self):
+        frames = [Image.new("RGB", (64, 48), (i * 20, 0, 0)) for i in range(5)]
+        buffer = io.BytesIO()
+        frames[0].save(buffer, "GIF", save_all=True, append_images=frames[1:], duration=[40, 40, 80, 80, 120], loop=0)
+        data = buffer.getvalue()
+        upload = SimpleUploadedFile("test.gif", data, content_type="image/gif")
+        upload.DEFAULT_CHUNK_SIZE = 16
+
+        change_to_tmp_dir()
+        spool_name = str(uuid.uuid4()) + ".gif"
+        meta = ingest_upload(upload, spool_name)
+        with open(spool_name, "rb") as f:
+            spooled = f.read()
+        os.remove(spool_name)
+
+        # check that the metadata is parsed on the way
+        self.assertEqual(spooled, data)
+        self.assertEqual(meta["hash"], blake3(data).hexdigest())
+        self.assertEqual(meta["size"], len(data))
+        self.assertEqual((meta["format"], meta["version"]), ("gif", "GIF89a"))
+        self.assertEqual((meta["width"], meta["height"]), (64, 48))
+        self.assertEqual(meta["frames"], 5)
+        self.assertEqual(meta["durations"], [40, 40, 80, 80, 120])
+
+
+    def test_create_roughver_gif(self):
+        durations = [(i % 3 + 4) * 10 for i in range(20)]
+        frames = [Image.new("RGB", (64, 48), (i * 12, 0, 255 - i * 12)) for i in range(20)]
+        change_to_tmp_dir()
+        gif_name = str(uuid.uuid4()) + ".gif"
+        frames[0].save(gif_name, "GIF", save_all=True, append_images=frames[1:], duration=durations, loop=0)
+
+        webp_name = create_roughver(gif_name)
+        with Image.open(webp_name) as im:
+            webp_durations, colors = [], []
+            for i in range(im.n_frames):
+                im.seek(i)
+                im.load()
+                webp_durations.append(im.info["duration"])
+                colors.append(im.convert("RGB").getpixel((32, 24)))
+            size = im.size
+        os.remove(gif_name)
+        os.remove(webp_name)
+
+        # check that the frames encoded over the pool are muxed in order
+        self.assertEqual(size, (64, 48))
+        self.assertEqual(webp_durations, durations)
+        for i, color in enumerate(colors):
+            self.assertLess(abs(color[0] - i * 12), 16)
+            self.assertLess(abs(color[2] - (255 - i * 12)), 16)
+
+
+    def test_create_thumbnails(self):
+        frames = [Image.new("RGB", (400, 300), (i * 40, 0, 0)) for i in range(5)]
+        change_to_tmp_dir()
+        gif_name = str(uuid.uuid4()) + ".gif"
+        frames[0].save(gif_name, "GIF", save_all=True, append_images=frames[1:], duration=60, loop=0)
+        png_name = str(uuid.uuid4()) + ".png"
+        Image.new("RGBA", (1000, 500), (0, 0, 255, 128)).save(png_name)
+
+        gif_thumbnails = create_thumbnails(gif_name)
+        png_thumbnails = create_thumbnails(png_name)
+        gif_sizes, png_sizes = [], []
+        for _, thumbnail_name in gif_thumbnails:
+            with Image.open(thumbnail_name) as im:
+                gif_sizes.append((im.size, im.n_frames))
+            os.remove(thumbnail_name)
+        for _, thumbnail_name in png_thumbnails:
+            with Image.open(thumbnail_name) as im:
+                png_sizes.append((im.size, im.mode))
+            os.remove(thumbnail_name)
+        os.remove(gif_name)
+        os.remove(png_name)
+
+        # check that only the widths below the image width are generated, keeping the aspect ratio
+        self.assertEqual([width for width, _ in gif_thumbnails], [160, 320])
+        self.assertEqual(gif_sizes, [((160, 120), 5), ((320, 240), 5)])
+        self.assertEqual([width for width, _ in png_thumbnails], [160, 320, 640])
+        self.assertEqual(png_sizes, [((160, 80), "RGBA"), ((320, 160), "RGBA"), ((640, 320), "RGBA")])
+
+
+    def test_rough_image_nearest_thumbnail(self):
+        change_to_tmp_dir()
+        png_name = str(uuid.uuid4()) + ".png"
+        Image.frombytes("RGB", (400, 300), random.randbytes(400 * 300 * 3)).save(png_name)
+        with open(png_name, "rb") as f:
+            image_hash = blake3(f.read()).hexdigest()
+
+        with tempfile.TemporaryDirectory() as root, patch.object(images_views, "storage", LocalStorage(root)):
+            _, webp_name, thumbnail_widths = fput_object(png_name, image_hash)
+            os.remove(webp_name)
+            os.remove(png_name)
+            AronaImage.objects.create(content_type="png", hash=image_hash, uploader=self.user, width=400, height=300,
+                                      thumbnail_widths=thumbnail_widths)
+
+            widths = {}
+            for w in ["100", "200", "320", "1000"]:
+                response = rough_image(self.factory.get(f"/image/rough/{image_hash}", {"w": w}), image_hash)
+                self.assertEqual(response.status_code, 200)
+                with Image.open(io.BytesIO(b"".join(response.streaming_content))) as im:
+                    widths[w] = im.width
+            response = rough_image(self.factory.get(f"/image/rough/{image_hash}", {"w": "0"}), image_hash)
+
+        # check that the narrowest thumbnail covering the requested width is served
+        self.assertEqual(thumbnail_widths, [160, 320])
+        self.assertEqual(widths, {"100": 160, "200": 320, "320": 320, "1000": 400})
+        self.assertEqual(response.status_code, 400)
+
+    def test_image_meta_cached(self):
+        change_to_tmp_dir()
+        png_name = str(uuid.uuid4()) + ".png"
+        Image.frombytes("RGB", (200, 100), random.randbytes(200 * 100 * 3)).save(png_name)
+        with open(png_name, "rb") as f:
+            image_hash = blake3(f.read()).hexdigest()
+
+        with tempfile.TemporaryDirectory() as root, patch.object(images_views, "storage", LocalStorage(root)):
+            _, webp_name, thumbnail_widths = fput_object(png_name, image_hash)
+            os.remove(webp_name)
+            os.remove(png_name)
+            uploaded = AronaImage.objects.create(content_type="png", hash=image_hash, uploader=self.user, width=200, height=100,
+                                                 thumbnail_widths=thumbnail_widths)
+
+            with self.assertNumQueries(1):
+                response = rough_image(self.factory.get(f"/image/rough/{image_hash}"), image_hash)
+                self.assertEqual(response.status_code, 200)
+            # check that the metadata of a served image is cached
+            with self.assertNumQueries(0):
+                response = image(self.factory.get(f"/image/raw/{image_hash}"), image_hash)
+                self.assertEqual(response.status_code, 200)
+                response = rough_image(self.factory.get(f"/image/rough/{image_hash}", {"w": "100"}), image_hash)
+                self.assertEqual(response.status_code, 200)
+
+            # check that the metadata is dropped along with the image
+            uploaded.delete()
+            delete_image_meta(image_hash)
+            response = rough_image(self.factory.get(f"/image/rough/{image_hash}"), image_hash)
+            self.assertEqual(response.status_code, 404)
+
+
+    def test_image_info_response_cached(self):
+        uploaded = AronaImage.objects.create(content_type="png", hash=self.illegalize_hash(blake3(b"cached").hexdigest()), uploader=self.user,
+                                             width=200, height=100, state="ready")
+        response = image_info(self.factory.get(f"/image/{uploaded.id}"), uploaded.id)
+        self.assertEqual(json.loads(response.content)["likes"], 0)
+
+        # check that anonymous requests are answered from the cache
+        AronaImage.objects.filter(id=uploaded.id).update(likes=5)
+        with self.assertNumQueries(0):
+            response = image_info(self.factory.get(f"/image/{uploaded.id}"), uploaded.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.content)["likes"], 0)
+
+        # check that authenticated requests skip the cache
+        response = image_info(self.factory.get(f"/image/{uploaded.id}", HTTP_AUTHORIZATION=f"Bearer {self.jwt}"), uploaded.id)
+        self.assertEqual(json.loads(response.content)["likes"], 5)
+
+        # check that invalidating the tag of the image drops its cached response
+        invalidate_tags([f"image:{uploaded.id}"])
+        response = image_info(self.factory.get(f"/image/{uploaded.id}"), uploaded.id)
+        self.assertEqual(json.loads(response.content)["likes"], 5)
+
+
+    def test_rough_image_variant(self):
+        change_to_tmp_dir()
+        gif_name = str(uuid.uuid4()) + ".gif"
+        frames = [Image.frombytes("RGB", (400, 300), random.randbytes(400 * 300 * 3)) for _ in range(3)]
+        frames[0].save(gif_name, "GIF", save_all=True, append_images=frames[1:], duration=80, loop=0)
+        with open(gif_name, "rb") as f:
+            image_hash = blake3(f.read()).hexdigest()
+
+        with tempfile.TemporaryDirectory() as root, patch.object(images_views, "storage", LocalStorage(root)):
+            _, webp_name, thumbnail_widths = fput_object(gif_name, image_hash)
+            os.remove(webp_name)
+            os.remove(gif_name)
+            AronaImage.objects.create(content_type="gif", hash=image_hash, uploader=self.user, width=400, height=300,
+                                      thumbnail_widths=thumbnail_widths)
+
+            variants = {}
+            for params in [{"w": "100", "fm": "png", "q": "75"}, {"w": "200", "q": "90"}, {"fm": "jpeg"}]:
+                response = rough_image(self.factory.get(f"/image/rough/{image_hash}", params), image_hash)
+                self.assertEqual(response.status_code, 200)
+                with Image.open(io.BytesIO(b"".join(response.streaming_content))) as im:
+                    variants[im.format] = (response["Content-Type"], im.size, getattr(im, "n_frames", 1))
+            invalid_statuses = [rough_image(self.factory.get(f"/image/rough/{image_hash}", params), image_hash).status_code
+                                for params in [{"fm": "bmp"}, {"q": "0"}, {"q": "101"}, {"q": "80"}]]
+
+        # check that the variants are rendered from the original at the thumbnail widths, animated as webp only
+        self.assertEqual(thumbnail_widths, [160, 320])
+        self.assertEqual(variants, {
+            "PNG": ("image/png", (160, 120), 1),
+            "WEBP": ("image/webp", (320, 240), 3),
+            "JPEG": ("image/jpeg", (400, 300), 1),
+        })
+        self.assertEqual(invalid_statuses, [400, 400, 400, 400])
+
+    def test_frame_pipeline_memory_bounded(self):
+        frame_count, size = 200, (256, 256)
+        frames = [Image.effect_noise(size, 64 + i % 64) for i in range(frame_count)]
+        change_to_tmp_dir()
+        gif_name = str(uuid.uuid4()) + ".gif"
+        frames[0].save(gif_name, "GIF", save_all=True, append_images=frames[1:], duration=50, loop=0)
+        del frames
+        decoded_size = frame_count * size[0] * size[1] * 3
+
+        font = str(fm.findfont(fm.FontProperties(family='DejaVu Sans', style='oblique', weight='normal')))
+        peaks, written_frames = {}, {}
+        for pipeline, extension in [("webp", ".webp"), ("gif", ".gif")]:
+            dest_name = str(uuid.uuid4()) + extension
+            result = subprocess.run([sys.executable, "-c", FRAME_PIPELINE_SCRIPT, pipeline, os.path.abspath(gif_name), os.path.abspath(dest_name), font],
+                                    cwd=settings.BASE_DIR, capture_output=True, text=True, check=True)
+            peaks[pipeline] = int(result.stdout.split()[-1]) * 1024
+            with Image.open(dest_name) as im:
+                written_frames[pipeline] = im.n_frames
+                if pipeline == "gif":
+                    im.seek(im.n_frames - 1)
+                    gif_duration = im.info["duration"]
+            os.remove(dest_name)
+        os.remove(gif_name)
+
+        # check that every frame is written while only the frames in flight are held
+        self.assertEqual(written_frames, {"webp": frame_count, "gif": frame_count})
+        self.assertEqual(gif_duration, 50)
+        self.assertLess(peaks["webp"], decoded_size / 2)
+        self.assertLess(peaks["gif"], decoded_size / 2)
+
+
+    def test_enhance_frames_with_stub_api(self):
+        stub = {"requests": 0, "active": 0, "max_active": 0}
+        stub_lock = threading.Lock()
+
+        class StubHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+                with stub_lock:
+                    stub["requests"] += 1
+                    request_index = stub["requests"]
+                    stub["active"] += 1
+                    stub["max_active"] = max(stub["max_active"], stub["active"])
+                time.sleep(0.05)
+                if request_index % 4 == 1: # reject some requests, as the QPS limit of the API does
+                    body = {"error_code": 18, "error_msg": "Open api qps request limit reached"}
+                else:
+                    im = Image.open(io.BytesIO(base64.b64decode(form["image"][0])))
+                    buffer = io.BytesIO()
+                    im.resize((im.width * 2, im.height * 2)).save(buffer, format="PNG")
+                    body = {"image": base64.b64encode(buffer.getvalue()).decode()}
+                with stub_lock:
+                    stub["active"] -= 1
+
+                data = json.dumps(body).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(("127.0.0.1", 0), StubHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        stub_enhancer = EnhanceClient(f"http://127.0.0.1:{server.server_port}/enhance?access_token=test",
+                                      concurrency=3, max_attempts=3, backoff=0.01, timeout=5, dedup_entries=8)
+        frames = [Image.new("RGB", (16, 12), (i % 5 * 50, 0, 0)) for i in range(15)]
+        results = list(stub_enhancer.enhance_frames((frame, 40 + i) for i, frame in enumerate(frames)))
+        server.shutdown()
+        server.server_close()
+
+        # check that the frames are reassembled in order
+        self.assertEqual([duration for _, duration in results], [40 + i for i in range(15)])
+        for i, (frame, _) in enumerate(results):
+            self.assertEqual(frame.size, (32, 24))
+            self.assertEqual(frame.convert("RGB").getpixel((0, 0)), (i % 5 * 50, 0, 0))
+
+        # check that the 5 distinct frames are sent once each, plus the 2 rejected requests
+        self.assertEqual(stub["requests"], 7)
+        self.assertLessEqual(stub["max_active"], 3)
+
+
+    def create_upload_session(self, hash, size, content_type, jwt):
+        payload = {
+            "hash": hash,
+            "size": size,
+            "contentType": content_type,
+        }
+        request = self.factory.post("/image/upload/sessions", data=payload, content_type="application/json", HTTP_AUTHORIZATION=f"Bearer {jwt}")
+        response = upload_sessions(request)
+        return response
+
+
+    def put_upload_chunk(self, session_id, offset, chunk, jwt):
+        request = self.factory.put(f"/image/upload/sessions/{session_id}?offset={offset}", data=chunk, content_type="application/octet-stream", HTTP_AUTHORIZATION=f"Bearer {jwt}")
+        response = upload_session(request, session_id)
+        return response
+
+
+    def test_upload_session_with_existing_image(self):
+        image_hash = blake3(b"arona").hexdigest()
+        AronaImage.objects.create(content_type="gif", hash=image_hash, uploader=self.user, width=1, height=1)
+
+        response = self.create_upload_session(image_hash, 5, "gif", self.jwt)
+        json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
+
+        # check that nothing is transferred
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(AronaImage.objects.filter(hash=image_hash).count(), 2)
+        self.assertTrue(AronaImage.objects.filter(id=json_response["id"], uploader=self.user, state="ready").exists())
+        self.assertFalse(UploadSession.objects.exists())
+
+
+    def test_upload_session_resumed(self):
+        data = bytes(range(256)) * 4
+        image_hash = blake3(data).hexdigest()
+
+        response = self.create_upload_session(image_hash, len(data), "gif", self.jwt)
+        json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json_response["offset"], 0)
+        session_id = uuid.UUID(json_response["session"])
+
+        response = self.put_upload_chunk(session_id, 0, data[:300], self.jwt)
+        self.assertEqual(response.status_code, 200)
+
+        # check that a disconnected client can resume from the received offset
+        response = self.create_upload_session(image_hash, len(data), "gif", self.jwt)
+        json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
+        self.assertEqual(json_response["session"], str(session_id))
+        self.assertEqual(json_response["offset"], 300)
+
+        response = self.put_upload_chunk(session_id, 0, data[:300], self.jwt)
+        self.assertEqual(response.status_code, 409)
+
+        response = self.put_upload_chunk(session_id, 300, data[300:], self.jwt)
+        json_response = json.loads(response.content.decode(response.charset).replace("'", '"'))
+
+        # check that the bytes are checked once complete
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json_response, {"msg": "Invalid file type"})
+        self.assertFalse(UploadSession.objects.exists())
@@ -4,11 +4,14 @@ import ImagesApp.views as views
 urlpatterns = [
     path("semiupload", views.semiupload),
     path("upload", views.upload_image),
+    path("upload/sessions", views.upload_sessions),
+    path("upload/sessions/<uuid:session_id>", views.upload_session),
     path("category", views.image_category),
     path("convert", views.video2gif),
     path("resolution", views.super_resolution),
     path("watermark", views.watermark),
     path("utilities", views.util_results),
+    path("utilities/<int:id>", views.util_result),
     path("<int:id>", views.image_info),
     path("<int:id>/download", views.download_image),
     path("raw/<str:hash>", views.image),
@@ -2,32 +2,57 @@ from django.conf import settings
 import json
 import io
 import time
-import base64
 import jwt
 import re
 import uuid
 from datetime import timedelta
+from contextlib import ExitStack
 from blake3 import blake3
 import os
 import cv2
 import ffmpeg
-from PIL import Image, ImageSequence, ImageFont, ImageDraw
-import imageio
+from PIL import Image, ImageFont, ImageDraw
 import matplotlib.font_manager as fm
 import requests
-from django.http import HttpRequest, HttpResponse, JsonResponse
+from django.http import HttpRequest, HttpResponse, JsonResponse, FileResponse, StreamingHttpResponse, HttpResponseNotModified, HttpResponseRedirect
+from django.utils.http import http_date, parse_etags
 from django.core.paginator import Paginator
-from ImagesApp.config import COMMENT_PER_PAGE, UTIL_RESULT_PER_PAGE, FONT_SIZE, TMP_DIR, IMAGE_CATEGORIES
+from django.core.cache import cache
+from django.db import transaction
+from ImagesApp.config import COMMENT_PER_PAGE, UTIL_RESULT_PER_PAGE, FONT_SIZE, TMP_DIR, IMAGE_CATEGORIES, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES, \
+    IMAGE_SERVE_MODE, IMAGE_STREAM_CHUNK_SIZE, IMAGE_CACHE_CONTROL, IMAGE_REDIRECT_EXPIRY, IMAGE_REDIRECT_MARGIN, \
+    THUMBNAIL_WIDTHS, THUMBNAIL_QUALITY, VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES, VARIANT_FORMATS, VARIANT_QUALITIES, \
+    IMAGE_META_TTL, IMAGE_META_LOCAL_TTL, IMAGE_INFO_CACHE_TTL, IMAGE_COMMENTS_CACHE_TTL, \
+    UPLOAD_SPOOL_DIR, UPLOAD_CHUNK_SIZE, UPLOAD_MAX_SIZE, UPLOAD_SESSION_EXPIRY, \
+    VIDEO_CONVERT_SLOTS, VIDEO_SLOT_WAIT, VIDEO_PROGRESS_INTERVAL, VIDEO_GIF_PALETTE, \
+    ENHANCE_API_URL, ENHANCE_CONCURRENCY, ENHANCE_MAX_ATTEMPTS, ENHANCE_RETRY_BACKOFF, ENHANCE_TIMEOUT, ENHANCE_DEDUP_ENTRIES
 from UsersApp.models import User
-from ImagesApp.models import AronaImage, AronaImageBrowseRecord, ImageUtilRecord
-from SocialApp.models import Comment
-from qcloud_cos import CosConfig, CosS3Client
+from ImagesApp.models import AronaImage, AronaImageBrowseRecord, ImageUtilRecord, UploadSession
+from SocialApp.models import Comment, LikeCommentRelation, TimelineEntry
 from utils import utils_time
+from utils.utils_cache import DiskCache, ExpiringMemo, cache_response, invalidate_tags
+from utils.utils_counters import add_counter, with_pending_counters
+from utils.utils_enhance import EnhanceClient, EnhanceError
+from utils.utils_jobs import enqueue, job_handler, node_slot
+from utils.utils_image import ingest_upload, inspect_file
+from utils.utils_storage import RANGE_PATTERN, RangeNotSatisfiable, get_storage, parse_range, wait_puts
+from utils.utils_frames import iter_frames, write_animation, write_animations, encode_webp_frames, resize_webp_frames, encode_gif_frames, draw_text_gif_frames, WebPAnimWriter, GifWriter
 from utils.utils_request import BAD_METHOD, request_failed, request_success, return_field, get_es_id
 from utils.utils_require import MAX_CHAR_LENGTH, CheckPath, CheckRequire, require
 
-client = CosS3Client(CosConfig(Region=settings.COS_REGION, SecretId=settings.COS_SECRET_ID, SecretKey=settings.COS_SECRET_KEY))
-
+storage = get_storage()
+image_cache = DiskCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+variant_cache = DiskCache(VARIANT_CACHE_DIR, VARIANT_CACHE_MAX_BYTES)
+presigned_urls = ExpiringMemo(max_entries=10000)
+image_metas = ExpiringMemo(max_entries=10000)
+enhancer = EnhanceClient(
+    f"{ENHANCE_API_URL}?access_token={settings.BAIDU_AI_TOKEN}",
+    concurrency=ENHANCE_CONCURRENCY,
+    max_attempts=ENHANCE_MAX_ATTEMPTS,
+    backoff=ENHANCE_RETRY_BACKOFF,
+    timeout=ENHANCE_TIMEOUT,
+    dedup_entries=ENHANCE_DEDUP_ENTRIES
+)
 
 def change_to_tmp_dir():
     os.chdir(TMP_DIR)
@@ -47,14 +72,9 @@ def create_roughver(image_name: str, quality: int=50):
     image_id = image_name[:-(len(format) + 1)]
 
     if format == 'gif':
-        image = Image.open(image_name)
-        duration = image.info['duration']
-
-        with imageio.get_reader(image_name) as reader:
-            frames = [Image.fromarray(frame) for frame in reader]
-
         save_name = image_id + '.webp'
-        frames[0].save(save_name, format='WEBP', save_all=True, append_images=frames[1:], optimize=True, quality=quality, duration=duration, loop=0)
+        with open(save_name, "wb") as f:
+            write_animation(f, WebPAnimWriter, iter_frames(image_name), encode_webp_frames, quality)
         return save_name
     
     elif format == 'jpeg':
@@ -70,226 +90,497 @@ def create_roughver(image_name: str, quality: int=50):
         return save_name
 
 
+@CheckPath
+def create_thumbnails(image_name: str, quality: int=THUMBNAIL_QUALITY):
+    """Create the webp thumbnails of the image file, one per width of `THUMBNAIL_WIDTHS` below its own width.
+
+    Args:
+        image_name: the whole filename of the image file to be converted.
+
+    Returns:
+        the width and the whole filename of each created thumbnail, in ascending order of width.
+    """
+    format = image_name.split('.')[-1]
+    image_id = image_name[:-(len(format) + 1)]
+
+    with Image.open(image_name) as im:
+        width, height = im.size
+        if format != 'gif':
+            has_alpha = im.mode in ["RGBA", "LA", "PA"] or "transparency" in im.info
+            still = im.convert("RGBA" if has_alpha else "RGB")
+
+    thumbnails = []
+    for thumbnail_width in THUMBNAIL_WIDTHS:
+        if thumbnail_width >= width:
+            break
+        thumbnails.append((thumbnail_width, f"{image_id}-{thumbnail_width}.webp"))
+    sizes = [(thumbnail_width, max(round(height * thumbnail_width / width), 1)) for thumbnail_width, _ in thumbnails]
+
+    if format == 'gif':
+        if thumbnails:
+            # Each frame is decoded once, and shrunk to every width by the pool workers
+            with ExitStack() as stack:
+                fs = [stack.enter_context(open(save_name, "wb")) for _, save_name in thumbnails]
+                write_animations(fs, WebPAnimWriter, sizes, iter_frames(image_name), resize_webp_frames, quality)
+    else:
+        for (_, save_name), size in zip(thumbnails, sizes):
+            still.resize(size, Image.LANCZOS).save(save_name, format='WEBP', quality=quality)
+    return thumbnails
+
+
 @CheckPath
 def fput_object(image_name: str, blake3_hash: str):
-    """Put an object and its webp version in the workspace directory /opt/tmp to the COS server.
+    """Put an object, its webp version and its thumbnails in the workspace directory /opt/tmp to the object storage.
 
     Args:
-        format: the format of the object, deciding the bucket to be put in.
+        image_name: the whole filename of the object, whose format decides the bucket to be put in.
         blake3_hash: the blake3 hash of the object, and name it accordingly.
 
     Returns:
-        the writting result of the object.
+        the whole filenames of the object and of its webp version, and the widths of its thumbnails.
     """
     format = image_name.split('.')[-1]
-    image_id = image_name[:-(len(format) + 1)]
 
+    # The original goes up while its webp versions are being encoded
+    puts = [storage.begin_put(object_bucket(format), blake3_hash, image_name, f"image/{format}")]
+    thumbnails = []
+    try:
+        webp_name = create_roughver(image_name)
+        puts.append(storage.begin_put(object_bucket(format, rough=True), blake3_hash, webp_name, "image/webp"))
+        thumbnails = create_thumbnails(image_name)
+        for width, thumbnail_name in thumbnails:
+            puts.append(storage.begin_put(object_bucket(format, rough=True), object_key(blake3_hash, width), thumbnail_name, "image/webp"))
+    finally:
+        # Every put settles before its file is removed
+        wait_puts(*puts)
+        for _, thumbnail_name in thumbnails:
+            os.remove(thumbnail_name)
+
+    return image_name, webp_name, [width for width, _ in thumbnails]
+
+
+@CheckPath
+def fput_util_result(image_name: str, blake3_hash: str, util_type: str):
+    format = image_name.split('.')[-1]
+    storage.put_file(util_bucket(util_type), blake3_hash, image_name, f"image/{format}")
+
+
+def object_bucket(format: str, rough: bool=False):
+    """Select the bucket of an image object.
+
+    Args:
+        format: the format of the object.
+        rough: whether to select the bucket of the webp version.
+
+    Returns:
+        the name of the bucket.
+    """
     if format == 'gif':
-        try:
-            client.upload_file(
-                Bucket=settings.GIF_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/gif"
-            )
-            webp_name = create_roughver(image_name)
-            client.upload_file(
-                Bucket=settings.ROUGH_GIF_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=webp_name,
-                ContentType=f"image/webp"
-            )
-        except Exception as err:
-            raise err
-        
+        return settings.ROUGH_GIF_BUCKET if rough else settings.GIF_BUCKET
     elif format == 'jpeg':
-        try:
-            client.upload_file(
-                Bucket=settings.JPEG_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/jpeg"
-            )
-            webp_name = create_roughver(image_name)
-            client.upload_file(
-                Bucket=settings.ROUGH_JPEG_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=webp_name,
-                ContentType=f"image/webp"
-            )
-        except Exception as err:
-            raise err
-        
+        return settings.ROUGH_JPEG_BUCKET if rough else settings.JPEG_BUCKET
     elif format == 'png':
-        try:
-            client.upload_file(
-                Bucket=settings.PNG_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/png"
-            )
-            webp_name = create_roughver(image_name)
-            client.upload_file(
-                Bucket=settings.ROUGH_PNG_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=webp_name,
-                ContentType=f"image/webp"
-            )
-        except Exception as err:
-            raise err
-
+        return settings.ROUGH_PNG_BUCKET if rough else settings.PNG_BUCKET
     else:
         raise ValueError("Invalid format")
 
-    return image_name, webp_name
 
+def object_key(blake3_hash: str, width: int=None):
+    """Get the key of an image object, or of its thumbnail of the given width in the bucket of webp versions."""
+    return blake3_hash if width is None else f"{blake3_hash}-{width}"
 
-@CheckPath
-def fput_util_result(image_name: str, blake3_hash: str, util_type: str):
-    format = image_name.split('.')[-1]
-    image_id = image_name[:-(len(format) + 1)]
 
+def object_variant(rough: bool=False, width: int=None):
+    """Get the name of the local disk cache variant of an image object."""
+    if not rough:
+        return "raw"
+    return "rough" if width is None else f"rough-{width}"
+
+
+def util_bucket(util_type: str):
+    """Select the bucket of the results of an image utility.
+
+    Args:
+        util_type: the type of the utility, i.e. `convert`, `resolution` or `watermark`.
+
+    Returns:
+        the name of the bucket.
+    """
     if util_type == "convert":
-        try:
-            client.upload_file(
-                Bucket=settings.CONVERT_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-    
+        return settings.CONVERT_BUCKET
     elif util_type == "resolution":
-        try:
-            client.upload_file(
-                Bucket=settings.RESOLUTION_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-        
+        return settings.RESOLUTION_BUCKET
     elif util_type == "watermark":
-        try:
-            client.upload_file(
-                Bucket=settings.WATERMARK_BUCKET,
-                Key=blake3_hash,
-                LocalFilePath=image_name,
-                ContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-        
+        return settings.WATERMARK_BUCKET
     else:
         raise ValueError("Invalid util type")
-    
+
 
 @CheckPath
-def fget_object(dest_name: str, format: str, blake3_hash: str, rough: bool=False):
-    """Get an object from the COS server and save it to the workspace directory /opt/tmp.
+def fget_object(dest_name: str, format: str, blake3_hash: str, rough: bool=False, width: int=None):
+    """Get an object from the object storage and save it to the workspace directory /opt/tmp.
+
+    Args:
+        format: the format of the object, simplifying the process of bucket selection.
+        blake3_hash: the blake3 hash of the object in the certain bucket.
+        width: the width of the thumbnail to get instead of the webp version.
+    """
+    storage.get_file(object_bucket(format, rough), object_key(blake3_hash, width), dest_name)
+
+
+def stream_object(format: str, blake3_hash: str, rough: bool=False, range_header: str=None, width: int=None):
+    """Get an object from the object storage as a stream, without saving it anywhere.
 
     Args:
         format: the format of the object, simplifying the process of bucket selection.
-        blake3_hash: the blake3 hash of the object in the certain bucket.    
+        blake3_hash: the blake3 hash of the object in the certain bucket.
+        rough: whether to get the webp version of the object.
+        range_header: the byte range of the object to get, in the form of an HTTP `Range` header.
+        width: the width of the thumbnail to get instead of the webp version.
 
     Returns:
-        the object in the certain bucket.
+        an iterator over the chunks of the object, and its `Content-Length` and `Content-Range` headers.
     """
+    return storage.open_stream(object_bucket(format, rough), object_key(blake3_hash, width), range_header, IMAGE_STREAM_CHUNK_SIZE)
 
-    if format == 'gif':
-        bucket = settings.ROUGH_GIF_BUCKET if rough else settings.GIF_BUCKET
-    elif format == 'jpeg':
-        bucket = settings.ROUGH_JPEG_BUCKET if rough else settings.JPEG_BUCKET
-    elif format == 'png':
-        bucket = settings.ROUGH_PNG_BUCKET if rough else settings.PNG_BUCKET
-    else:
-        raise ValueError("Invalid format")
 
+def open_cached_object(format: str, blake3_hash: str, rough: bool=False, width: int=None):
+    """Open an object through the local disk cache, fetching it from the object storage on a miss.
+
+    Args:
+        format: the format of the object, simplifying the process of bucket selection.
+        blake3_hash: the blake3 hash of the object in the certain bucket.
+        rough: whether to open the webp version of the object.
+        width: the width of the thumbnail to open instead of the webp version.
+
+    Returns:
+        the opened binary file of the cached object.
+    """
+    def fetch(dest_name: str):
+        change_to_tmp_dir()
+        fget_object(dest_name, format, blake3_hash, rough, width)
+
+    return image_cache.open(blake3_hash, object_variant(rough, width), fetch)
+
+
+def image_etag(blake3_hash: str):
+    return f'"{blake3_hash}"'
+
+
+def set_image_cache_headers(response: HttpResponse, blake3_hash: str, upload_time: float=None):
+    """Mark an image response as immutable, since image objects are keyed by their own blake3 hash."""
+    response["ETag"] = image_etag(blake3_hash)
+    response["Cache-Control"] = IMAGE_CACHE_CONTROL
+    response["Accept-Ranges"] = "bytes"
+    if upload_time is not None:
+        response["Last-Modified"] = http_date(upload_time)
+    return response
+
+
+def image_not_modified(req: HttpRequest, blake3_hash: str):
+    """Answer a conditional GET whose `If-None-Match` already names the image, without touching COS or the DB.
+
+    Returns:
+        a 304 response, or None if the client does not hold the image yet.
+    """
+    etags = [etag.removeprefix("W/") for etag in parse_etags(req.headers.get("If-None-Match", ""))]
+    if "*" in etags or image_etag(blake3_hash) in etags:
+        return set_image_cache_headers(HttpResponseNotModified(), blake3_hash)
+    return None
+
+
+def image_range(req: HttpRequest, blake3_hash: str):
+    """Get the `Range` header of a request, if it is a single byte range that should be honored.
+
+    The range is dropped when `If-Range` names another entity, as the whole image must be sent then.
+    """
+    range_header = req.headers.get("Range", "").strip()
+    match = RANGE_PATTERN.fullmatch(range_header)
+    if match is None or match.groups() == ("", ""):
+        return None
+
+    if_range = req.headers.get("If-Range", "").strip()
+    if if_range.startswith(('"', "W/")) and if_range != image_etag(blake3_hash):
+        return None
+
+    return range_header
+
+
+def read_range(f, start: int, length: int):
+    """Iterate over `length` bytes of an opened file starting from `start`, closing the file at the end."""
     try:
-        client.download_file(
-            Bucket=bucket,
-            Key=blake3_hash,
-            DestFilePath=dest_name,
-            ResponseContentType=f"image/{'webp' if rough else format}"
-        )
-    except Exception as err:
-        raise err
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(IMAGE_STREAM_CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+    finally:
+        f.close()
+
+
+def serve_object(req: HttpRequest, image: AronaImage, rough: bool=False, width: int=None):
+    """Build the response carrying the bytes of an image object.
+
+    In the `cache` serving mode the object is served from the local disk cache as a file response,
+    which the server hands to sendfile. In the `stream` mode the COS response body is piped straight
+    to the client. Neither mode holds the whole object in memory. A single byte range is honored in
+    both modes. In the `redirect` mode no bytes pass through the worker at all: the client is sent
+    to a presigned url of the object instead. With a `width`, the thumbnail of that width is served
+    instead of the webp version.
+    """
+    format, blake3_hash = image.content_type, image.hash
+    content_type = "image/webp" if rough else f"image/{format}"
+    range_header = image_range(req, blake3_hash)
+
+    if IMAGE_SERVE_MODE == "redirect":
+        response = HttpResponseRedirect(cached_presigned_url(format, blake3_hash, rough, width))
+        response["Cache-Control"] = f"private, max-age={IMAGE_REDIRECT_MARGIN}"
+        return response
+
+    if IMAGE_SERVE_MODE == "stream":
+        try:
+            chunks, headers = stream_object(format, blake3_hash, rough, range_header, width)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=416)
+            response["Content-Range"] = "bytes */*"
+            return set_image_cache_headers(response, blake3_hash, image.upload_time)
+
+        response = StreamingHttpResponse(chunks, content_type=content_type)
+        if headers.get("Content-Length") is not None:
+            response["Content-Length"] = headers["Content-Length"]
+        if headers.get("Content-Range") is not None:
+            response.status_code = 206
+            response["Content-Range"] = headers["Content-Range"]
+        return set_image_cache_headers(response, blake3_hash, image.upload_time)
+
+    f = open_cached_object(format, blake3_hash, rough, width)
+    return serve_file(f, content_type, range_header, blake3_hash, image.upload_time)
+
+
+def serve_file(f, content_type: str, range_header: str, blake3_hash: str, upload_time: float):
+    """Build the response carrying the bytes of an opened image file, honoring a single byte range."""
+    if range_header is None:
+        return set_image_cache_headers(FileResponse(f, content_type=content_type), blake3_hash, upload_time)
+
+    size = os.fstat(f.fileno()).st_size
+    try:
+        byte_range = parse_range(range_header, size)
+    except ValueError:
+        f.close()
+        response = HttpResponse(status=416)
+        response["Content-Range"] = f"bytes */{size}"
+        return set_image_cache_headers(response, blake3_hash, upload_time)
+
+    if byte_range is None:
+        return set_image_cache_headers(FileResponse(f, content_type=content_type), blake3_hash, upload_time)
+
+    start, end = byte_range
+    response = StreamingHttpResponse(read_range(f, start, end - start + 1), status=206, content_type=content_type)
+    response["Content-Length"] = end - start + 1
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return set_image_cache_headers(response, blake3_hash, upload_time)
+
+
+def render_variant(f, dest_name: str, image: AronaImage, width: int, format: str, quality: int):
+    """Render a variant of an image from its original.
+
+    Animated GIFs stay animated as webp variants, and are reduced to their first frame otherwise.
+
+    Args:
+        f: the opened binary file of the original.
+        dest_name: the filename to save the variant to.
+        width: the width of the variant, at most the width of the image.
+        format: the format of the variant, in `VARIANT_FORMATS`.
+        quality: the encoding quality of the variant.
+    """
+    size = (width, max(round(image.height * width / image.width), 1))
+    if image.content_type == "gif" and format == "webp":
+        timed_frames = ((frame.resize(size, Image.LANCZOS), duration) for frame, duration in iter_frames(f))
+        with open(dest_name, "wb") as out:
+            write_animation(out, WebPAnimWriter, timed_frames, encode_webp_frames, quality)
+        return
+
+    frames = iter_frames(f)
+    frame, _ = next(frames)
+    frames.close()
+    frame = frame.resize(size, Image.LANCZOS)
+    if format == "jpeg":
+        frame = frame.convert("RGB")
+    frame.save(dest_name, format=format.upper(), quality=quality)
+
+
+def serve_variant(req: HttpRequest, image: AronaImage, width: int, format: str, quality: int):
+    """Build the response carrying a variant of an image, rendering it on a miss of the variant cache.
+
+    Concurrent misses on the same variant share a single render, across the threads of a process and
+    across the worker processes of the node, through `DiskCache.open`.
+
+    Args:
+        width: the width of the variant, one of the thumbnail widths of the image, or None for its own width.
+    """
+    width = width or image.width
+    variant = f"{width}w-{quality}q.{format}"
+
+    def render(dest_name: str):
+        with open_cached_object(image.content_type, image.hash) as f:
+            render_variant(f, dest_name, image, width, format, quality)
+
+    f = variant_cache.open(image.hash, variant, render)
+    return serve_file(f, f"image/{format}", image_range(req, image.hash), image.hash, image.upload_time)
 
 
 @CheckPath
 def fget_util_result(image_name: str, blake3_hash: str, util_type: str):
-    format = image_name.split('.')[-1]
-    image_id = image_name[:-(len(format) + 1)]
+    storage.get_file(util_bucket(util_type), blake3_hash, image_name)
 
-    if util_type == "convert":
-        try:
-            client.download_file(
-                Bucket=settings.CONVERT_BUCKET,
-                Key=blake3_hash,
-                DestFilePath=image_name,
-                ResponseContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-    
-    elif util_type == "resolution":
-        try:
-            client.download_file(
-                Bucket=settings.RESOLUTION_BUCKET,
-                Key=blake3_hash,
-                DestFilePath=image_name,
-                ResponseContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-        
-    elif util_type == "watermark":
-        try:
-            client.download_file(
-                Bucket=settings.WATERMARK_BUCKET,
-                Key=blake3_hash,
-                DestFilePath=image_name,
-                ResponseContentType=f"image/{format}"
-            )
-        except Exception as err:
-            raise err
-        
-    else:
-        raise ValueError("Invalid util type")
-    
-    
-def presigned_fget_object(format: str, blake3_hash: str, expiry: int):
-    """Get a presigned url of an original object from the COS server.
+
+def presigned_fget_object(format: str, blake3_hash: str, expiry: int, rough: bool=False, width: int=None):
+    """Get a presigned url of an object from the object storage.
 
     Args:
         format: the format of the object, simplifying the process of bucket selection.
         blake3_hash: the blake3 hash of the object in the certain bucket.
         expiry: the expiry time of the presigned url, in seconds.
+        rough: whether to sign the webp version of the object.
+        width: the width of the thumbnail to sign instead of the webp version.
 
     Returns:
-        the presigned url of the original object in the certain bucket.
+        the presigned url of the object in the certain bucket.
     """
-    if format == 'gif':
-        bucket = settings.GIF_BUCKET
-    elif format == 'jpeg':
-        bucket = settings.JPEG_BUCKET
-    elif format == 'png':
-        bucket = settings.PNG_BUCKET
-    else:
-        raise ValueError("Invalid format")
+    return storage.presigned_url(object_bucket(format, rough), object_key(blake3_hash, width), expiry)
+
+
+def presigned_fget_util_result(blake3_hash: str, util_type: str, expiry: int):
+    return storage.presigned_url(util_bucket(util_type), blake3_hash, expiry)
+
+
+def cached_presigned_url(format: str, blake3_hash: str, rough: bool=False, width: int=None):
+    """Get a presigned url of an object for redirecting image requests to.
+
+    The url is signed for `IMAGE_REDIRECT_EXPIRY` seconds and memoized per object until
+    `IMAGE_REDIRECT_MARGIN` seconds before it expires, so a redirected client always has time
+    to follow it.
+    """
+    return presigned_urls.get_or_set(
+        (object_bucket(format, rough), object_key(blake3_hash, width)),
+        lambda: presigned_fget_object(format, blake3_hash, IMAGE_REDIRECT_EXPIRY, rough, width),
+        IMAGE_REDIRECT_EXPIRY - IMAGE_REDIRECT_MARGIN
+    )
     
+
+def fail_conversion(job):
+    ImageUtilRecord.objects.filter(id=job.payload["id"]).update(state="failed")
+    if os.path.exists(job.payload["path"]):
+        os.remove(job.payload["path"])
+
+
+def run_ffmpeg(stream, duration: float, report_fn):
+    """Run an ffmpeg command, reporting its progress.
+
+    Args:
+        stream: the ffmpeg-python output stream to run.
+        duration: the duration of the output, in seconds.
+        report_fn: a callable taking the fraction of the output written so far.
+    """
+    process = stream.global_args("-progress", "pipe:1", "-nostats", "-loglevel", "error").overwrite_output().run_async(pipe_stdout=True)
+    for line in process.stdout:
+        key, _, value = line.decode().strip().partition("=")
+        if key == "out_time_us" and value.isdigit() and duration > 0:
+            report_fn(min(int(value) / 1e6 / duration, 1.0))
+    if process.wait() != 0:
+        raise ffmpeg.Error("ffmpeg", None, None)
+
+
+def gif_stream(video_name: str, gif_name: str, fps: float=None, start_frame: int=None, frames: int=None, size: tuple=None, palette: bool=VIDEO_GIF_PALETTE):
+    """Build the ffmpeg command converting a video, or a clip of it, to a GIF in a single pass.
+
+    A clip is seeked to, trimmed by frame numbers and scaled in one filter graph, and with `palette`,
+    quantized with a palette generated from its own frames.
+
+    Args:
+        fps: the frame rate of the video.
+        start_frame: the first frame of the clip, or None to convert the whole video.
+        frames: the number of frames of the clip.
+        size: the width and height of the clip.
+        palette: whether to generate the palette of a clip, see `VIDEO_GIF_PALETTE`.
+    """
+    if start_frame is None:
+        return ffmpeg.input(video_name).output(gif_name)
+
+    clip = ffmpeg.input(video_name, ss=start_frame / fps).trim(end_frame=frames).setpts("PTS-STARTPTS").filter("scale", *size)
+    if not palette:
+        return clip.output(gif_name)
+    split = clip.split()
+    return ffmpeg.filter([split[0], split[1].filter("palettegen", stats_mode="diff")], "paletteuse", dither="bayer", diff_mode="rectangle").output(gif_name)
+
+
+@job_handler("convert_video", on_failure=fail_conversion)
+def convert_video(job):
+    """Convert a spooled video to a GIF with `gif_stream`, upload it to COS, and complete its utility record.
+
+    At most `VIDEO_CONVERT_SLOTS` conversions run at once on a node.
+
+    Payload:
+        id: the ID of the utility record.
+        path: the path of the spooled video file.
+        start, end, resize: the clip to convert and its scale, or None to convert the whole video.
+    """
+    video_name = job.payload["path"]
+    record = ImageUtilRecord.objects.filter(id=job.payload["id"]).first()
+    if record is None:
+        if os.path.exists(video_name):
+            os.remove(video_name)
+        return
+
+    last_report = 0
+    def report(progress: float):
+        nonlocal last_report
+        if time.monotonic() - last_report >= VIDEO_PROGRESS_INTERVAL:
+            last_report = time.monotonic()
+            ImageUtilRecord.objects.filter(id=record.id).update(progress=progress)
+
+    change_to_tmp_dir()
+    convgif_name = str(uuid.uuid4()) + '.gif'
     try:
-        return client.get_presigned_url(
-            Method='GET',
-            Bucket=bucket,
-            Key=blake3_hash,
-            Expired=expiry
-        )
-    except Exception as err:
-        raise err
-    
+        with node_slot("ffmpeg", VIDEO_CONVERT_SLOTS, VIDEO_SLOT_WAIT):
+            ImageUtilRecord.objects.filter(id=record.id).update(state="running", progress=0)
+            cap = cv2.VideoCapture(video_name)
+            fps = cap.get(cv2.CAP_PROP_FPS)
+            width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
+            height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
+            frame_count = cap.get(cv2.CAP_PROP_FRAME_COUNT)
+            cap.release()
+
+            if job.payload["start"] is None:
+                stream = gif_stream(video_name, convgif_name)
+                duration = frame_count / fps if fps else 0
+            else:
+                start_frame = int(job.payload["start"] * fps)
+                end_frame = int(job.payload["end"] * fps)
+                new_frames = end_frame - start_frame + 1
+                size = (int(width * job.payload["resize"]), int(height * job.payload["resize"]))
+                stream = gif_stream(video_name, convgif_name, fps, start_frame, new_frames, size)
+                duration = new_frames / fps
+            run_ffmpeg(stream, duration, report)
+
+        with open(convgif_name, "rb") as f:
+            blake3_hash = blake3(f.read()).hexdigest()
+        fput_util_result(convgif_name, blake3_hash, "convert")
+    finally:
+        # A failed ffmpeg run or upload leaves no partial GIF behind, the job may be retried from the video
+        if os.path.exists(convgif_name):
+            os.remove(convgif_name)
+
+    ImageUtilRecord.objects.filter(id=record.id).update(
+        result_url=presigned_fget_util_result(blake3_hash, "convert", int(timedelta(days=7).total_seconds())),
+        state="done",
+        progress=1.0,
+        finish_time=utils_time.get_timestamp()
+    )
+    os.remove(video_name)
+
 
 @CheckRequire
 def video2gif(req: HttpRequest):
@@ -317,105 +608,41 @@ def video2gif(req: HttpRequest):
         if len(keywords) > 3:
             return request_failed("Too many query parameters", status_code=400)
 
-        if len(keywords) == 0:
-            change_to_tmp_dir()
-            video_type_format = "mkv" if video_type == "x-matroska" else "mp4"
-            video_name = str(uuid.uuid4()) + '.' + video_type_format
-            convgif_name = str(uuid.uuid4()) + '.gif'
-            with open(video_name, "wb") as f:
-                for chunk in video.chunks():
-                    f.write(chunk)
-            
-            ffmpeg.input(video_name).output(convgif_name).run()
-
-            with open(convgif_name, "rb") as f:
-                blake3_hash = blake3(f.read()).hexdigest()
-            fput_util_result(convgif_name, blake3_hash, "convert")
-
-            os.remove(video_name)
-            os.remove(convgif_name)
-            
-            ImageUtilRecord.objects.create(
-                user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.CONVERT_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
-                result_type="gif",
-                util_type="convert",
-            )
-            return request_success(status_code=200)
-
-        if "start" not in keywords or "end" not in keywords or "resize" not in keywords:
-            return request_failed("Missing query parameters", status_code=400)
+        start, end, resize = None, None, None
+        if len(keywords) != 0:
+            if "start" not in keywords or "end" not in keywords or "resize" not in keywords:
+                return request_failed("Missing query parameters", status_code=400)
 
-        start = require(params, "start", "float", err_msg="Missing or error type of [start]")
-        end = require(params, "end", "float", err_msg="Missing or error type of [end]")
-        resize = require(params, "resize", "float", err_msg="Missing or error type of [resize]")
+            start = require(params, "start", "float", err_msg="Missing or error type of [start]")
+            end = require(params, "end", "float", err_msg="Missing or error type of [end]")
+            resize = require(params, "resize", "float", err_msg="Missing or error type of [resize]")
 
-        change_to_tmp_dir()
+        # The video is spooled for a background job, out of the request and its harakiri
         video_type_format = "mkv" if video_type == "x-matroska" else "mp4"
-        video_name = str(uuid.uuid4()) + '.' + video_type_format
-        convvideo_name = str(uuid.uuid4()) + '.' + video_type_format
-        convgif_name = str(uuid.uuid4()) + '.gif'
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        video_name = os.path.join(UPLOAD_SPOOL_DIR, str(uuid.uuid4()) + '.' + video_type_format)
         with open(video_name, "wb") as f:
             for chunk in video.chunks():
                 f.write(chunk)
 
-        cap = cv2.VideoCapture(video_name)
-        try:
+        if start is not None:
+            cap = cv2.VideoCapture(video_name)
             fps = cap.get(cv2.CAP_PROP_FPS)
-            width = cap.get(cv2.CAP_PROP_FRAME_WIDTH)
-            height = cap.get(cv2.CAP_PROP_FRAME_HEIGHT)
-        except:
-            return request_failed("Video file is broken", status_code=400)
-        
-        start_frame = int(start * fps)
-        end_frame = int(end * fps)
-        new_frames = end_frame - start_frame + 1
-        new_width = int(width * resize)
-        new_height = int(height * resize)
-
-        if video_type_format == "mkv":
-            fourcc = cv2.VideoWriter_fourcc(*'X264')
-        elif video_type_format == "mp4":
-            fourcc = cv2.VideoWriter_fourcc(*'MP4V')
-        out = cv2.VideoWriter(convvideo_name, fourcc, fps, (new_width, new_height))
-
-        cap.set(cv2.CAP_PROP_POS_FRAMES, start_frame)
-        for _ in range(new_frames):
-            ret, frame = cap.read()
-            if not ret: break
-            frame = cv2.resize(frame, (new_width, new_height))
-            out.write(frame)
-
-        cap.release()
-        out.release()
-
-        ffmpeg.input(convvideo_name).output(convgif_name).run()
-
-        with open(convgif_name, "rb") as f:
-            blake3_hash = blake3(f.read()).hexdigest()
-        fput_util_result(convgif_name, blake3_hash, "convert")
-
-        os.remove(video_name)
-        os.remove(convvideo_name)
-        os.remove(convgif_name)
-
-        ImageUtilRecord.objects.create(
-                user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.CONVERT_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
-                result_type="gif",
-                util_type="convert"
-            )
-        return request_success(status_code=200)
+            cap.release()
+            if not fps:
+                os.remove(video_name)
+                return request_failed("Video file is broken", status_code=400)
+
+        record = ImageUtilRecord.objects.create(
+            user=user,
+            result_url="",
+            result_type="gif",
+            util_type="convert",
+            state="pending",
+            progress=0
+        )
+        enqueue("convert_video", {"id": record.id, "path": video_name, "start": start, "end": end, "resize": resize})
+        return request_success({"id": record.id}, status_code=202)
 
     else:
         return BAD_METHOD
@@ -445,57 +672,26 @@ def super_resolution(req: HttpRequest):
             if version == b'GIF87a':
                 return request_failed("GIF87a is not supported", status_code=400)
     
-        api_url = "https://aip.baidubce.com/rest/2.0/image-process/v1/image_definition_enhance"
-        request_url = api_url + "?access_token=" + settings.BAIDU_AI_TOKEN
-
         if image_type == "gif":
             change_to_tmp_dir()
-            gif_name = str(uuid.uuid4()) + '.gif'
-            with open(gif_name, "wb") as f:
-                for chunk in image.chunks():
-                    f.write(chunk)
-
-            image = Image.open(gif_name)
-            duration = image.info['duration']
-    
-            with imageio.get_reader(gif_name) as reader:
-                frames = [Image.fromarray(frame) for frame in reader]
-                sr_frames = []
-
-            for idx, frame in enumerate(frames):
-                frame_name = str(uuid.uuid4()) + '.png'
-                frame.save(frame_name, format="PNG")
-                with open(frame_name, "rb") as f:
-                    image_b64bytes = base64.b64encode(f.read())
-                while True:
-                    response = requests.post(
-                        url=request_url,
-                        data={"image": image_b64bytes},
-                        headers={"content-type": "application/x-www-form-urlencoded"},
-                    )
-                    if "image" in response.json(): break
-                image_bytes = base64.b64decode(response.json()["image"])
-                sr_frames.append(Image.open(io.BytesIO(image_bytes)))
-                os.remove(frame_name)
-
+            image.seek(0)
             resogif_name = str(uuid.uuid4()) + '.gif'
-            sr_frames[0].save(resogif_name, save_all=True, duration=duration, loop=0, append_images=sr_frames[1:])
+            try:
+                with open(resogif_name, "wb") as f:
+                    write_animation(f, GifWriter, enhancer.enhance_frames(iter_frames(image)), encode_gif_frames)
+            except EnhanceError:
+                os.remove(resogif_name)
+                return request_failed("Super resolution failed", status_code=502)
 
             with open(resogif_name, "rb") as f:
                 blake3_hash = blake3(f.read()).hexdigest()
             fput_util_result(resogif_name, blake3_hash, "resolution")
 
-            os.remove(gif_name)
             os.remove(resogif_name)
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.RESOLUTION_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "resolution", int(timedelta(days=7).total_seconds())),
                 result_type="gif",
                 util_type="resolution"
             )
@@ -503,13 +699,10 @@ def super_resolution(req: HttpRequest):
 
         elif image_type == "jpeg":
             change_to_tmp_dir()
-            image_b64bytes = base64.b64encode(image.read())
-            response = requests.post(
-                url=request_url,
-                data={"image": image_b64bytes},
-                headers={"content-type": "application/x-www-form-urlencoded"},
-            )
-            image_bytes = base64.b64decode(response.json()["image"])
+            try:
+                image_bytes = enhancer.enhance(image.read())
+            except EnhanceError:
+                return request_failed("Super resolution failed", status_code=502)
             blake3_hash = blake3(image_bytes).hexdigest()
 
             resojpeg_name = str(uuid.uuid4()) + '.jpeg'
@@ -521,12 +714,7 @@ def super_resolution(req: HttpRequest):
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.RESOLUTION_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "resolution", int(timedelta(days=7).total_seconds())),
                 result_type="jpeg",
                 util_type="resolution"
             )
@@ -534,13 +722,10 @@ def super_resolution(req: HttpRequest):
 
         elif image_type == "png":
             change_to_tmp_dir()
-            image_b64bytes = base64.b64encode(image.read())
-            response = requests.post(
-                url=request_url,
-                data={"image": image_b64bytes},
-                headers={"content-type": "application/x-www-form-urlencoded"},
-            )
-            image_bytes = base64.b64decode(response.json()["image"])
+            try:
+                image_bytes = enhancer.enhance(image.read())
+            except EnhanceError:
+                return request_failed("Super resolution failed", status_code=502)
             blake3_hash = blake3(image_bytes).hexdigest()
 
             resopng_name = str(uuid.uuid4()) + '.png'
@@ -552,12 +737,7 @@ def super_resolution(req: HttpRequest):
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.RESOLUTION_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "resolution", int(timedelta(days=7).total_seconds())),
                 result_type="png",
                 util_type="resolution"
             )
@@ -600,7 +780,7 @@ def watermark(req: HttpRequest):
             return request_failed("Too many query parameters", status_code=400)
         
         width, height = im.size
-        font = fm.findfont(fm.FontProperties(family='DejaVu Sans', style='oblique', weight='normal'))
+        font = str(fm.findfont(fm.FontProperties(family='DejaVu Sans', style='oblique', weight='normal'))) # a plain path, to be sent to the frame pool
         
         if len(keywords) == 0:
             text = "A.R.O.N.A@{}".format(user.username)
@@ -621,15 +801,10 @@ def watermark(req: HttpRequest):
     
         if im.format == "GIF":
             change_to_tmp_dir()
-            frames = []
-            duration = im.info['duration']
-            for frame in ImageSequence.Iterator(im):
-                frame = frame.convert("RGB")
-                draw = ImageDraw.Draw(frame)
-                draw.text(xy=(width_pos, height_pos), text=text, fill="white", font=ImageFont.truetype(font, font_size))
-                frames.append(frame)
+            image.seek(0)
             gif_name = str(uuid.uuid4()) + '.gif'
-            frames[0].save(gif_name, save_all=True, duration=duration, loop=0, append_images=frames[1:])
+            with open(gif_name, "wb") as f:
+                write_animation(f, GifWriter, iter_frames(image), draw_text_gif_frames, text, (width_pos, height_pos), font, font_size)
 
             with open(gif_name, "rb") as f:
                 blake3_hash = blake3(f.read()).hexdigest()
@@ -639,12 +814,7 @@ def watermark(req: HttpRequest):
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.WATERMARK_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "watermark", int(timedelta(days=7).total_seconds())),
                 result_type="gif",
                 util_type="watermark"
             )
@@ -665,12 +835,7 @@ def watermark(req: HttpRequest):
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.WATERMARK_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "watermark", int(timedelta(days=7).total_seconds())),
                 result_type="jpeg",
                 util_type="watermark"
             )
@@ -691,12 +856,7 @@ def watermark(req: HttpRequest):
 
             ImageUtilRecord.objects.create(
                 user=user,
-                result_url=client.get_presigned_url(
-                    Method='GET',
-                    Bucket=settings.WATERMARK_BUCKET,
-                    Key=blake3_hash,
-                    Expired=timedelta(days=7).total_seconds()
-                ),
+                result_url=presigned_fget_util_result(blake3_hash, "watermark", int(timedelta(days=7).total_seconds())),
                 result_type="png",
                 util_type="watermark"
             )
@@ -754,15 +914,7 @@ def util_results(req: HttpRequest):
             {
                 "count": util_result_cnt,
                 "perPage": UTIL_RESULT_PER_PAGE,
-                "result": [
-                    {
-                        "url": util_record.result_url,
-                        "type": util_record.util_type,
-                        "fileType": util_record.result_type,
-                        "finishTime": util_record.finish_time,
-                        "expiredTime": util_record.finish_time + util_record.expiry,
-                    }
-                for util_record in util_result_page],
+                "result": [serialize_util_record(util_record) for util_record in util_result_page],
             },
             status_code=200)
 
@@ -770,6 +922,40 @@ def util_results(req: HttpRequest):
         return BAD_METHOD
 
 
+def serialize_util_record(util_record: ImageUtilRecord):
+    return {
+        "id": util_record.id,
+        "url": util_record.result_url,
+        "type": util_record.util_type,
+        "fileType": util_record.result_type,
+        "state": util_record.state,
+        "progress": util_record.progress,
+        "finishTime": util_record.finish_time,
+        "expiredTime": util_record.finish_time + util_record.expiry,
+    }
+
+
+@CheckRequire
+def util_result(req: HttpRequest, id: int):
+    if req.method == "GET":
+        auth = require(req.headers, "authorization", "string", err_msg="Missing or error type of [authorization]")
+        jw_token = auth[7:] # remove "Bearer " from the authorization header
+        try:
+            verification = jwt.decode(jw_token, settings.EDDSA_PUBLIC_KEY, algorithms="EdDSA")
+            user = User.objects.filter(username=verification["username"]).first()
+        except:
+            return request_failed("Invalid digital signature", status_code=401)
+
+        util_record = ImageUtilRecord.objects.filter(id=id, user=user).first()
+        if util_record is None:
+            return request_failed("Utility record not found", status_code=404)
+
+        return request_success(serialize_util_record(util_record), status_code=200)
+
+    else:
+        return BAD_METHOD
+
+
 @CheckRequire
 def image_category(req: HttpRequest):
     if req.method == "GET":
@@ -778,6 +964,118 @@ def image_category(req: HttpRequest):
         return BAD_METHOD
 
 
+def index_image(image: AronaImage):
+    """Add an image to the Elasticsearch index."""
+    es_body = {
+        "id": image.id,
+        "hash": image.hash,
+        "contentType": image.content_type,
+        "uploader": image.uploader.username,
+        "uploadTime": image.upload_time,
+        "likes": image.likes,
+        "comments": image.comments,
+        "width": image.width,
+        "height": image.height,
+        "title": image.title,
+        "tags": image.tags,
+        "description": image.description,
+        "category": image.category,
+        "thumbnailWidths": image.thumbnail_widths,
+    }
+    url = "{}/{}/_doc".format(settings.ES_HOST, settings.ES_DB_NAME)
+    headers = {"Content-Type": "application/json"}
+    res = requests.post(url=url, headers=headers, data=json.dumps(es_body))
+    res.raise_for_status()
+
+
+def fail_upload(job):
+    # Images sharing the hash through semiupload wait for this job, they fail along with it
+    AronaImage.objects.filter(hash=job.payload["meta"]["hash"], state="pending").update(state="failed")
+    if os.path.exists(job.payload["path"]):
+        os.remove(job.payload["path"])
+
+
+@job_handler("process_upload", on_failure=fail_upload)
+def process_upload(job):
+    """Upload a spooled image and its webp version to COS, mark it as ready, and index it.
+
+    Payload:
+        id: the ID of the uploaded image.
+        path: the path of the spooled image file.
+        meta: the metadata of the image parsed while it was spooled.
+    """
+    spool_name = job.payload["path"]
+    image = AronaImage.objects.filter(id=job.payload["id"]).first()
+    if image is None:
+        # Deleted before being processed, the images sharing its hash through semiupload still wait for the bytes
+        image = AronaImage.objects.filter(hash=job.payload["meta"]["hash"], state="pending").first()
+    if image is None:
+        if os.path.exists(spool_name):
+            os.remove(spool_name)
+        return
+
+    if image.state == "pending":
+        change_to_tmp_dir()
+        _, webp_name, thumbnail_widths = fput_object(spool_name, image.hash)
+        os.remove(webp_name)
+        # Images sharing the hash through semiupload become ready along with it
+        ready_images = list(AronaImage.objects.filter(hash=image.hash, state="pending").values_list("id", "uploader__username"))
+        AronaImage.objects.filter(hash=image.hash, state="pending").update(state="ready", thumbnail_widths=thumbnail_widths)
+        image.thumbnail_widths = thumbnail_widths
+        set_image_meta(image)
+        invalidate_tags([f"image:{id}" for id, _ in ready_images] + [f"user-images:{username}" for _, username in ready_images] + ["image-list"])
+        os.remove(spool_name)
+
+    index_image(image)
+
+
+@job_handler("index_image")
+def index_image_job(job):
+    """Index an image whose bytes are already stored.
+
+    Payload:
+        id: the ID of the image.
+    """
+    image = AronaImage.objects.filter(id=job.payload["id"]).first()
+    if image is not None:
+        index_image(image)
+
+
+@job_handler("fan_out_image")
+def fan_out_image_job(job):
+    """Add a new image to the timelines of the followers of its uploader.
+
+    Payload:
+        id: the ID of the image.
+    """
+    image = AronaImage.objects.filter(id=job.payload["id"]).first()
+    if image is not None:
+        TimelineEntry.objects.fan_out(image)
+
+
+@job_handler("refill_timelines")
+def refill_timelines_job(job):
+    """Refill the timelines of the followers of a user whose follower count crossed `TIMELINE_FANOUT_MAX_FOLLOWERS`.
+
+    Payload:
+        id: the ID of the user.
+    """
+    user = User.objects.filter(id=job.payload["id"]).first()
+    if user is not None:
+        TimelineEntry.objects.refill(user)
+
+
+def adopt_stored_image(stored_image: AronaImage, uploader: User):
+    """Create an image for `uploader` sharing the bytes of an already stored image, skipping any transfer."""
+    image = AronaImage.objects.create(content_type=stored_image.content_type, hash=stored_image.hash, uploader=uploader,
+                                      width=stored_image.width, height=stored_image.height, state=stored_image.state,
+                                      thumbnail_widths=stored_image.thumbnail_widths)
+    invalidate_tags([f"user-images:{uploader.username}", "image-list"])
+    enqueue("index_image", {"id": image.id})
+    enqueue("fan_out_image", {"id": image.id})
+    return image
+
+
 @CheckRequire
 def semiupload(req: HttpRequest):
     if req.method == "POST":
@@ -791,9 +1089,9 @@ def semiupload(req: HttpRequest):
             return request_failed("Invalid digital signature", status_code=401)
         
         hash = require(body, "hash", "string", "Missing or error type of [hash]")
-        if AronaImage.objects.filter(hash=hash).exists():
-            image = AronaImage.objects.filter(hash=hash).first()
-            upload_image = AronaImage.objects.create(content_type=image.content_type, hash=hash, uploader=uploader, width=image.width, height=image.height)
+        image = AronaImage.objects.filter(hash=hash).exclude(state="failed").first()
+        if image is not None:
+            upload_image = adopt_stored_image(image, uploader)
             return request_success({"id": upload_image.id}, 200)
         else:
             return request_success(status_code=204)
@@ -821,70 +1119,168 @@ def upload_image(req: HttpRequest):
         image_type = image.content_type.split('/')[-1]
         if image_type not in ["jpeg", "png", "gif"]:
             return request_failed("Invalid file type", status_code=400)
-        if image_type == "gif":
-            version = Image.open(image).info['version']
-            if version == b'GIF87a': # GIF87a
-                return request_failed("GIF87a is not supported", status_code=400)
+
+        # Read the upload once: spool it while hashing it and parsing its header
+        os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+        spool_name = os.path.join(UPLOAD_SPOOL_DIR, str(uuid.uuid4()) + '.' + image_type)
+        meta = ingest_upload(image, spool_name)
+        if meta["format"] != image_type or meta["width"] is None:
+            os.remove(spool_name)
+            return request_failed("Invalid file type", status_code=400)
+        if meta["version"] == "GIF87a":
+            os.remove(spool_name)
+            return request_failed("GIF87a is not supported", status_code=400)
+
+        # The bytes are already stored, skip the COS uploads and the webp version
+        stored_image = AronaImage.objects.filter(hash=meta["hash"]).exclude(state="failed").first()
+        if stored_image is not None:
+            os.remove(spool_name)
+            upload_image = adopt_stored_image(stored_image, uploader)
+            return request_success({"id": upload_image.id}, status_code=201)
+
+        upload_image = AronaImage.objects.create(content_type=image_type, hash=meta["hash"], uploader=uploader, width=meta["width"], height=meta["height"], state="pending")
+        invalidate_tags([f"user-images:{uploader.username}", "image-list"])
+
+        # Leave the COS uploads, the webp version and the indexing to a background job
+        enqueue("process_upload", {"id": upload_image.id, "path": spool_name, "meta": meta})
+        enqueue("fan_out_image", {"id": upload_image.id})
+
+        return request_success({"id": upload_image.id}, status_code=201)
         
-        width, height = Image.open(image).size
-        blake3_hash = blake3(image.read()).hexdigest()
+    else:
+        return BAD_METHOD
+    
 
-        upload_image = AronaImage.objects.create(content_type=image_type, hash=blake3_hash, uploader=uploader, width=width, height=height)
+def upload_session_path(session: UploadSession):
+    return os.path.join(UPLOAD_SPOOL_DIR, f"{session.id}.part")
 
-        if image_type == "gif":
-            change_to_tmp_dir()
-            gif_name = str(uuid.uuid4()) + '.gif'
-            with open(gif_name, "wb") as f:
-                for chunk in image.chunks():
-                    f.write(chunk)
-            gif_name, webp_name = fput_object(gif_name, blake3_hash)
 
-            os.remove(gif_name)
-            os.remove(webp_name)
+def remove_upload_session(session: UploadSession):
+    if os.path.exists(upload_session_path(session)):
+        os.remove(upload_session_path(session))
+    session.delete()
 
-        elif image_type == "jpeg":
-            change_to_tmp_dir()
-            jpeg_name = str(uuid.uuid4()) + '.jpeg'
-            with open(jpeg_name, "wb") as f:
-                for chunk in image.chunks():
-                    f.write(chunk)
-            jpeg_name, webp_name = fput_object(jpeg_name, blake3_hash)
 
-            os.remove(jpeg_name)
-            os.remove(webp_name)
+@CheckRequire
+def upload_sessions(req: HttpRequest):
+    if req.method == "POST":
+        auth = require(req.headers, "authorization", "string", err_msg="Missing or error type of [authorization]")
+        jw_token = auth[7:] # remove "Bearer " from the authorization header
+        body = json.loads(req.body.decode("utf-8").replace("'", '"'))
+        try:
+            verification = jwt.decode(jw_token, settings.EDDSA_PUBLIC_KEY, algorithms="EdDSA")
+            uploader = User.objects.filter(username=verification["username"]).first()
+        except:
+            return request_failed("Invalid digital signature", status_code=401)
 
-        elif image_type == "png":
-            change_to_tmp_dir()
-            png_name = str(uuid.uuid4()) + '.png'
-            with open(png_name, "wb") as f:
-                for chunk in image.chunks():
-                    f.write(chunk)
-            png_name, webp_name = fput_object(png_name, blake3_hash)
+        hash = require(body, "hash", "string", err_msg="Missing or error type of [hash]")
+        size = require(body, "size", "int", err_msg="Missing or error type of [size]")
+        content_type = require(body, "contentType", "string", err_msg="Missing or error type of [contentType]")
 
-            os.remove(png_name)
-            os.remove(webp_name)
-
-        es_body = {
-            "id": upload_image.id,
-            "hash": upload_image.hash,
-            "contentType": upload_image.content_type,
-            "uploader": upload_image.uploader.username,
-            "uploadTime": upload_image.upload_time,
-            "likes": upload_image.likes,
-            "comments": upload_image.comments,
-            "width": upload_image.width,
-            "height": upload_image.height,
-            "title": upload_image.title,
-            "tags": upload_image.tags,
-            "description": upload_image.description,
-            "category": upload_image.category,
-        }
-        url = "{}/{}/_doc".format(settings.ES_HOST, settings.ES_DB_NAME)
-        headers = {"Content-Type": "application/json"}
-        res = requests.post(url=url, headers=headers, data=json.dumps(es_body)).json()
+        if content_type not in ["jpeg", "png", "gif"]:
+            return request_failed("Invalid file type", status_code=400)
+        if size <= 0 or size > UPLOAD_MAX_SIZE:
+            return request_failed("Invalid size", status_code=400)
+
+        # Already stored, nothing to transfer
+        stored_image = AronaImage.objects.filter(hash=hash).exclude(state="failed").first()
+        if stored_image is not None:
+            upload_image = adopt_stored_image(stored_image, uploader)
+            return request_success({"id": upload_image.id}, status_code=200)
+
+        expired_sessions = UploadSession.objects.filter(created_time__lt=utils_time.get_timestamp() - UPLOAD_SESSION_EXPIRY)
+        for expired_session in expired_sessions:
+            remove_upload_session(expired_session)
 
+        # Resume the session of the same upload, in case the client lost track of it
+        session = UploadSession.objects.filter(uploader=uploader, hash=hash, size=size, content_type=content_type).first()
+        if session is None:
+            session = UploadSession.objects.create(uploader=uploader, hash=hash, size=size, content_type=content_type)
+            os.makedirs(UPLOAD_SPOOL_DIR, exist_ok=True)
+            open(upload_session_path(session), "wb").close()
+
+        return request_success({"session": str(session.id), "offset": session.received, "chunkSize": UPLOAD_CHUNK_SIZE}, status_code=201)
+
+    else:
+        return BAD_METHOD
+
+
+@CheckRequire
+def upload_session(req: HttpRequest, session_id: uuid.UUID):
+    auth = require(req.headers, "authorization", "string", err_msg="Missing or error type of [authorization]")
+    jw_token = auth[7:] # remove "Bearer " from the authorization header
+    try:
+        verification = jwt.decode(jw_token, settings.EDDSA_PUBLIC_KEY, algorithms="EdDSA")
+        uploader = User.objects.filter(username=verification["username"]).first()
+    except:
+        return request_failed("Invalid digital signature", status_code=401)
+
+    if req.method == "GET":
+        session = UploadSession.objects.filter(id=session_id, uploader=uploader).first()
+        if session is None:
+            return request_failed("Upload session not found", status_code=404)
+        return request_success({"offset": session.received, "size": session.size}, status_code=200)
+
+    elif req.method == "PUT":
+        offset = require(req.GET, "offset", "int", err_msg="Missing or error type of [offset]")
+
+        with transaction.atomic():
+            session = UploadSession.objects.select_for_update().filter(id=session_id, uploader=uploader).first()
+            if session is None:
+                return request_failed("Upload session not found", status_code=404)
+            if offset != session.received:
+                return request_failed(f"Expected offset {session.received}", status_code=409)
+
+            # Append the chunk, streaming it from the request instead of buffering it
+            received = session.received
+            with open(upload_session_path(session), "r+b") as f:
+                f.seek(received)
+                f.truncate()
+                for chunk in iter(lambda: req.read(64 * 1024), b""):
+                    received += len(chunk)
+                    if received - offset > UPLOAD_CHUNK_SIZE or received > session.size:
+                        return request_failed("Chunk too large", status_code=400)
+                    f.write(chunk)
+            session.received = received
+            session.save(update_fields=["received"])
+
+        if session.received < session.size:
+            return request_success({"offset": session.received}, status_code=200)
+
+        # The last chunk, check the image and hand it to the processing job
+        meta = inspect_file(upload_session_path(session))
+        if meta["hash"] != session.hash:
+            remove_upload_session(session)
+            return request_failed("Hash mismatch", status_code=400)
+        if meta["format"] != session.content_type or meta["width"] is None:
+            remove_upload_session(session)
+            return request_failed("Invalid file type", status_code=400)
+        if meta["version"] == "GIF87a":
+            remove_upload_session(session)
+            return request_failed("GIF87a is not supported", status_code=400)
+
+        stored_image = AronaImage.objects.filter(hash=meta["hash"]).exclude(state="failed").first()
+        if stored_image is not None:
+            remove_upload_session(session)
+            upload_image = adopt_stored_image(stored_image, uploader)
+            return request_success({"id": upload_image.id}, status_code=201)
+
+        spool_name = os.path.join(UPLOAD_SPOOL_DIR, f"{session.id}.{session.content_type}")
+        os.replace(upload_session_path(session), spool_name)
+        session.delete()
+        upload_image = AronaImage.objects.create(content_type=meta["format"], hash=meta["hash"], uploader=uploader, width=meta["width"], height=meta["height"], state="pending")
+        invalidate_tags([f"user-images:{uploader.username}", "image-list"])
+        enqueue("process_upload", {"id": upload_image.id, "path": spool_name, "meta": meta})
+        enqueue("fan_out_image", {"id": upload_image.id})
         return request_success({"id": upload_image.id}, status_code=201)
-        
+
+    elif req.method == "DELETE":
+        session = UploadSession.objects.filter(id=session_id, uploader=uploader).first()
+        if session is None:
+            return request_failed("Upload session not found", status_code=404)
+        remove_upload_session(session)
+        return request_success(status_code=200)
+
     else:
         return BAD_METHOD
     
@@ -936,88 +1332,112 @@ def image(req: HttpRequest, hash: str):
     image_hash = require({"hash": hash}, "hash", "string", err_msg="Missing or error type of [hash]")
 
     if req.method == "GET":
-        if not AronaImage.objects.filter(hash=image_hash).exists():
-            return request_failed("Image not found", status_code=404)
-        
-        content_type = AronaImage.objects.filter(hash=image_hash).first().content_type
-        if content_type == "gif":
-            change_to_tmp_dir()
-            gif_name = str(uuid.uuid4()) + '.gif'
-            fget_object(gif_name, "gif", image_hash)
+        not_modified = image_not_modified(req, image_hash)
+        if not_modified is not None:
+            return not_modified
 
-            with open(gif_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/gif")
-            os.remove(gif_name)
-            return response
-        
-        elif content_type == "jpeg":
-            change_to_tmp_dir()
-            jpeg_name = str(uuid.uuid4()) + '.jpeg'
-            fget_object(jpeg_name, "jpeg", image_hash)
-
-            with open(jpeg_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/jpeg")
-            os.remove(jpeg_name)
-            return response
+        image = get_image_meta(image_hash)
+        if image is None:
+            return request_failed("Image not found", status_code=404)
         
-        elif content_type == "png":
-            change_to_tmp_dir()
-            png_name = str(uuid.uuid4()) + '.png'
-            fget_object(png_name, "png", image_hash)
+        if image.content_type not in ["gif", "jpeg", "png"]:
+            raise TypeError("Unsupported image format.")
 
-            with open(png_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/png")
-            os.remove(png_name)
-            return response
+        return serve_object(req, image)
 
     else:
         return BAD_METHOD
     
 
+IMAGE_META_FIELDS = ["content_type", "width", "height", "upload_time", "thumbnail_widths"]
+
+
+def image_meta_key(blake3_hash: str):
+    return f"image-meta:{blake3_hash}"
+
+
+def get_image_meta(blake3_hash: str):
+    """Look up what serving the bytes of an image needs, without touching the DB in the common case.
+
+    The metadata is read from the process-local memo, then from the Django cache, then from the DB.
+    Only ready images are cached, so a pending image is looked up again until it becomes ready.
+
+    Returns:
+        an unsaved image holding the hash and `IMAGE_META_FIELDS` of a ready image, or None if
+        no ready image has the hash.
+    """
+    meta = image_metas.get(blake3_hash)
+    if meta is None:
+        meta = cache.get(image_meta_key(blake3_hash))
+        if meta is None:
+            meta = AronaImage.objects.filter(hash=blake3_hash, state="ready").values(*IMAGE_META_FIELDS).first()
+            if meta is None:
+                return None
+            cache.set(image_meta_key(blake3_hash), meta, IMAGE_META_TTL)
+        image_metas.set(blake3_hash, meta, IMAGE_META_LOCAL_TTL)
+    return AronaImage(hash=blake3_hash, **meta)
+
+
+def set_image_meta(image: AronaImage):
+    meta = {field: getattr(image, field) for field in IMAGE_META_FIELDS}
+    cache.set(image_meta_key(image.hash), meta, IMAGE_META_TTL)
+    image_metas.set(image.hash, meta, IMAGE_META_LOCAL_TTL)
+
+
+def delete_image_meta(blake3_hash: str):
+    cache.delete(image_meta_key(blake3_hash))
+    image_metas.delete(blake3_hash)
+
+
+def nearest_thumbnail_width(image: AronaImage, width: int=None):
+    """Select the narrowest stored thumbnail at least `width` pixels wide.
+
+    Returns:
+        the width of the thumbnail, or None if the webp version itself should be served.
+    """
+    if width is None:
+        return None
+    return next((thumbnail_width for thumbnail_width in image.thumbnail_widths if thumbnail_width >= width), None)
+
+
 @CheckRequire
 def rough_image(req: HttpRequest, hash: str):
     image_hash = require({"hash": hash}, "hash", "string", err_msg="Missing or error type of [hash]")
 
     if req.method == "GET":
-        if not AronaImage.objects.filter(hash=image_hash).exists():
+        not_modified = image_not_modified(req, image_hash)
+        if not_modified is not None:
+            return not_modified
+
+        width = require(req.GET, "w", "int", err_msg="Error type of [w]", strict=False)
+        if width is not None and width <= 0:
+            return request_failed("Error type of [w]", status_code=400)
+        format = req.GET.get("fm")
+        if format is not None and format not in VARIANT_FORMATS:
+            return request_failed("Error type of [fm]", status_code=400)
+        quality = require(req.GET, "q", "int", err_msg="Error type of [q]", strict=False)
+        if quality is not None and quality not in VARIANT_QUALITIES:
+            return request_failed("Error type of [q]", status_code=400)
+
+        image = get_image_meta(image_hash)
+        if image is None:
             return request_failed("Image not found", status_code=404)
         
-        content_type = AronaImage.objects.filter(hash=image_hash).first().content_type
-        if content_type == "gif":
-            change_to_tmp_dir()
-            webp_name = str(uuid.uuid4()) + '.webp'
-            fget_object(webp_name, "gif", image_hash, rough=True)
-            
-            with open(webp_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/webp")
-            os.remove(webp_name)
-            return response
-        
-        elif content_type == "jpeg":
-            change_to_tmp_dir()
-            webp_name = str(uuid.uuid4()) + '.webp'
-            fget_object(webp_name, "jpeg", image_hash, rough=True)
-
-            with open(webp_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/webp")
-            os.remove(webp_name)
-            return response
-            
-        elif content_type == "png":
-            change_to_tmp_dir()
-            webp_name = str(uuid.uuid4()) + '.webp'
-            fget_object(webp_name, "png", image_hash, rough=True)
+        if image.content_type not in ["gif", "jpeg", "png"]:
+            raise TypeError("Unsupported image format.")
 
-            with open(webp_name, "rb") as f:
-                response = HttpResponse(f.read(), content_type="image/webp")
-            os.remove(webp_name)
-            return response
+        # Widths snap to the stored thumbnails, other formats and qualities are rendered on demand at those widths
+        thumbnail_width = nearest_thumbnail_width(image, width)
+        if format is None and quality is None:
+            return serve_object(req, image, rough=True, width=thumbnail_width)
+        return serve_variant(req, image, thumbnail_width, format or "webp", quality or THUMBNAIL_QUALITY)
 
     else:
         return BAD_METHOD
 
 
 @CheckRequire
+@cache_response(IMAGE_INFO_CACHE_TTL, lambda req, id: [f"image:{id}"])
 def image_info(req: HttpRequest, id: int):
     image_id = require({"id": id}, "id", "int", err_msg="Missing or error type of [image id]")
 
@@ -1037,7 +1457,10 @@ def image_info(req: HttpRequest, id: int):
             return request_failed("Image not found", status_code=404)
         
         if jw_token is not None:
-            AronaImageBrowseRecord.objects.create(image=image, browser=user)
+            with transaction.atomic():
+                AronaImageBrowseRecord.objects.create(image=image, browser=user)
+                add_counter(image.id, "views", 1)
+        image = with_pending_counters([image])[0]
 
         return request_success({
             "id": image.id,
@@ -1047,12 +1470,14 @@ def image_info(req: HttpRequest, id: int):
             "uploadTime": image.upload_time,
             "likes": image.likes,
             "comments": image.comments,
+            "views": image.views,
             "width": image.width,
             "height": image.height,
             "title": image.title,
             "tags": image.tags,
             "description": image.description,
             "category": image.category,
+            "state": image.state,
             "isLiked": False if jw_token is None else image.is_liked_by(user),
         }, status_code=200)
         
@@ -1153,7 +1578,9 @@ def image_info(req: HttpRequest, id: int):
                 url = url = "{}/{}/_update/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
                 res = requests.post(url, headers=headers, data=json.dumps(update_body)).json()
 
-        image_to_update.save()
+        # The counters of the row may be changing meanwhile, leave them alone
+        image_to_update.save(update_fields=["title", "tags", "description", "category"])
+        invalidate_tags([f"image:{image_id}", f"user-images:{updater.username}", "image-list"])
         return request_success(status_code=200)
 
     elif req.method == "DELETE":
@@ -1172,21 +1599,23 @@ def image_info(req: HttpRequest, id: int):
         image_to_delete = AronaImage.objects.filter(id=image_id).first()
         image_hash = image_to_delete.hash
         image_type = image_to_delete.content_type
+        thumbnail_widths = image_to_delete.thumbnail_widths
 
         if deleter != image_to_delete.uploader:
             return request_failed("You are not the uploader of this image", status_code=403)
         
         image_to_delete.delete()
+        invalidate_tags([f"image:{image_id}", f"image-comments:{image_id}", f"user-images:{deleter.username}", "image-list"])
         if not AronaImage.objects.filter(hash=image_hash).exists():
-            if image_type == "gif":
-                client.delete_object(Bucket=settings.GIF_BUCKET, Key=f"{image_hash}.gif")
-                client.delete_object(Bucket=settings.ROUGH_GIF_BUCKET, Key=f"{image_hash}.webp")
-            elif image_type == "jpeg":
-                client.delete_object(Bucket=settings.JPEG_BUCKET, Key=f"{image_hash}.jpeg")
-                client.delete_object(Bucket=settings.ROUGH_JPEG_BUCKET, Key=f"{image_hash}.webp")
-            elif image_type == "png":
-                client.delete_object(Bucket=settings.PNG_BUCKET, Key=f"{image_hash}.png")
-                client.delete_object(Bucket=settings.ROUGH_PNG_BUCKET, Key=f"{image_hash}.webp")
+            delete_image_meta(image_hash)
+            image_cache.delete(image_hash, "raw")
+            variant_cache.delete_all(image_hash)
+            presigned_urls.delete((object_bucket(image_type), image_hash))
+            storage.delete_many(object_bucket(image_type), [image_hash])
+            for width in [None] + thumbnail_widths:
+                image_cache.delete(image_hash, object_variant(True, width))
+                presigned_urls.delete((object_bucket(image_type, rough=True), object_key(image_hash, width)))
+            storage.delete_many(object_bucket(image_type, rough=True), [object_key(image_hash, width) for width in [None] + thumbnail_widths])
 
         es_id = get_es_id(image_id)
         url = "{}/{}/_doc/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
@@ -1199,7 +1628,19 @@ def image_info(req: HttpRequest, id: int):
         return BAD_METHOD
 
 
+def comment_poster_info(poster: User):
+    return {
+        "username": poster.username,
+        "nickname": poster.nickname,
+        "registerTime": poster.registerTime,
+        "userType": poster.userType,
+        "slogan": poster.slogan,
+        "email": poster.email,
+    }
+
+
 @CheckRequire
+@cache_response(IMAGE_COMMENTS_CACHE_TTL, lambda req, id: [f"image-comments:{id}"])
 def image_comments(req: HttpRequest, id: int):
     image_id = require({"id": id}, "id", "int", err_msg="Missing or error type of [image id]")
 
@@ -1237,17 +1678,26 @@ def image_comments(req: HttpRequest, id: int):
             except:
                 return request_failed("Invalid digital signature", status_code=401)
 
-        comments = Comment.objects.filter(belong_to_image=image)
+        comments = Comment.objects.filter(belong_to_image=image).select_related("poster")
 
         # Get the first level comments
         if sorted_by == "time":
             first_level_comments = comments.filter(belong_to_comment=None).order_by("-post_time")
-        second_level_comments = comments.exclude(belong_to_comment=None).order_by("post_time")
 
         # Pagination
         comment_pages = Paginator(first_level_comments, COMMENT_PER_PAGE)
         comment_cnt = comment_pages.count
-        result_page = comment_pages.get_page(page)
+        result_page = list(comment_pages.get_page(page))
+
+        # Fetch the replies of the whole page at once, and group them by the comment they belong to
+        replies = {comment.id: [] for comment in result_page}
+        for sub_comment in comments.filter(belong_to_comment__in=result_page).order_by("post_time"):
+            replies[sub_comment.belong_to_comment_id].append(sub_comment)
+
+        liked_ids = set()
+        if jw_token is not None:
+            page_ids = list(replies.keys()) + [sub_comment.id for sub_comments in replies.values() for sub_comment in sub_comments]
+            liked_ids = set(LikeCommentRelation.objects.filter(user=user, comment__in=page_ids).values_list("comment_id", flat=True))
 
         # Construct the two-layer comment list
         comment_list = []
@@ -1255,39 +1705,21 @@ def image_comments(req: HttpRequest, id: int):
             comment_list.append({
                 "id": comment.id,
                 "content": comment.content,
-                "poster": {
-                    "username": comment.poster.username,
-                    "nickname": comment.poster.nickname,
-                    "registerTime": comment.poster.registerTime,
-                    "userType": comment.poster.userType,
-                    "slogan": comment.poster.slogan,
-                    "email": comment.poster.email,
-                },
+                "poster": comment_poster_info(comment.poster),
                 "postTime": comment.post_time,
                 "likes": comment.likes,
                 "comments": comment.comments,
-                "isLiked": False if jw_token is None else comment.is_liked_by(user),
-                "replies": [],
-            })
-
-            sub_comments = second_level_comments.filter(belong_to_comment=comment).order_by("post_time")
-            for sub_comment in sub_comments:
-                comment_list[-1]["replies"].append({
+                "isLiked": comment.id in liked_ids,
+                "replies": [{
                     "id": sub_comment.id,
                     "content": sub_comment.content,
-                    "poster": {
-                        "username": comment.poster.username,
-                        "nickname": comment.poster.nickname,
-                        "registerTime": comment.poster.registerTime,
-                        "userType": comment.poster.userType,
-                        "slogan": comment.poster.slogan,
-                        "email": comment.poster.email,
-                    },
+                    "poster": comment_poster_info(sub_comment.poster),
                     "postTime": sub_comment.post_time,
                     "likes": sub_comment.likes,
                     "replyToUser": sub_comment.reply_to_user_username,
-                    "isLiked": False if jw_token is None else sub_comment.is_liked_by(user),
-                })
+                    "isLiked": sub_comment.id in liked_ids,
+                } for sub_comment in replies[comment.id]],
+            })
 
         return request_success(
             {
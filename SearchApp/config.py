@@ -1,4 +1,5 @@
 SEARCH_RESULT_PER_PAGE = 10
 SEARCH_HISTORY_SIZE = 10
 MAX_ES_SEARCH_SIZE = 200000
-MAX_ES_DETERMINED_STATES = 10000
\ No newline at end of file
+MAX_ES_DETERMINED_STATES = 10000
+SEARCH_RESULT_CACHE_TTL = 10 # seconds the anonymous results of empty searches are cached
\ No newline at end of file
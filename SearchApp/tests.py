@@ -15,6 +15,7 @@ class SearchTests(TestCase):
     def setUp(self) -> None:
         self.factory = RequestFactory()
         self.jwt = os.getenv("TEST_JWT")# for real unit-test
+        cache.clear()
 
     def setupuser(self, username, password, email):
         if not User.objects.filter(username = username).exists():
@@ -6,12 +6,14 @@ from django.http import HttpRequest, HttpResponse, JsonResponse
 from django.core.paginator import Paginator
 from UsersApp.models import User
 from SearchApp.models import SearchModel
-from SearchApp.config import SEARCH_RESULT_PER_PAGE, SEARCH_HISTORY_SIZE, MAX_ES_SEARCH_SIZE, MAX_ES_DETERMINED_STATES
+from SearchApp.config import SEARCH_RESULT_PER_PAGE, SEARCH_HISTORY_SIZE, MAX_ES_SEARCH_SIZE, MAX_ES_DETERMINED_STATES, SEARCH_RESULT_CACHE_TTL
 from ImagesApp.models import AronaImage
 from django.conf import settings
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import bulk
 from utils.utils_time import get_timestamp
+from utils.utils_cache import cache_response
+from utils.utils_counters import with_pending_counters
 from utils.utils_request import BAD_METHOD, request_failed, request_success
 from utils.utils_require import MAX_CHAR_LENGTH, CheckPath, CheckRequire, require
 import json 
@@ -22,7 +24,16 @@ from urllib.parse import unquote
 client = Elasticsearch(hosts=[settings.ES_HOST])
 
 
+def empty_search_tags(req: HttpRequest):
+    """Tag the listings of all images, i.e. the searches without any search term."""
+    search_for = unquote(unquote(req.GET.get("searchFor", ""), 'utf-8'), 'utf-8')
+    if search_for == "" or set(search_for) == {' '} or search_for == ".*":
+        return ["image-list"]
+    return None
+
+
 @CheckRequire
+@cache_response(SEARCH_RESULT_CACHE_TTL, empty_search_tags)
 def search_image(req: HttpRequest):
     if req.method == "GET":
         auth = require(req.headers, "authorization", "string", err_msg="Missing or error type of [authorization]", strict=False)
@@ -81,7 +92,7 @@ def search_image(req: HttpRequest):
             regexp = 0
 
         if search_for == "" or set(search_for)== {' '} or search_for == ".*":
-            all_images = AronaImage.objects.all()
+            all_images = AronaImage.objects.filter(state="ready")
             if not category == 'all':
                 all_images = all_images.filter(category=category)
             if not uploader == 'all':
@@ -106,7 +117,7 @@ def search_image(req: HttpRequest):
                 
             final_pages= Paginator(final_list, SEARCH_RESULT_PER_PAGE)
             count = final_pages.count
-            return_page = final_pages.page(page)
+            return_page = with_pending_counters(final_pages.page(page))
             
             if jw_token is not None:
                 if login_user is not None:
@@ -133,6 +144,7 @@ def search_image(req: HttpRequest):
                         "tags": image.tags,
                         "description": image.description,
                         "category": image.category,
+                        "thumbnailWidths": image.thumbnail_widths,
                         "isLiked": False
                     }
                 for image in return_page]
@@ -142,10 +154,12 @@ def search_image(req: HttpRequest):
             tag_list = analyzer(search_for, settings.ES_DB_NAME, regexp)
 
             unfilted_list = search_data(tag_list, settings.ES_DB_NAME)
+            # Images sharing the hash of a pending upload are indexed before their bytes are ready
+            ready_ids = set(AronaImage.objects.filter(id__in=[item["id"] for item in unfilted_list if "id" in item], state="ready").values_list("id", flat=True))
             filted_list = []
             for item in unfilted_list:
                 if "properties" not in item.keys():
-                    flag = True
+                    flag = item.get("id") in ready_ids
                     if not category == 'all':
                         if not item['category'] == category:
                             flag = False
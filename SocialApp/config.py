@@ -1 +1,8 @@
-FOLLOWING_IMAGE_PER_PAGE = 10
\ No newline at end of file
+FOLLOWING_IMAGE_PER_PAGE = 10
+
+# The images of followed users are copied to the timeline of each follower when they are uploaded,
+# except for users with more than TIMELINE_FANOUT_MAX_FOLLOWERS followers, whose images are merged
+# into the timelines when they are read. Following a user copies its TIMELINE_BACKFILL latest images, and so
+# does a user crossing back below TIMELINE_FANOUT_MAX_FOLLOWERS for every follower.
+TIMELINE_FANOUT_MAX_FOLLOWERS = 10000
+TIMELINE_BACKFILL = 100
@@ -0,0 +1,38 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:50
+
+from django.db import migrations, models
+from django.db.models import Count, F, Min
+
+
+def dedup_likes(apps, schema_editor):
+    """Drop the duplicate likes, keeping the first one of each user, and take them off the counters."""
+    AronaImage = apps.get_model("ImagesApp", "AronaImage")
+    Comment = apps.get_model("SocialApp", "Comment")
+    LikeImageRelation = apps.get_model("SocialApp", "LikeImageRelation")
+    LikeCommentRelation = apps.get_model("SocialApp", "LikeCommentRelation")
+
+    for relation_model, target, target_model in [(LikeImageRelation, "image", AronaImage), (LikeCommentRelation, "comment", Comment)]:
+        duplicates = relation_model.objects.values("user", target).annotate(first=Min("id"), total=Count("id")).filter(total__gt=1)
+        for row in duplicates:
+            relation_model.objects.filter(user=row["user"], **{target: row[target]}).exclude(id=row["first"]).delete()
+            target_model.objects.filter(id=row[target]).update(likes=F("likes") - (row["total"] - 1))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0027_aronaimage_views_imagecounterdelta'),
+        ('SocialApp', '0012_alter_comment_belong_to_comment_and_more'),
+    ]
+
+    operations = [
+        migrations.RunPython(dedup_likes, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='likecommentrelation',
+            constraint=models.UniqueConstraint(fields=('user', 'comment'), name='unique_like_comment'),
+        ),
+        migrations.AddConstraint(
+            model_name='likeimagerelation',
+            constraint=models.UniqueConstraint(fields=('user', 'image'), name='unique_like_image'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 4.2.1 on 2026-10-18 14:53
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# The values of SocialApp.config when this migration was written, so it fills the same timelines whenever it runs
+TIMELINE_FANOUT_MAX_FOLLOWERS = 10000
+TIMELINE_BACKFILL = 100
+
+
+def fill_timelines(apps, schema_editor):
+    """Fill the timelines of the existing followers with the latest images of the users they follow."""
+    AronaImage = apps.get_model("ImagesApp", "AronaImage")
+    User = apps.get_model("UsersApp", "User")
+    FollowRelation = apps.get_model("UsersApp", "FollowRelation")
+    TimelineEntry = apps.get_model("SocialApp", "TimelineEntry")
+
+    users = {user.username: user for user in User.objects.all()}
+    for relation in FollowRelation.objects.all():
+        follower, following = users.get(relation.follower), users.get(relation.following)
+        if follower is None or following is None or following.followerCount > TIMELINE_FANOUT_MAX_FOLLOWERS:
+            continue
+        images = AronaImage.objects.filter(uploader=following).order_by("-upload_time", "-id")[:TIMELINE_BACKFILL]
+        TimelineEntry.objects.bulk_create([TimelineEntry(owner=follower, image=image, upload_time=image.upload_time) for image in images],
+                                          ignore_conflicts=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ImagesApp', '0027_aronaimage_views_imagecounterdelta'),
+        ('UsersApp', '0005_user_last_view_folllowing_moment'),
+        ('SocialApp', '0013_dedup_likes_unique'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.BigAutoField(primary_key=True, serialize=False)),
+                ('upload_time', models.FloatField()),
+                ('image', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='ImagesApp.aronaimage')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to='UsersApp.user')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['owner', '-upload_time', '-image'], name='SocialApp_t_owner_i_11d605_idx')],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='timelineentry',
+            constraint=models.UniqueConstraint(fields=('owner', 'image'), name='unique_timeline_entry'),
+        ),
+        migrations.RunPython(fill_timelines, migrations.RunPython.noop),
+    ]
@@ -1,35 +1,29 @@
-from django.db import models
+from django.db import connection, models, transaction
+from django.db.models import F, Q
 from utils import utils_time
+from utils.utils_counters import add_counter
+from utils.utils_jobs import enqueue
 from utils.utils_require import MAX_CHAR_LENGTH, MAX_TEXT_LENGTH
-from UsersApp.models import User
+from UsersApp.models import User, FollowRelation
+from SocialApp.config import TIMELINE_FANOUT_MAX_FOLLOWERS, TIMELINE_BACKFILL
 from ImagesApp.models import AronaImage
 
 
 class CommentManager(models.Manager):
     # 重载 create
+    @transaction.atomic
     def create(self, *args, **kwargs):
         # 创建该评论
         comment = super().create(*args, **kwargs)
         # 所属图片的评论数加一
-        belong_to_image = AronaImage.objects.filter(id=comment.belong_to_image.id).first()
-        belong_to_image.comments += 1
-        belong_to_image.save()
+        add_counter(comment.belong_to_image_id, "comments", 1)
         # 如果是二级评论
         if comment.is_first_level() is False:
-            if comment.reply_to_first_level():
-                # 一级评论的评论数加一
-                belong_to_comment = Comment.objects.filter(id=comment.belong_to_comment.id).first()
-                belong_to_comment.comments += 1
-                belong_to_comment.save()
-            else:
-                # 一级评论的评论数加一
-                belong_to_comment = Comment.objects.filter(id=comment.belong_to_comment.id).first()
-                belong_to_comment.comments += 1
-                belong_to_comment.save()
+            # 一级评论的评论数加一
+            Comment.objects.filter(id=comment.belong_to_comment_id).update(comments=F("comments") + 1)
+            if not comment.reply_to_first_level():
                 # 所回复的二级评论的评论数加一
-                reply_to_comment = Comment.objects.filter(id=comment.reply_to_comment.id).first()
-                reply_to_comment.comments += 1
-                reply_to_comment.save()
+                Comment.objects.filter(id=comment.reply_to_comment_id).update(comments=F("comments") + 1)
         return comment
 
 
@@ -59,31 +53,31 @@ class Comment(models.Model):
         return LikeCommentRelation.objects.filter(user=user, comment=self).exists()
     
     # 重载 delete
+    @transaction.atomic
     def delete(self, *args, **kwargs):
         if self.is_first_level() is False:
-            self.belong_to_image.comments -= 1
-            self.belong_to_image.save()
-            if self.reply_to_first_level():
-                self.belong_to_comment.comments -= 1
-                self.belong_to_comment.save()
-            else:
-                self.belong_to_comment.comments -= 1
-                self.belong_to_comment.save()
-                if self.reply_to_comment is not None:
-                    self.reply_to_comment.comments -= 1
-                    self.reply_to_comment.save()
-            replies = Comment.objects.filter(reply_to_comment=self)
-            for item in replies:
-                item.reply_to_comment = None
-                item.save()
+            add_counter(self.belong_to_image_id, "comments", -1)
+            Comment.objects.filter(id=self.belong_to_comment_id).update(comments=F("comments") - 1)
+            if not self.reply_to_first_level() and self.reply_to_comment_id is not None:
+                Comment.objects.filter(id=self.reply_to_comment_id).update(comments=F("comments") - 1)
+            Comment.objects.filter(reply_to_comment=self).update(reply_to_comment=None)
             super().delete(*args, **kwargs)
         else:
-            belongings = Comment.objects.filter(belong_to_comment=self)
-            self.belong_to_image.comments -= 1
-            self.belong_to_image.save()
-            for item in belongings:
-                item.delete()
-            super().delete(*args, **kwargs)
+            self.delete_thread()
+
+    def delete_thread(self):
+        """Delete a first level comment along with all its replies, in a constant number of queries.
+
+        Replies only refer to comments of their own thread, so once the likes of the thread are
+        gone, nothing else refers to it and it is deleted by a single statement, without the deletion
+        collector, which would follow the chain of replies one level at a time.
+        """
+        thread = Comment.objects.filter(Q(id=self.id) | Q(belong_to_comment=self))
+        LikeCommentRelation.objects.filter(comment__in=thread).delete()
+
+        deleted = thread._raw_delete(thread.db)
+        add_counter(self.belong_to_image_id, "comments", -deleted)
+        self.id = None
    
     class Meta:
         indexes = [
@@ -93,16 +87,51 @@ class Comment(models.Model):
         ]
 
 
+def toggle_relation(model, user: User, target: str, target_id: int):
+    """Delete the relation of `model` between a user and a target if it exists, or insert it otherwise.
+
+    Each step is a single statement, and the insert does nothing if a concurrent toggle inserted the
+    relation first, so racing toggles never duplicate it.
+
+    Returns:
+        1 if the relation is inserted, -1 if it is deleted, or 0 if nothing changed.
+    """
+    deleted, _ = model.objects.filter(user=user, **{f"{target}_id": target_id}).delete()
+    if deleted > 0:
+        return -1
+
+    quote = connection.ops.quote_name
+    table, user_column, target_column = quote(model._meta.db_table), quote(model._meta.get_field("user").column), quote(model._meta.get_field(target).column)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {table} ({user_column}, {target_column}) VALUES (%s, %s) "
+            f"ON CONFLICT ({user_column}, {target_column}) DO NOTHING RETURNING id",
+            [user.pk, target_id]
+        )
+        return 0 if cursor.fetchone() is None else 1
+
+
 class LikeImageRelationManager(models.Manager):
     # 重载 create
+    @transaction.atomic
     def create(self, *args, **kwargs):
         # 创建该点赞
         relation = super().create(*args, **kwargs)
         # 所属图片的点赞数加一
-        belong_to_image = AronaImage.objects.filter(id=relation.image.id).first()
-        belong_to_image.likes += 1
-        belong_to_image.save()
+        add_counter(relation.image_id, "likes", 1)
         return relation
+
+    @transaction.atomic
+    def toggle(self, user: User, image_id: int):
+        """Like or unlike an image, and count it only if the like actually changed.
+
+        Returns:
+            the change of the likes of the image, see `toggle_relation`.
+        """
+        change = toggle_relation(self.model, user, "image", image_id)
+        if change != 0:
+            add_counter(image_id, "likes", change)
+        return change
     
 
 class LikeImageRelation(models.Model):
@@ -113,32 +142,47 @@ class LikeImageRelation(models.Model):
     image = models.ForeignKey(AronaImage, on_delete=models.CASCADE, related_name="image_likes")
 
     # 重载 delete
+    @transaction.atomic
     def delete(self, *args, **kwargs):
-        # 所属图片的点赞数减一
-        belong_to_image = AronaImage.objects.filter(id=self.image.id).first()
-        belong_to_image.likes -= 1
-        belong_to_image.save()
         # 删除该点赞
-        super().delete(*args, **kwargs)
+        deleted, deleted_per_model = super().delete(*args, **kwargs)
+        # 所属图片的点赞数减去实际删除的行数, 重复或并发的删除不会多减
+        if deleted:
+            add_counter(self.image_id, "likes", -deleted)
+        return deleted, deleted_per_model
 
     class Meta:
         indexes = [
             models.Index(fields=['user']),
             models.Index(fields=['image']),
         ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'image'], name='unique_like_image'),
+        ]
 
 
 class LikeCommentRelationManager(models.Manager):
     # 重载 create
+    @transaction.atomic
     def create(self, *args, **kwargs):
         # 创建该点赞
         relation = super().create(*args, **kwargs)
         # 所属评论的点赞数加一
-        belong_to_comment = Comment.objects.filter(id=relation.comment.id).first()
-        belong_to_comment.likes += 1
-        belong_to_comment.save()
+        Comment.objects.filter(id=relation.comment_id).update(likes=F("likes") + 1)
         return relation
 
+    @transaction.atomic
+    def toggle(self, user: User, comment_id: int):
+        """Like or unlike a comment, and count it only if the like actually changed.
+
+        Returns:
+            the change of the likes of the comment, see `toggle_relation`.
+        """
+        change = toggle_relation(self.model, user, "comment", comment_id)
+        if change != 0:
+            Comment.objects.filter(id=comment_id).update(likes=F("likes") + change)
+        return change
+
 
 class LikeCommentRelation(models.Model):
     objects = LikeCommentRelationManager()
@@ -148,11 +192,10 @@ class LikeCommentRelation(models.Model):
     comment = models.ForeignKey(Comment, on_delete=models.CASCADE, related_name="comment_likes")
 
     # 重载 delete
+    @transaction.atomic
     def delete(self, *args, **kwargs):
         # 所属评论的点赞数减一
-        belong_to_comment = Comment.objects.filter(id=self.comment.id).first()
-        belong_to_comment.likes -= 1
-        belong_to_comment.save()
+        Comment.objects.filter(id=self.comment_id).update(likes=F("likes") - 1)
         # 删除该点赞
         super().delete(*args, **kwargs)
 
@@ -160,4 +203,93 @@ class LikeCommentRelation(models.Model):
         indexes = [
             models.Index(fields=['user']),
             models.Index(fields=['comment']),
-        ]
\ No newline at end of file
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'comment'], name='unique_like_comment'),
+        ]
+
+
+
+class TimelineEntryManager(models.Manager):
+    def fan_out(self, image: AronaImage):
+        """Add an image to the timeline of every follower of its uploader, unless they are too many.
+
+        Images already in a timeline are skipped, so fanning out an image again is harmless.
+
+        Returns:
+            the number of timelines holding the image.
+        """
+        if image.uploader.followerCount > TIMELINE_FANOUT_MAX_FOLLOWERS:
+            return 0
+        followers = User.objects.filter(username__in=FollowRelation.objects.filter(following=image.uploader.username).values("follower"))
+        entries = [self.model(owner_id=follower_id, image=image, upload_time=image.upload_time) for follower_id in followers.values_list("id", flat=True)]
+        self.bulk_create(entries, ignore_conflicts=True, batch_size=1000)
+        return len(entries)
+
+    def follow(self, follower: User, following: User):
+        """Add the latest images of a followed user to the timeline of its new follower.
+
+        `following` holds the follower count including the new follower.
+        """
+        self.follower_count_changed(following, following.followerCount - 1)
+        if following.followerCount > TIMELINE_FANOUT_MAX_FOLLOWERS:
+            return
+        images = AronaImage.objects.filter(uploader=following).order_by("-upload_time", "-id")[:TIMELINE_BACKFILL]
+        self.bulk_create([self.model(owner=follower, image=image, upload_time=image.upload_time) for image in images], ignore_conflicts=True)
+
+    def unfollow(self, follower: User, following: User):
+        """Remove the images of a user from the timeline of its former follower.
+
+        `following` holds the follower count without the former follower.
+        """
+        self.filter(owner=follower, image__uploader=following).delete()
+        self.follower_count_changed(following, following.followerCount + 1)
+
+    def follower_count_changed(self, user: User, previous: int):
+        """Queue a refill of the timelines of the followers of a user whose follower count crossed `TIMELINE_FANOUT_MAX_FOLLOWERS`."""
+        if (previous > TIMELINE_FANOUT_MAX_FOLLOWERS) != (user.followerCount > TIMELINE_FANOUT_MAX_FOLLOWERS):
+            enqueue("refill_timelines", {"id": user.id})
+
+    def refill(self, uploader: User):
+        """Bring the timelines of the followers of a user in line with whether its images are fanned out.
+
+        The images of a user with too many followers are merged into the timelines on read, so they
+        are dropped from the timelines. Otherwise, its latest images are copied into the timeline of
+        every follower, as if they had just followed it, which restores the images it uploaded while
+        it had too many followers.
+        """
+        if uploader.followerCount > TIMELINE_FANOUT_MAX_FOLLOWERS:
+            self.filter(image__uploader=uploader).delete()
+            return
+
+        images = list(AronaImage.objects.filter(uploader=uploader).order_by("-upload_time", "-id")[:TIMELINE_BACKFILL])
+        followers = User.objects.filter(username__in=FollowRelation.objects.filter(following=uploader.username).values("follower"))
+        follower_ids = list(followers.values_list("id", flat=True))
+        # A batch of followers at a time, so the entries of every follower are never all held at once
+        for start in range(0, len(follower_ids), 100):
+            self.bulk_create([self.model(owner_id=follower_id, image=image, upload_time=image.upload_time)
+                              for follower_id in follower_ids[start:start + 100] for image in images], ignore_conflicts=True, batch_size=1000)
+
+
+class TimelineEntry(models.Model):
+    """An image in the timeline of a user, i.e. uploaded by someone the user follows.
+
+    Attributes:
+        owner: the user whose timeline holds the image.
+        image: the image.
+        upload_time: the upload time of the image, copied to order the timeline by its index.
+    """
+    objects = TimelineEntryManager()
+
+    id = models.BigAutoField(primary_key=True)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="timeline")
+    image = models.ForeignKey(AronaImage, on_delete=models.CASCADE, related_name="timeline_entries")
+    upload_time = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', '-upload_time', '-image']),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'image'], name='unique_timeline_entry'),
+        ]
@@ -1,13 +1,21 @@
 import random
 import uuid
 import os
+import threading
+from unittest.mock import patch
 from urllib.request import urlopen, Request
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.cache import cache
 from UsersApp.models import User, FollowRelation
 from ImagesApp.models import AronaImage
 from SocialApp.models import Comment, LikeImageRelation, LikeCommentRelation
 from .views import *
 from ImagesApp.views import *
+from UsersApp.views import user_image_info
+from SearchApp.views import search_image
+from utils.utils_counters import flush_counters, reconcile_counters, with_pending_counters
 
 
 class SocialTests(TestCase):
@@ -18,6 +26,7 @@ class SocialTests(TestCase):
                             email="test@sharklasers.com", mail_code="231425", salt="1919810")
         self.user = User.objects.filter(username="test").first()
         self.jwt = os.getenv("TEST_JWT")
+        cache.clear()
     
 
     # Utility functions
@@ -495,4 +504,221 @@ class SocialTests(TestCase):
 
         # check the response
         self.assertEqual(json_response, {"msg": "Comment not found"})
-        self.assertEqual(response.status_code, 404)
\ No newline at end of file
+        self.assertEqual(response.status_code, 404)
+
+
+    def test_delete_comment_thread_constant_queries(self):
+        image = AronaImage.objects.create(content_type="png", hash=blake3(b"thread").hexdigest(), uploader=self.user, width=1, height=1, state="ready")
+
+        def delete_thread(replies: int):
+            comment = Comment.objects.create(content="test", poster=self.user, belong_to_image=image)
+            LikeCommentRelation.objects.create(user=self.user, comment=comment)
+            reply_to = comment
+            for i in range(replies):
+                reply_to = Comment.objects.create(content=f"reply{i}", poster=self.user, belong_to_image=image, belong_to_comment=comment,
+                                                  reply_to_comment=reply_to, reply_to_user_username=self.user.username)
+                LikeCommentRelation.objects.create(user=self.user, comment=reply_to)
+            with CaptureQueriesContext(connection) as queries:
+                comment.delete()
+            return len(queries)
+
+        # check that a thread of many replies takes as many queries as a thread of one
+        self.assertEqual(delete_thread(100), delete_thread(1))
+        self.assertFalse(Comment.objects.filter(belong_to_image=image).exists())
+        self.assertFalse(LikeCommentRelation.objects.exists())
+        self.assertEqual(AronaImage.objects.get(id=image.id).comments, 0)
+
+
+
+    def test_dynamic_list_timeline(self):
+        normal = User.objects.create(username="normal", password="114514", email="normal@sharklasers.com", mail_code="231425", salt="1919810", followerCount=1)
+        star = User.objects.create(username="star", password="114514", email="star@sharklasers.com", mail_code="231425", salt="1919810",
+                                   followerCount=TIMELINE_FANOUT_MAX_FOLLOWERS + 1)
+        for following in [normal, star]:
+            FollowRelation.objects.create(follower=self.user.username, following=following.username)
+
+        images = []
+        for i in range(15):
+            # Pairs of images share their upload time, to be told apart by their IDs
+            image = AronaImage.objects.create(content_type="png", hash=blake3(f"timeline{i}".encode()).hexdigest(), uploader=normal if i % 2 == 0 else star,
+                                              width=1, height=1, upload_time=1000.0 + i // 2)
+            enqueue("fan_out_image", {"id": image.id})
+            images.append(image)
+
+        # check that only the images of the account with few followers are fanned out
+        self.assertEqual(TimelineEntry.objects.filter(owner=self.user).count(), 8)
+        # An image of the popular account fanned out before it had that many followers is also merged on read
+        TimelineEntry.objects.create(owner=self.user, image=images[1], upload_time=images[1].upload_time)
+
+        # check that the pages merge both accounts in order, without gaps or repeats
+        ids, cursor = [], None
+        while True:
+            params = {} if cursor is None else {"cursor": cursor}
+            response = dynamic_list(self.factory.get("/dynamic/list", params, HTTP_AUTHORIZATION=f"Bearer {self.jwt}"))
+            json_response = json.loads(response.content)
+            self.assertEqual(json_response["count"], len(images) if cursor is None else None)
+            ids += [result["id"] for result in json_response["result"]]
+            cursor = json_response["cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(ids, [image.id for image in sorted(images, key=lambda image: (image.upload_time, image.id), reverse=True)])
+
+        # check that numbered pages are still served in the same order
+        page_ids = []
+        for page in [1, 2]:
+            response = dynamic_list(self.factory.get("/dynamic/list", {"pageId": page}, HTTP_AUTHORIZATION=f"Bearer {self.jwt}"))
+            json_response = json.loads(response.content)
+            self.assertEqual(json_response["count"], len(images))
+            page_ids += [result["id"] for result in json_response["result"]]
+        self.assertEqual(page_ids, ids)
+
+        # check that a cursor page does not count the whole timeline again
+        response = dynamic_list(self.factory.get("/dynamic/list", HTTP_AUTHORIZATION=f"Bearer {self.jwt}"))
+        cursor = json.loads(response.content)["cursor"]
+        with self.assertNumQueries(4): # the user, its last view time, and a page of each source
+            dynamic_list(self.factory.get("/dynamic/list", {"cursor": cursor}, HTTP_AUTHORIZATION=f"Bearer {self.jwt}"))
+
+        # check that unfollowing and following again empties and refills the timeline
+        TimelineEntry.objects.unfollow(self.user, normal)
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.user, image__uploader=normal).exists())
+        TimelineEntry.objects.follow(self.user, normal)
+        self.assertEqual(TimelineEntry.objects.filter(owner=self.user, image__uploader=normal).count(), 8)
+
+
+    def test_lists_skip_unready_images(self):
+        normal = User.objects.create(username="normal", password="114514", email="normal@sharklasers.com", mail_code="231425", salt="1919810", followerCount=1)
+        FollowRelation.objects.create(follower=self.user.username, following=normal.username)
+        for state in ["ready", "pending", "failed"]:
+            image = AronaImage.objects.create(content_type="png", hash=blake3(state.encode()).hexdigest(), uploader=normal, width=1, height=1, state=state)
+            enqueue("fan_out_image", {"id": image.id})
+
+        # check that only the ready image is listed, as the others cannot be served
+        responses = [
+            dynamic_list(self.factory.get("/dynamic/list", HTTP_AUTHORIZATION=f"Bearer {self.jwt}")),
+            user_image_info(self.factory.get(f"/user/{normal.username}/images"), normal.username),
+            search_image(self.factory.get("/search/images", {"uploader": normal.username})),
+        ]
+        for response in responses:
+            json_response = json.loads(response.content)
+            self.assertEqual(json_response["count"], 1)
+            self.assertEqual([result["hash"] for result in json_response["result"]], [blake3(b"ready").hexdigest()])
+
+
+    def test_timeline_refilled_across_fanout_threshold(self):
+        star = User.objects.create(username="star", password="114514", email="star@sharklasers.com", mail_code="231425", salt="1919810",
+                                   followerCount=TIMELINE_FANOUT_MAX_FOLLOWERS + 1)
+        fan = User.objects.create(username="fan", password="114514", email="fan@sharklasers.com", mail_code="231425", salt="1919810")
+        FollowRelation.objects.create(follower=self.user.username, following=star.username)
+        for i in range(3):
+            image = AronaImage.objects.create(content_type="png", hash=blake3(f"threshold{i}".encode()).hexdigest(), uploader=star, width=1, height=1)
+            enqueue("fan_out_image", {"id": image.id})
+        self.assertFalse(TimelineEntry.objects.filter(owner=self.user).exists())
+
+        # check that the images uploaded while merged on read are copied once the account is fanned out again
+        FollowRelation.objects.create(follower=fan.username, following=star.username)
+        star.followerCount = TIMELINE_FANOUT_MAX_FOLLOWERS
+        star.save()
+        TimelineEntry.objects.unfollow(fan, star)
+        self.assertEqual(TimelineEntry.objects.filter(owner=self.user, image__uploader=star).count(), 3)
+
+        # check that they are dropped again once the account is merged on read again
+        star.followerCount = TIMELINE_FANOUT_MAX_FOLLOWERS + 1
+        star.save()
+        TimelineEntry.objects.follow(fan, star)
+        self.assertFalse(TimelineEntry.objects.filter(image__uploader=star).exists())
+        response = dynamic_list(self.factory.get("/dynamic/list", HTTP_AUTHORIZATION=f"Bearer {self.jwt}"))
+        self.assertEqual(json.loads(response.content)["count"], 3)
+
+
+class SocialConcurrencyTests(TransactionTestCase):
+    # Utility functions
+    def create_likers(self, count: int):
+        uploader = User.objects.create(username="test", password="114514", email="test@sharklasers.com", mail_code="231425", salt="1919810")
+        image = AronaImage.objects.create(content_type="png", hash=blake3(b"parallel likes").hexdigest(), uploader=uploader, width=1, height=1, state="ready")
+        users = [User.objects.create(username=f"liker{i}", password="114514", email=f"liker{i}@sharklasers.com", mail_code="231425", salt="1919810")
+                 for i in range(count)]
+        return uploader, image, users
+
+
+    def run_in_threads(self, fn, users):
+        barrier = threading.Barrier(len(users))
+        def run(user):
+            try:
+                barrier.wait()
+                fn(user)
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+
+    # Test cases
+    def test_parallel_likes(self):
+        uploader, image, users = self.create_likers(16)
+        comment = Comment.objects.create(content="test", poster=uploader, belong_to_image=image)
+
+        # check that no increment is lost
+        self.run_in_threads(lambda user: (LikeImageRelation.objects.create(user=user, image=image), LikeCommentRelation.objects.create(user=user, comment=comment)), users)
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, len(users))
+        self.assertEqual(Comment.objects.get(id=comment.id).likes, len(users))
+
+        # check that no decrement is lost
+        self.run_in_threads(lambda user: LikeImageRelation.objects.filter(user=user, image=image).first().delete(), users)
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, 0)
+        self.assertEqual(Comment.objects.get(id=comment.id).likes, len(users))
+
+
+    def test_parallel_toggles(self):
+        uploader, image, users = self.create_likers(1)
+        comment = Comment.objects.create(content="test", poster=uploader, belong_to_image=image)
+
+        # check that toggles change the likes one at a time
+        self.assertEqual(LikeImageRelation.objects.toggle(users[0], image.id), 1)
+        self.assertEqual(LikeCommentRelation.objects.toggle(users[0], comment.id), 1)
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, 1)
+        self.assertEqual(LikeImageRelation.objects.toggle(users[0], image.id), -1)
+        self.assertEqual(LikeCommentRelation.objects.toggle(users[0], comment.id), -1)
+        self.assertEqual(Comment.objects.get(id=comment.id).likes, 0)
+
+        # check that racing toggles of the same user never duplicate a like nor miscount it
+        for _ in range(5):
+            self.run_in_threads(lambda user: (LikeImageRelation.objects.toggle(user, image.id), LikeCommentRelation.objects.toggle(user, comment.id)), users * 8)
+            self.assertLessEqual(LikeImageRelation.objects.filter(image=image).count(), 1)
+            self.assertEqual(AronaImage.objects.get(id=image.id).likes, LikeImageRelation.objects.filter(image=image).count())
+            self.assertLessEqual(LikeCommentRelation.objects.filter(comment=comment).count(), 1)
+            self.assertEqual(Comment.objects.get(id=comment.id).likes, LikeCommentRelation.objects.filter(comment=comment).count())
+
+
+    @override_settings(COUNTER_WRITE_BEHIND=True)
+    @patch("utils.utils_counters.start_flusher")
+    def test_write_behind_likes(self, _):
+        uploader, image, users = self.create_likers(16)
+        self.run_in_threads(lambda user: LikeImageRelation.objects.create(user=user, image=image), users)
+        relation = LikeImageRelation.objects.filter(user=users[0]).first()
+        stale = LikeImageRelation.objects.get(id=relation.id)
+        relation.delete()
+        # Deleting a like already deleted by another request leaves the counter alone
+        stale.delete()
+
+        # check that the likes are pending, and seen by readers
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, 0)
+        self.assertEqual(with_pending_counters(AronaImage.objects.filter(id=image.id))[0].likes, len(users) - 1)
+
+        # check that a flush applies the pending likes once
+        self.assertEqual(flush_counters(), len(users) + 1)
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, len(users) - 1)
+
+        # check that a flush with nothing pending opens no shard transaction
+        with self.assertNumQueries(1):
+            self.assertEqual(flush_counters(), 0)
+
+        # check that reconciling fixes a drifted counter without counting the pending likes twice
+        AronaImage.objects.filter(id=image.id).update(likes=100)
+        LikeImageRelation.objects.create(user=users[0], image=image)
+        reconcile_counters()
+        self.assertEqual(with_pending_counters(AronaImage.objects.filter(id=image.id))[0].likes, len(users))
+        flush_counters()
+        self.assertEqual(AronaImage.objects.get(id=image.id).likes, len(users))
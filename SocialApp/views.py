@@ -8,11 +8,13 @@ import requests
 from django.http import HttpRequest, HttpResponse
 from UsersApp.models import User, FollowRelation
 from ImagesApp.models import AronaImage
-from SocialApp.models import Comment, LikeCommentRelation, LikeImageRelation
+from SocialApp.models import Comment, LikeCommentRelation, LikeImageRelation, TimelineEntry
 from utils.utils_request import BAD_METHOD, request_failed, request_success, get_es_id
 from utils.utils_require import MAX_CHAR_LENGTH, CheckPath, CheckRequire, require
 from SocialApp.config import *
 from utils.utils_time import get_timestamp
+from utils.utils_cache import invalidate_tags
+from utils.utils_counters import with_pending_counters
 from django.db.models import Q
 from django.core.paginator import Paginator
 
@@ -63,6 +65,7 @@ def post_comment(req: HttpRequest):
             url = "{}/{}/_update/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
             res = requests.post(url, headers=headers, data=json.dumps(update_body)).json()
 
+        invalidate_tags([f"image:{belong_to_image.id}", f"image-comments:{belong_to_image.id}", f"user-images:{belong_to_image.uploader.username}", "image-list"])
         return request_success({"id": comment.id}, status_code=201)
 
     else:
@@ -134,7 +137,9 @@ def comment_info(req: HttpRequest, id: int):
             url = "{}/{}/_update/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
             res = requests.post(url, headers=headers, data=json.dumps(update_body)).json()
 
+        image = comment_to_delete.belong_to_image
         comment_to_delete.delete()
+        invalidate_tags([f"image:{image.id}", f"image-comments:{image.id}", f"user-images:{image.uploader.username}", "image-list"])
         return request_success(status_code=200)
 
     else:
@@ -159,29 +164,26 @@ def like_image(req: HttpRequest, id: int):
         if image is None:
             return request_failed("Image not found", status_code=404)
         
-        likes_change = 0
-        if image.is_liked_by(user):
-            likes_change = -1
-            LikeImageRelation.objects.filter(user=user, image=image).first().delete()
-        else:
-            likes_change = 1
-            LikeImageRelation.objects.create(user=user, image=image)
+        likes_change = LikeImageRelation.objects.toggle(user, image.id)
 
-        update_body = {
-            "script": {
-                "source": "ctx._source.likes += params.likes",
-                "lang": "painless",
-                "params": {
-                    "likes": likes_change
+        # A toggle losing a race with another one changes nothing
+        if likes_change != 0:
+            update_body = {
+                "script": {
+                    "source": "ctx._source.likes += params.likes",
+                    "lang": "painless",
+                    "params": {
+                        "likes": likes_change
+                    }
                 }
             }
-        }
-        es_id = get_es_id(image_id)
-        headers = {"Content-Type": "application/json"}
-        if es_id != "":
-            url = "{}/{}/_update/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
-            res = requests.post(url, headers=headers, data=json.dumps(update_body)).json()
+            es_id = get_es_id(image_id)
+            headers = {"Content-Type": "application/json"}
+            if es_id != "":
+                url = "{}/{}/_update/{}".format(settings.ES_HOST, settings.ES_DB_NAME, es_id)
+                res = requests.post(url, headers=headers, data=json.dumps(update_body)).json()
 
+        invalidate_tags([f"image:{image.id}", f"user-images:{image.uploader.username}", "image-list"])
         return request_success(status_code=200)
 
     else:
@@ -206,16 +208,32 @@ def like_comment(req: HttpRequest, id: int):
         if comment is None:
             return request_failed("Comment not found", status_code=404)
 
-        if comment.is_liked_by(user):
-            LikeCommentRelation.objects.filter(user=user, comment=comment).first().delete()
-        else:
-            LikeCommentRelation.objects.create(user=user, comment=comment)
+        LikeCommentRelation.objects.toggle(user, comment.id)
+        invalidate_tags([f"image-comments:{comment.belong_to_image_id}"])
         return request_success(status_code=200)
     
     else:
         return BAD_METHOD
 
 
+def timeline_sources(user: User):
+    """Get what the timeline of a user is read from, holding only the images ready to be served.
+
+    Returns:
+        the timeline entries of the user, and the images of the followed users with too many
+        followers to be fanned out, which are merged into the timeline on read.
+    """
+    followings = User.objects.filter(username__in=FollowRelation.objects.filter(follower=user.username).values("following"))
+    merged_images = AronaImage.objects.filter(uploader__in=followings.filter(followerCount__gt=TIMELINE_FANOUT_MAX_FOLLOWERS), state="ready")
+    return TimelineEntry.objects.filter(owner=user, image__state="ready"), merged_images
+
+
+def timeline_images(user: User):
+    """Get the images of the timeline of a user as a single queryset, holding each image once."""
+    entries, merged_images = timeline_sources(user)
+    return AronaImage.objects.filter(Q(id__in=entries.values("image_id")) | Q(id__in=merged_images.values("id")))
+
+
 @CheckRequire
 def dynamic_list(req: HttpRequest):
     if req.method == "GET":
@@ -228,26 +246,43 @@ def dynamic_list(req: HttpRequest):
         except:
             return request_failed("Invalid digital signature", status_code=401)
         
+        cursor = req.GET.get("cursor", None)
+        if cursor is not None:
+            try:
+                last_time, last_id = cursor.rsplit("_", 1)
+                last_time, last_id = float(last_time), int(last_id)
+            except ValueError:
+                return request_failed("Invalid [cursor]", status_code=400)
+        page = require(req.GET, "pageId", "int", err_msg="Missing or error type of [pageId]", strict=False)
+
         login_user.last_view_folllowing_moment = get_timestamp()
         login_user.save()
-        
-        query_param = Q()
-        query_param.connector = 'OR'
-        all_followings = FollowRelation.objects.filter(follower=login_user.username)
-        for relation in all_followings:
-            cur_user = User.objects.filter(username=relation.following).first()
-            query_param.children.append(('uploader', cur_user))
-        
-        all_images = AronaImage.objects.filter(query_param).order_by("-upload_time")
-        pageId = int(req.GET.get("pageId", 1))
-        image_pages = Paginator(all_images, FOLLOWING_IMAGE_PER_PAGE)
-        count = image_pages.count
-        result_page = image_pages.page(pageId)
-        
+
+        if cursor is None and page is not None:
+            # Numbered pages, for the clients not passing cursors yet
+            image_pages = Paginator(timeline_images(login_user).select_related("uploader").order_by("-upload_time", "-id"), FOLLOWING_IMAGE_PER_PAGE)
+            count = image_pages.count
+            result_page = list(image_pages.page(page))
+        else:
+            entries, merged_images = timeline_sources(login_user)
+            # Only the first page counts the whole timeline, the next ones keep to their own rows
+            count = timeline_images(login_user).count() if cursor is None else None
+
+            # Keyset pagination: each page starts right after the last image of the previous one
+            if cursor is not None:
+                entries = entries.filter(Q(upload_time__lt=last_time) | Q(upload_time=last_time, image_id__lt=last_id))
+                merged_images = merged_images.filter(Q(upload_time__lt=last_time) | Q(upload_time=last_time, id__lt=last_id))
+            images = {entry.image.id: entry.image for entry in entries.select_related("image__uploader").order_by("-upload_time", "-image_id")[:FOLLOWING_IMAGE_PER_PAGE]}
+            images.update({image.id: image for image in merged_images.select_related("uploader").order_by("-upload_time", "-id")[:FOLLOWING_IMAGE_PER_PAGE]})
+            result_page = sorted(images.values(), key=lambda image: (image.upload_time, image.id), reverse=True)[:FOLLOWING_IMAGE_PER_PAGE]
+        result_page = with_pending_counters(result_page)
+        next_cursor = f"{result_page[-1].upload_time}_{result_page[-1].id}" if len(result_page) == FOLLOWING_IMAGE_PER_PAGE else None
+
         return request_success(
             {
                 "count": count,
                 "perPage": FOLLOWING_IMAGE_PER_PAGE,
+                "cursor": next_cursor,
                 "result": [
                     {
                         "id": image.id,
@@ -263,6 +298,7 @@ def dynamic_list(req: HttpRequest):
                         "tags": image.tags,
                         "description": image.description,
                         "category": image.category,
+                        "thumbnailWidths": image.thumbnail_widths,
                     }
                 for image in result_page]
             },
@@ -283,20 +319,8 @@ def dynamic_unread(req: HttpRequest):
         except:
             return request_failed("Invalid digital signature", status_code=401)
         
-        all_time_list = []
-        all_followings = FollowRelation.objects.filter(follower=login_user.username)
-        for relation in all_followings:
-            cur_user = User.objects.filter(username=relation.following).first()
-            image_uploaded_by_user = AronaImage.objects.filter(uploader=cur_user)
-            for image in image_uploaded_by_user:
-                all_time_list.append(image.upload_time)
-
-        all_time_list = sorted(all_time_list, key=lambda x: x, reverse=True)
         last_view_time = login_user.last_view_folllowing_moment
-        count = 0
-        for time in all_time_list:
-            if time > last_view_time:
-                count += 1
+        count = timeline_images(login_user).filter(upload_time__gt=last_view_time).count()
 
         return request_success({"count": count}, status_code=200)
     
@@ -1,4 +1,5 @@
 USER_IMAGE_PER_PAGE = 20
 BROWSE_RECORD_PER_PAGE = 20
 FOLLOWER_PER_PAGE = 20
-FOLLOWING_PER_PAGE = 20
\ No newline at end of file
+FOLLOWING_PER_PAGE = 20
+USER_IMAGE_CACHE_TTL = 10 # seconds the anonymous lists of user images are cached
\ No newline at end of file
@@ -1,4 +1,5 @@
 from django.test import TestCase
+from django.core.cache import cache
 from UsersApp.models import User, FollowRelation
 from ImagesApp.models import AronaImage
 import random as rd
@@ -8,6 +9,7 @@ from blake3 import blake3
 class UsersTests(TestCase):
     def setUp(self):
         self.jwt = os.getenv("TEST_JWT")
+        cache.clear()
         
     def setupuser(self, username, password, email):
         if not User.objects.filter(username = username).exists():
@@ -556,7 +558,7 @@ class UsersTests(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(json_response["result"]) != 0)
         self.assertEqual(json_response["count"], 1)
-        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category"}
+        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category","thumbnailWidths"}
         self.assertEqual(expected_keys, set(json_response["result"][0].keys()))
         self.assertEqual(json_response["perPage"], 20)
 
@@ -572,7 +574,7 @@ class UsersTests(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(json_response["result"]) == 20)
         self.assertEqual(json_response["count"], 30)
-        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category"}
+        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category","thumbnailWidths"}
         self.assertEqual(expected_keys, set(json_response["result"][0].keys()))
         self.assertEqual(json_response["perPage"], 20)
 
@@ -588,6 +590,6 @@ class UsersTests(TestCase):
         self.assertEqual(res.status_code, 200)
         self.assertTrue(len(json_response["result"]) == 10)
         self.assertEqual(json_response["count"], 30)
-        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category"}
+        expected_keys = {"id","hash","contentType","uploader","uploadTime", "likes","comments","width","height","title","tags","description","category","thumbnailWidths"}
         self.assertEqual(expected_keys, set(json_response["result"][0].keys()))
         self.assertEqual(json_response["perPage"], 20)
\ No newline at end of file
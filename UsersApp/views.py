@@ -7,9 +7,12 @@ from django.conf import settings
 from UsersApp.config import *
 from UsersApp.models import User, FollowRelation
 from ImagesApp.models import AronaImage, AronaImageBrowseRecord
+from SocialApp.models import TimelineEntry
 from utils.utils_request import BAD_METHOD, request_failed, request_success, return_field
 from utils.utils_require import MAX_CHAR_LENGTH, CheckRequire, require
 from utils.utils_time import get_timestamp
+from utils.utils_cache import cache_response
+from utils.utils_counters import with_pending_counters
 from blake3 import blake3
 import jwt
 import uuid
@@ -236,9 +239,11 @@ def user_info(req: HttpRequest, username: any):
             
             all_followers = list(FollowRelation.objects.filter(following=user_name))
             all_followings = list(FollowRelation.objects.filter(follower=user_name))
+            previous_follower_count = user.followerCount
             user.followerCount = len(all_followers)
             user.followingCount = len(all_followings)
             user.save()
+            TimelineEntry.objects.follower_count_changed(user, previous_follower_count)
             detailed_information = {
                 "username": user.username,
                 "nickname": user.nickname,
@@ -412,6 +417,7 @@ def user_info(req: HttpRequest, username: any):
                 following = User.objects.filter(username=user_name).first()
                 following.followerCount += 1
                 following.save()
+                TimelineEntry.objects.follow(follower, following)
                 return request_success()
         
         elif url == "/user/" + user_name + "/unfollow":
@@ -427,6 +433,7 @@ def user_info(req: HttpRequest, username: any):
                 following = User.objects.filter(username=user_name).first()
                 following.followerCount -= 1
                 following.save()
+                TimelineEntry.objects.unfollow(follower, following)
                 return request_success()
             else:
                 return request_failed("No such relation found", 404)
@@ -439,6 +446,7 @@ def user_info(req: HttpRequest, username: any):
     
 
 @CheckRequire
+@cache_response(USER_IMAGE_CACHE_TTL, lambda req, username: [f"user-images:{username}"])
 def user_image_info(req: HttpRequest, username: any):
     user_name = require({"username": username}, "username", "string", err_msg="Bad param [username]")
     
@@ -470,12 +478,12 @@ def user_image_info(req: HttpRequest, username: any):
             return request_failed("user not found", 404)
 
         if sorted_by == "time":
-            images = AronaImage.objects.filter(uploader=user).order_by('-upload_time')
+            images = AronaImage.objects.filter(uploader=user, state="ready").order_by('-upload_time')
 
         # Pagination
         image_pages = Paginator(images, USER_IMAGE_PER_PAGE)
         image_cnt = image_pages.count
-        result_page = image_pages.page(page)
+        result_page = with_pending_counters(image_pages.page(page))
 
         return request_success(
             {
@@ -496,6 +504,7 @@ def user_image_info(req: HttpRequest, username: any):
                         "tags": image.tags,
                         "description": image.description,
                         "category": image.category,
+                        "thumbnailWidths": image.thumbnail_widths,
                     }
                 for image in result_page],
             },
@@ -539,7 +548,7 @@ def records(req: HttpRequest):
         # Pagination
         record_pages = Paginator(reocrds, BROWSE_RECORD_PER_PAGE)
         record_cnt = record_pages.count
-        result_page = record_pages.page(page)
+        result_page = with_pending_counters(record_pages.page(page))
 
         return request_success(
             {
@@ -6,7 +6,8 @@ uwsgi --module=BackendProject.wsgi:application \
     --env DJANGO_SETTINGS_MODULE=BackendProject.settings \
     --master \
     --http=0.0.0.0:80 \
-    --processes=5 \
+    --processes=${WEB_PROCESSES:-5} \
     --harakiri=20 \
     --max-requests=5000 \
+    --enable-threads \
     --vacuum
\ No newline at end of file
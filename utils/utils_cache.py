@@ -0,0 +1,324 @@
+import os
+import re
+import time
+import uuid
+import fcntl
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+from blake3 import blake3
+from django.core.cache import cache
+from django.http import HttpRequest, HttpResponse
+
+
+class DiskCache:
+    """A bounded, content-addressed cache of object bytes on the local disk.
+
+    Entries are keyed by the blake3 hash of the object and a variant name (e.g. `raw` or `rough`),
+    and are stored as plain files under `root`. The cache is shared by every worker process on the
+    node: entries are published with an atomic rename, and eviction is serialized with a lock file.
+    The total size of the entries is kept in a file shared by the workers, so the cache is only
+    scanned once a fill takes it over `max_bytes`. The modification time of an entry is refreshed on
+    every hit, so eviction drops the least recently used entries first. Concurrent misses on the
+    same entry are coalesced into a single fill: across threads by a `SingleFlight`, and across
+    worker processes by a lock file next to the entry.
+
+    Attributes:
+        root: the directory holding the cached files.
+        max_bytes: the total size of the cache, in bytes, above which entries are evicted.
+    """
+    HASH_PATTERN = re.compile(r"[0-9a-f]+")
+    LOW_WATERMARK = 0.9
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.lock_path = os.path.join(root, ".lock")
+        self.size_path = os.path.join(root, ".size")
+        self.fills = SingleFlight()
+
+    def path(self, blake3_hash: str, variant: str):
+        if self.HASH_PATTERN.fullmatch(blake3_hash) is None:
+            raise ValueError("Invalid hash")
+        return os.path.join(self.root, variant, blake3_hash[:2], blake3_hash)
+
+    def get(self, blake3_hash: str, variant: str):
+        """Look up an entry and mark it as recently used.
+
+        Returns:
+            the path of the cached file, or None on a miss.
+        """
+        path = self.path(blake3_hash, variant)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def fill(self, blake3_hash: str, variant: str, fetch_fn):
+        """Fill an entry on a miss.
+
+        Args:
+            fetch_fn: a callable that writes the object to the path it is given.
+
+        Returns:
+            the path of the cached file.
+        """
+        path = self.path(blake3_hash, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4()}.part"
+        try:
+            fetch_fn(part_path)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+        total = self.add_size(os.path.getsize(path))
+        if total is None or total > self.max_bytes:
+            self.evict()
+        return path
+
+    def fill_once(self, blake3_hash: str, variant: str, fetch_fn):
+        """Fill an entry, unless another worker process fills it first.
+
+        A worker missing an entry that another worker is filling waits for that fill and takes
+        its result, instead of fetching the object again.
+
+        Returns:
+            the path of the cached file.
+        """
+        path = self.path(blake3_hash, variant)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(f"{path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            return self.get(blake3_hash, variant) or self.fill(blake3_hash, variant, fetch_fn)
+
+    def open(self, blake3_hash: str, variant: str, fetch_fn):
+        """Open an entry for reading, filling it through `fetch_fn` on a miss.
+
+        An opened file stays readable even if another worker evicts it afterwards.
+        """
+        while True:
+            path = self.get(blake3_hash, variant)
+            if path is None:
+                # Another thread may have filled the entry by the time this one leads the fill
+                path = self.fills.do((blake3_hash, variant), lambda: self.fill_once(blake3_hash, variant, fetch_fn))
+            try:
+                return open(path, "rb")
+            except FileNotFoundError:
+                continue # evicted between fill and open, fetch it again
+
+    def delete(self, blake3_hash: str, variant: str):
+        path = self.path(blake3_hash, variant)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        else:
+            self.add_size(-size)
+        try:
+            os.remove(f"{path}.lock")
+        except FileNotFoundError:
+            pass
+
+    def delete_all(self, blake3_hash: str):
+        """Delete every variant of an entry."""
+        try:
+            variants = os.listdir(self.root)
+        except FileNotFoundError:
+            return
+        for variant in variants:
+            if os.path.isdir(os.path.join(self.root, variant)):
+                self.delete(blake3_hash, variant)
+
+    def add_size(self, delta: int):
+        """Add `delta` bytes to the total size of the entries.
+
+        Returns:
+            the new total, or None if the total is not known yet and the cache has to be scanned.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.size_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            data = f.read()
+            if not data:
+                return None
+            total = max(int(data) + delta, 0)
+            f.truncate(0)
+            f.write(str(total))
+        return total
+
+    def set_size(self, total: int):
+        with open(self.size_path, "a+") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.truncate(0)
+            f.write(str(total))
+
+    def evict(self):
+        """Drop the least recently used entries until the cache is below its low watermark.
+
+        The total size is recomputed by the scan, which also corrects its drift, e.g. from the
+        fills racing with the scan. Only one worker evicts at a time; the others skip eviction
+        instead of waiting.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.lock_path, "a") as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return
+
+            entries, total = [], 0
+            for dirpath, _, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if filename.startswith(".") or filename.endswith((".part", ".lock")):
+                        continue
+                    path = os.path.join(dirpath, filename)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+                    total += stat.st_size
+
+            if total > self.max_bytes:
+                entries.sort()
+                for _, size, path in entries:
+                    if total <= self.max_bytes * self.LOW_WATERMARK:
+                        break
+                    # A fill racing with the removal of its lock file only fetches the object twice
+                    for evicted_path in [path, f"{path}.lock"]:
+                        try:
+                            os.remove(evicted_path)
+                        except FileNotFoundError:
+                            pass
+                    total -= size
+            self.set_size(total)
+
+
+class SingleFlight:
+    """Coalesce concurrent calls sharing a key within a process.
+
+    The first caller of a key runs the call, and the callers arriving while it runs wait for its
+    result, or its error, instead of running the call again.
+    """
+    def __init__(self):
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+        if not leader:
+            return call.result()
+
+        try:
+            result = fn()
+        except BaseException as err:
+            call.set_exception(err)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class ExpiringMemo:
+    """A process-local, thread-safe memo whose entries expire after a given time.
+
+    At most `max_entries` entries are kept; the least recently used ones are dropped first.
+    """
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expire_at = entry
+            if expire_at <= time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl: float):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def get_or_set(self, key, compute_fn, ttl: float):
+        value = self.get(key)
+        if value is None:
+            value = compute_fn()
+            self.set(key, value, ttl)
+        return value
+
+
+def tag_versions(tags: list):
+    """Get the current version of each cache tag, starting a new version for the unknown ones."""
+    keys = [f"tag:{tag}" for tag in tags]
+    versions = cache.get_many(keys)
+    for key in keys:
+        if key not in versions:
+            # A random version never matches the entries cached before the tag was evicted
+            cache.add(key, uuid.uuid4().hex, None)
+            versions[key] = cache.get(key)
+    return [versions[key] for key in keys]
+
+
+def invalidate_tags(tags: list):
+    """Invalidate every cached response tagged with any of `tags`."""
+    cache.set_many({f"tag:{tag}": uuid.uuid4().hex for tag in tags}, None)
+
+
+def cache_response(ttl: int, tags_fn):
+    """Cache the successful responses of a JSON view to anonymous GET requests.
+
+    Responses are keyed by the view, the full path of the request, and the versions of their tags,
+    so invalidating any tag of a response through `invalidate_tags` drops it. Requests with an
+    `Authorization` header are never cached, as their responses depend on the user.
+
+    Args:
+        ttl: the number of seconds a response is cached.
+        tags_fn: a callable taking the arguments of the view and returning the tags of its response,
+            or None if the response should not be cached.
+    """
+    def decorator(view_fn):
+        @wraps(view_fn)
+        def decorated(req: HttpRequest, *args, **kwargs):
+            if req.method != "GET" or "authorization" in req.headers:
+                return view_fn(req, *args, **kwargs)
+            tags = tags_fn(req, *args, **kwargs)
+            if tags is None:
+                return view_fn(req, *args, **kwargs)
+
+            name = f"{view_fn.__module__}.{view_fn.__name__}:{req.get_full_path()}:{':'.join(tag_versions(tags))}"
+            key = f"response:{blake3(name.encode()).hexdigest()}"
+            cached = cache.get(key)
+            if cached is not None:
+                return HttpResponse(cached, content_type="application/json")
+
+            response = view_fn(req, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, response.content, ttl)
+            return response
+        return decorated
+    return decorator
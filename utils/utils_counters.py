@@ -0,0 +1,171 @@
+import time
+import logging
+import threading
+from collections import defaultdict
+from django.conf import settings
+from django.db import connection, transaction, close_old_connections
+from django.db.models import Case, Count, F, IntegerField, OuterRef, Subquery, Sum, Value, When
+from django.db.models.functions import Coalesce
+
+# The counters of `AronaImage` maintained through `add_counter`
+COUNTER_FIELDS = ["likes", "comments", "views"]
+# The first key of the advisory locks of the shards
+COUNTER_LOCK_CLASS = 0x636e74
+
+logger = logging.getLogger(__name__)
+flusher = None
+flusher_lock = threading.Lock()
+
+
+def add_counter(image_id: int, field: str, delta: int):
+    """Add `delta` to a counter of an image.
+
+    With `settings.COUNTER_WRITE_BEHIND`, the delta is only appended to the pending deltas, which
+    never waits for the lock of the image row however hot the image is. It is committed along with
+    the transaction of the caller, e.g. the like it counts, and applied to the row by a later flush.
+    Otherwise the row is updated right away.
+    """
+    from ImagesApp.models import AronaImage, ImageCounterDelta
+
+    if field not in COUNTER_FIELDS:
+        raise ValueError(f"Unknown counter `{field}`")
+    if not settings.COUNTER_WRITE_BEHIND:
+        AronaImage.objects.filter(id=image_id).update(**{field: F(field) + delta})
+        return
+
+    ImageCounterDelta.objects.create(image_id=image_id, field=field, delta=delta, shard=image_id % settings.COUNTER_SHARDS)
+    start_flusher()
+
+
+def with_pending_counters(images):
+    """Add the pending deltas to the counters of images, as read from the database.
+
+    Returns:
+        the list of the images.
+    """
+    from ImagesApp.models import ImageCounterDelta
+
+    images = list(images)
+    if not settings.COUNTER_WRITE_BEHIND or not images:
+        return images
+
+    pending = ImageCounterDelta.objects.filter(image__in=[image.id for image in images]).values("image_id", "field").annotate(total=Sum("delta"))
+    totals = {(row["image_id"], row["field"]): row["total"] for row in pending}
+    for image in images:
+        for field in COUNTER_FIELDS:
+            setattr(image, field, getattr(image, field) + totals.get((image.id, field), 0))
+    return images
+
+
+def lock_shard(shard: int, wait: bool=False):
+    """Lock a shard of the pending deltas until the end of the current transaction.
+
+    Returns:
+        whether the shard is locked, always True when waiting for it.
+    """
+    with connection.cursor() as cursor:
+        if wait:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)", [COUNTER_LOCK_CLASS, shard])
+            return True
+        cursor.execute("SELECT pg_try_advisory_xact_lock(%s, %s)", [COUNTER_LOCK_CLASS, shard])
+        return cursor.fetchone()[0]
+
+
+def flush_shard(shard: int, batch_size: int):
+    """Apply a batch of the pending deltas of a locked shard to the image rows, and drop them.
+
+    Returns:
+        the number of applied deltas.
+    """
+    from ImagesApp.models import AronaImage, ImageCounterDelta
+
+    deltas = list(ImageCounterDelta.objects.filter(shard=shard).order_by("id").values_list("id", "image_id", "field", "delta")[:batch_size])
+    totals = defaultdict(int)
+    for _, image_id, field, delta in deltas:
+        totals[(image_id, field)] += delta
+
+    # One UPDATE per counter for the whole batch
+    for field in COUNTER_FIELDS:
+        changes = {image_id: total for (image_id, f), total in totals.items() if f == field and total != 0}
+        if changes:
+            AronaImage.objects.filter(id__in=changes.keys()).update(**{field: Case(
+                *[When(id=image_id, then=F(field) + total) for image_id, total in changes.items()],
+                default=F(field),
+                output_field=IntegerField(),
+            )})
+    ImageCounterDelta.objects.filter(id__in=[delta_id for delta_id, _, _, _ in deltas]).delete()
+    return len(deltas)
+
+
+def flush_counters(batch_size: int=None):
+    """Apply the pending deltas to the image rows, one shard at a time.
+
+    The deltas of a shard are applied and dropped in a single transaction, so a flush interrupted
+    by a crash leaves them pending for the next one, and never applies them twice. Shards held by
+    another flush are skipped. Each shard holds its own images, so concurrent flushes never wait
+    for each other's rows. Only the shards holding pending deltas are visited, so a flush with
+    nothing to apply takes a single query.
+
+    Returns:
+        the number of applied deltas.
+    """
+    from ImagesApp.models import ImageCounterDelta
+
+    batch_size = settings.COUNTER_FLUSH_BATCH if batch_size is None else batch_size
+    flushed = 0
+    shards = ImageCounterDelta.objects.order_by("shard").values_list("shard", flat=True).distinct()
+    for shard in list(shards):
+        with transaction.atomic():
+            if lock_shard(shard):
+                flushed += flush_shard(shard, batch_size)
+    return flushed
+
+
+def flush_forever(interval: float):
+    while True:
+        time.sleep(interval)
+        close_old_connections()
+        try:
+            # Keep flushing while whole batches are left, e.g. after a burst
+            while flush_counters() >= settings.COUNTER_FLUSH_BATCH:
+                pass
+        except Exception:
+            # The deltas stay pending, retry them on the next round
+            logger.exception("Failed to flush the pending counter deltas")
+
+
+def start_flusher():
+    """Start the thread flushing the pending deltas every `settings.COUNTER_FLUSH_INTERVAL` seconds, once per process."""
+    global flusher
+    with flusher_lock:
+        if flusher is None:
+            flusher = threading.Thread(target=flush_forever, args=(settings.COUNTER_FLUSH_INTERVAL,), daemon=True)
+            flusher.start()
+
+
+def reconcile_counters():
+    """Recompute the counters of every image from its likes, comments and browse records.
+
+    The pending deltas are left pending: each counter is set so that, once they are flushed, it
+    matches the rows counted. Every shard is locked meanwhile, so no flush runs in between.
+    """
+    from ImagesApp.models import AronaImage, AronaImageBrowseRecord, ImageCounterDelta
+    from SocialApp.models import Comment, LikeImageRelation
+
+    def count_of(model, key: str):
+        rows = model.objects.filter(**{key: OuterRef("id")}).order_by().values(key).annotate(total=Count("id")).values("total")
+        return Coalesce(Subquery(rows, output_field=IntegerField()), Value(0))
+
+    def pending_of(field: str):
+        rows = ImageCounterDelta.objects.filter(image=OuterRef("id"), field=field).order_by().values("image").annotate(total=Sum("delta")).values("total")
+        return Coalesce(Subquery(rows, output_field=IntegerField()), Value(0))
+
+    with transaction.atomic():
+        for shard in range(settings.COUNTER_SHARDS):
+            lock_shard(shard, wait=True)
+        # A single statement reads the rows and the pending deltas from the same snapshot
+        return AronaImage.objects.update(
+            likes=count_of(LikeImageRelation, "image") - pending_of("likes"),
+            comments=count_of(Comment, "belong_to_image") - pending_of("comments"),
+            views=count_of(AronaImageBrowseRecord, "image") - pending_of("views"),
+        )
@@ -0,0 +1,111 @@
+import io
+import time
+import base64
+import requests
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from blake3 import blake3
+from PIL import Image
+
+
+class EnhanceError(Exception):
+    pass
+
+
+class EnhanceClient:
+    """A client of an image enhancement API, e.g. the Baidu image definition enhancement.
+
+    The API takes a base64-encoded image in the `image` form field and answers a JSON object holding
+    the enhanced image in its `image` field, or an `error_msg` on failure. Requests share a pooled
+    session, and at most `concurrency` of them are in flight per process. Failed requests are retried
+    with an exponential backoff.
+
+    Attributes:
+        url: the url of the API, with its access token.
+        concurrency: the maximal number of concurrent requests.
+        max_attempts: the number of attempts of each request before giving up.
+        backoff: the delay before the first retry, in seconds, doubled after each failed attempt.
+        timeout: the timeout of each request, in seconds.
+        dedup_entries: the number of recent distinct frames whose results are reused by `enhance_frames`.
+    """
+    def __init__(self, url: str, concurrency: int, max_attempts: int, backoff: float, timeout: float, dedup_entries: int):
+        self.url = url
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.timeout = timeout
+        self.dedup_entries = dedup_entries
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="enhance")
+
+    def enhance(self, image_bytes: bytes):
+        """Enhance an encoded image.
+
+        Returns:
+            the enhanced image, encoded.
+
+        Raises:
+            EnhanceError: if every attempt failed.
+        """
+        data = {"image": base64.b64encode(image_bytes)}
+        error = None
+        for attempt in range(self.max_attempts):
+            if attempt > 0:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            try:
+                response = self.session.post(self.url, data=data, timeout=self.timeout)
+                result = response.json()
+            except (requests.RequestException, ValueError) as err:
+                error = repr(err)
+                continue
+            if "image" in result:
+                return base64.b64decode(result["image"])
+            error = result.get("error_msg", f"HTTP {response.status_code}")
+        raise EnhanceError(f"Image enhancement failed after {self.max_attempts} attempts: {error}")
+
+    def enhance_frame(self, frame: Image.Image):
+        buffer = io.BytesIO()
+        frame.save(buffer, format="PNG")
+        return self.enhance(buffer.getvalue())
+
+    def enhance_frames(self, timed_frames):
+        """Enhance a stream of frames concurrently.
+
+        Identical frames, e.g. the repeated frames of a looping GIF, are only sent once as long as
+        they are among the `dedup_entries` most recent distinct frames.
+
+        Args:
+            timed_frames: an iterable of frames and their durations, e.g. from `iter_frames`.
+
+        Yields:
+            each enhanced frame and its duration, in the order of the frames.
+        """
+        pending = deque()
+        recent = OrderedDict() # frame hash -> future of its enhanced image
+        try:
+            for frame, duration in timed_frames:
+                frame_hash = blake3(f"{frame.mode}:{frame.size}:".encode() + frame.tobytes()).hexdigest()
+                future = recent.get(frame_hash)
+                if future is None:
+                    future = self.executor.submit(self.enhance_frame, frame)
+                    recent[frame_hash] = future
+                    if len(recent) > self.dedup_entries:
+                        recent.popitem(last=False)
+                else:
+                    recent.move_to_end(frame_hash)
+                pending.append((future, duration))
+
+                if len(pending) >= 2 * self.concurrency:
+                    future, duration = pending.popleft()
+                    yield Image.open(io.BytesIO(future.result())), duration
+            while pending:
+                future, duration = pending.popleft()
+                yield Image.open(io.BytesIO(future.result())), duration
+        finally:
+            for future, _ in pending:
+                future.cancel()
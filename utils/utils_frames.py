@@ -0,0 +1,303 @@
+import io
+import os
+import sys
+import struct
+import threading
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from itertools import islice
+from django.conf import settings
+from PIL import Image, ImageSequence, ImageDraw, ImageFont
+
+frame_pool = None
+frame_pool_lock = threading.Lock()
+
+
+def get_frame_pool():
+    """Get the process pool shared by all frame processing of the current process."""
+    global frame_pool
+    with frame_pool_lock:
+        if frame_pool is None:
+            context = multiprocessing.get_context("forkserver")
+            # Under uWSGI, sys.executable is the uwsgi binary rather than a Python interpreter
+            if not os.path.basename(sys.executable).startswith("python"):
+                context.set_executable(os.path.join(sys.exec_prefix, "bin", "python3"))
+            frame_pool = ProcessPoolExecutor(max_workers=settings.FRAME_POOL_WORKERS, mp_context=context)
+    return frame_pool
+
+
+def pack_frame(frame: Image.Image):
+    return frame.mode, frame.size, frame.tobytes()
+
+
+def unpack_frame(packed_frame: tuple):
+    mode, size, data = packed_frame
+    return Image.frombytes(mode, size, data)
+
+
+def iter_frames(image):
+    """Decode the frames of an image one by one.
+
+    GIF frames are composited onto the previous ones while decoding, so decoding stays sequential.
+
+    Args:
+        image: the filename or the file object of the image.
+
+    Yields:
+        each frame as an RGB or RGBA image, and its duration in milliseconds.
+    """
+    with Image.open(image) as im:
+        default_duration = im.info.get("duration", 0)
+        for frame in ImageSequence.Iterator(im):
+            has_alpha = frame.mode in ["RGBA", "LA", "PA"] or "transparency" in frame.info
+            yield frame.convert("RGBA" if has_alpha else "RGB"), frame.info.get("duration", default_duration)
+
+
+def map_frames(process_fn, frames, *args):
+    """Process a stream of frames in batches over the shared process pool.
+
+    At most two batches per pool worker are in flight at any time, so frames are streamed through
+    the pool instead of being materialized all at once.
+
+    Args:
+        process_fn: a module-level function taking a list of packed frames and `args`, and returning
+            a list holding one result per frame.
+        frames: an iterable of frames.
+
+    Yields:
+        the result of each frame, in the order of the frames.
+    """
+    global frame_pool
+    pool = get_frame_pool()
+    pending = deque()
+    frames = iter(frames)
+    try:
+        while True:
+            batch = [pack_frame(frame) for frame in islice(frames, settings.FRAME_BATCH_SIZE)]
+            if not batch:
+                break
+            pending.append(pool.submit(process_fn, batch, *args))
+            if len(pending) >= 2 * settings.FRAME_POOL_WORKERS:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+    except BrokenProcessPool:
+        # A worker died, start a new pool for the next caller
+        with frame_pool_lock:
+            if frame_pool is pool:
+                frame_pool = None
+        raise
+
+
+def write_animation(f, writer_class, timed_frames, process_fn, *args):
+    """Encode a stream of frames into an animated image, frame by frame.
+
+    Frames go through `map_frames` and are written as soon as they come back, so only the frames
+    in flight are held in memory, whatever the length of the animation.
+
+    Args:
+        f: the file to write to.
+        writer_class: `WebPAnimWriter` or `GifWriter`.
+        timed_frames: an iterable of frames and their durations, e.g. from `iter_frames`.
+        process_fn: the frame processing function, encoding the frames for `writer_class`.
+    """
+    timed_frames = iter(timed_frames)
+    first_frame, first_duration = next(timed_frames)
+    durations = deque([first_duration])
+
+    def frames():
+        yield first_frame
+        for frame, duration in timed_frames:
+            durations.append(duration)
+            yield frame
+
+    writer = writer_class(f, *first_frame.size)
+    for frame in map_frames(process_fn, frames(), *args):
+        writer.add(frame, durations.popleft())
+    writer.close()
+
+
+def write_animations(fs: list, writer_class, sizes: list, timed_frames, process_fn, *args):
+    """Encode a stream of frames into several animated images of different sizes, in a single pass.
+
+    Like `write_animation`, but each frame is decoded once and `process_fn` returns one result per
+    size for it, each written to the file of that size.
+
+    Args:
+        fs: the files to write to, one per size.
+        writer_class: `WebPAnimWriter` or `GifWriter`.
+        sizes: the size of each file.
+        timed_frames: an iterable of frames and their durations, e.g. from `iter_frames`.
+        process_fn: the frame processing function, taking `sizes` before `args`.
+    """
+    durations = deque()
+
+    def frames():
+        for frame, duration in timed_frames:
+            durations.append(duration)
+            yield frame
+
+    writers = [writer_class(f, *size) for f, size in zip(fs, sizes)]
+    for results in map_frames(process_fn, frames(), sizes, *args):
+        duration = durations.popleft()
+        for writer, result in zip(writers, results):
+            writer.add(result, duration)
+    for writer in writers:
+        writer.close()
+
+
+# Frame processing functions, run in the pool workers
+
+def encode_webp_frames(packed_frames: list, quality: int):
+    """Encode each frame as the bitstream of a lossy WebP frame.
+
+    Returns:
+        for each frame, its `ALPH`/`VP8 ` chunks, and whether it has an alpha channel.
+    """
+    results = []
+    for packed_frame in packed_frames:
+        buffer = io.BytesIO()
+        unpack_frame(packed_frame).save(buffer, format="WEBP", quality=quality)
+        results.append(webp_frame_chunks(buffer.getvalue()))
+    return results
+
+
+def resize_webp_frames(packed_frames: list, sizes: list, quality: int):
+    """Shrink each frame to each of the sizes, and encode every copy like `encode_webp_frames`.
+
+    Returns:
+        for each frame, the encoded copy of each size.
+    """
+    results = []
+    for packed_frame in packed_frames:
+        frame = unpack_frame(packed_frame)
+        copies = []
+        for size in sizes:
+            buffer = io.BytesIO()
+            frame.resize(size, Image.LANCZOS).save(buffer, format="WEBP", quality=quality)
+            copies.append(webp_frame_chunks(buffer.getvalue()))
+        results.append(copies)
+    return results
+
+
+@lru_cache(maxsize=16)
+def load_font(font_name: str, font_size: int):
+    return ImageFont.truetype(font_name, font_size)
+
+
+def draw_text_frames(packed_frames: list, text: str, xy: tuple, font_name: str, font_size: int):
+    """Draw a text on each frame.
+
+    Returns:
+        each frame as a packed RGB frame.
+    """
+    font = load_font(font_name, font_size)
+    results = []
+    for packed_frame in packed_frames:
+        frame = unpack_frame(packed_frame).convert("RGB")
+        ImageDraw.Draw(frame).text(xy=xy, text=text, fill="white", font=font)
+        results.append(pack_frame(frame))
+    return results
+
+
+def encode_gif_frames(packed_frames: list):
+    """Quantize each frame and encode it as a GIF image block with its own color table."""
+    results = []
+    for packed_frame in packed_frames:
+        buffer = io.BytesIO()
+        unpack_frame(packed_frame).convert("RGB").convert("P", palette=Image.ADAPTIVE).save(buffer, format="GIF")
+        results.append(gif_frame_block(buffer.getvalue()))
+    return results
+
+
+def draw_text_gif_frames(packed_frames: list, text: str, xy: tuple, font_name: str, font_size: int):
+    return encode_gif_frames(draw_text_frames(packed_frames, text, xy, font_name, font_size))
+
+
+def gif_frame_block(gif_data: bytes):
+    """Extract the image block of a single-frame GIF file, moving its global color table into it."""
+    flags = gif_data[10]
+    pos = 13 # skip the header and the logical screen descriptor
+    color_table = b""
+    if flags & 0x80:
+        color_table = gif_data[pos:pos + (3 << ((flags & 0x07) + 1))]
+        pos += len(color_table)
+    while gif_data[pos] == 0x21: # skip the extensions
+        pos += 2
+        while gif_data[pos]:
+            pos += gif_data[pos] + 1
+        pos += 1
+
+    descriptor = bytearray(gif_data[pos:pos + 10])
+    if not descriptor[9] & 0x80:
+        descriptor[9] |= 0x80 | (flags & 0x07)
+    return bytes(descriptor) + color_table + gif_data[pos + 10:-1] # up to the trailer
+
+
+def webp_frame_chunks(webp_data: bytes):
+    """Extract the image chunks of a still WebP file, to be embedded into an animation frame."""
+    chunks, has_alpha = [], False
+    pos = 12 # skip the RIFF header
+    while pos + 8 <= len(webp_data):
+        fourcc, size = struct.unpack("<4sI", webp_data[pos:pos + 8])
+        end = pos + 8 + size + (size & 1)
+        if fourcc in [b"ALPH", b"VP8 ", b"VP8L"]:
+            chunks.append(webp_data[pos:end])
+            has_alpha = has_alpha or fourcc != b"VP8 "
+        pos = end
+    return b"".join(chunks), has_alpha
+
+
+class WebPAnimWriter:
+    """A writer of animated WebP files, taking frames already encoded by `encode_webp_frames`.
+
+    Frames are written to the file as they are added, each one covering the whole canvas.
+    """
+    def __init__(self, f, width: int, height: int, loop: int=0):
+        self.f = f
+        self.width, self.height = width, height
+        self.has_alpha = False
+        self.f.write(b"RIFF\0\0\0\0WEBP")
+        self.f.write(b"VP8X" + struct.pack("<I", 10) + b"\0\0\0\0" + self.pack_int24(width - 1) + self.pack_int24(height - 1))
+        self.f.write(b"ANIM" + struct.pack("<I", 6) + b"\0\0\0\0" + struct.pack("<H", loop))
+
+    @staticmethod
+    def pack_int24(value: int):
+        return struct.pack("<I", value)[:3]
+
+    def add(self, frame: tuple, duration: int):
+        frame_chunks, has_alpha = frame
+        self.has_alpha = self.has_alpha or has_alpha
+        header = self.pack_int24(0) + self.pack_int24(0) + self.pack_int24(self.width - 1) + self.pack_int24(self.height - 1) \
+            + self.pack_int24(min(int(duration), 0xFFFFFF)) + b"\x02" # replace the canvas without blending
+        self.f.write(b"ANMF" + struct.pack("<I", len(header) + len(frame_chunks)) + header + frame_chunks)
+
+    def close(self):
+        end = self.f.tell()
+        self.f.seek(4)
+        self.f.write(struct.pack("<I", end - 8))
+        self.f.seek(20)
+        self.f.write(bytes([0x02 | (0x10 if self.has_alpha else 0)])) # animation and alpha flags
+        self.f.seek(end)
+
+
+class GifWriter:
+    """A writer of animated GIF files, taking frames already encoded by `encode_gif_frames`.
+
+    Frames are written to the file as they are added, each one covering the whole canvas.
+    """
+    def __init__(self, f, width: int, height: int, loop: int=0):
+        self.f = f
+        self.f.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        self.f.write(b"\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", loop) + b"\x00")
+
+    def add(self, frame_block: bytes, duration: int):
+        delay = min(round(duration / 10), 0xFFFF) # in hundredths of a second
+        self.f.write(b"\x21\xf9\x04\x04" + struct.pack("<H", delay) + b"\x00\x00") # keep the frame until the next one
+        self.f.write(frame_block)
+
+    def close(self):
+        self.f.write(b"\x3b")
@@ -0,0 +1,204 @@
+import struct
+from blake3 import blake3
+
+# Markers of the JPEG segments carrying the frame header, i.e. the dimensions of the image
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+class HeaderParser:
+    """An incremental parser of the metadata of a GIF, PNG or JPEG image.
+
+    The parser is fed with the chunks of the image as they arrive, and never holds more than one
+    header structure in memory: pixel data is skipped over without being buffered or decoded.
+
+    Attributes:
+        meta: the parsed metadata, with keys
+            format: the format of the image, in [gif, png, jpeg], or None if it is not recognized.
+            version: the version of a GIF image, e.g. "GIF89a".
+            width, height: the dimensions of the image.
+            frames: the number of frames of the image.
+            durations: the duration of each frame of an animated image, in milliseconds.
+    """
+    def __init__(self):
+        self.meta = {"format": None, "version": None, "width": None, "height": None, "frames": 1, "durations": []}
+        self.buffer = bytearray()
+        self.parser = parse_image(self.meta)
+        self.request = next(self.parser)
+
+    def feed(self, chunk: bytes):
+        pos = 0
+        while self.request is not None:
+            kind, size = self.request
+            if kind == "skip":
+                taken = min(size, len(chunk) - pos)
+                pos += taken
+                if taken < size:
+                    self.request = ("skip", size - taken)
+                    return
+                self.advance(None)
+            else:
+                taken = min(size - len(self.buffer), len(chunk) - pos)
+                self.buffer += chunk[pos:pos + taken]
+                pos += taken
+                if len(self.buffer) < size:
+                    return
+                data = bytes(self.buffer)
+                self.buffer.clear()
+                self.advance(data)
+
+    def advance(self, data):
+        try:
+            self.request = self.parser.send(data)
+        except StopIteration:
+            self.request = None
+
+
+# The parsers below are generators yielding ("read", n) to receive the next n bytes,
+# or ("skip", n) to drop the next n bytes.
+
+def parse_image(meta: dict):
+    magic = yield ("read", 2)
+    if magic == b"GI":
+        meta["format"] = "gif"
+        yield from parse_gif(meta, magic)
+    elif magic == b"\x89P":
+        meta["format"] = "png"
+        yield from parse_png(meta, magic)
+    elif magic == b"\xff\xd8":
+        meta["format"] = "jpeg"
+        yield from parse_jpeg(meta)
+
+
+def skip_gif_sub_blocks():
+    while True:
+        size = (yield ("read", 1))[0]
+        if size == 0:
+            return
+        yield ("skip", size)
+
+
+def parse_gif(meta: dict, magic: bytes):
+    header = magic + (yield ("read", 11))
+    if header[:3] != b"GIF":
+        meta["format"] = None
+        return
+    meta["version"] = header[:6].decode("ascii", "replace")
+    meta["width"], meta["height"] = struct.unpack("<HH", header[6:10])
+    meta["frames"] = 0
+    if header[10] & 0x80: # global color table
+        yield ("skip", 3 << ((header[10] & 0x07) + 1))
+
+    delay = 0
+    while True:
+        introducer = (yield ("read", 1))[0]
+        if introducer == 0x21: # extension
+            label = (yield ("read", 1))[0]
+            if label == 0xF9: # graphic control extension, carrying the delay of the next frame
+                size = (yield ("read", 1))[0]
+                block = yield ("read", size)
+                if size >= 4:
+                    delay = struct.unpack("<H", block[1:3])[0] * 10
+            yield from skip_gif_sub_blocks()
+        elif introducer == 0x2C: # image descriptor
+            descriptor = yield ("read", 9)
+            if descriptor[8] & 0x80: # local color table
+                yield ("skip", 3 << ((descriptor[8] & 0x07) + 1))
+            yield ("skip", 1) # LZW minimum code size
+            yield from skip_gif_sub_blocks()
+            meta["frames"] += 1
+            meta["durations"].append(delay)
+            delay = 0
+        else: # trailer
+            return
+
+
+def parse_png(meta: dict, magic: bytes):
+    signature = magic + (yield ("read", 6))
+    if signature != b"\x89PNG\r\n\x1a\n":
+        meta["format"] = None
+        return
+
+    while True:
+        length, chunk_type = struct.unpack(">I4s", (yield ("read", 8)))
+        if chunk_type == b"IHDR":
+            data = yield ("read", length)
+            meta["width"], meta["height"] = struct.unpack(">II", data[:8])
+            yield ("skip", 4)
+        elif chunk_type == b"acTL": # animation control of an APNG
+            data = yield ("read", length)
+            meta["frames"] = struct.unpack(">I", data[:4])[0]
+            yield ("skip", 4)
+        elif chunk_type == b"fcTL": # frame control of an APNG
+            data = yield ("read", length)
+            delay_num, delay_den = struct.unpack(">HH", data[20:24])
+            meta["durations"].append(delay_num * 1000 // (delay_den or 100))
+            yield ("skip", 4)
+        elif chunk_type == b"IEND":
+            return
+        else:
+            yield ("skip", length + 4)
+
+
+def parse_jpeg(meta: dict):
+    while True:
+        marker = yield ("read", 2)
+        if marker[0] != 0xFF:
+            return
+        code = marker[1]
+        while code == 0xFF: # fill bytes
+            code = (yield ("read", 1))[0]
+        if code == 0x01 or 0xD0 <= code <= 0xD8: # markers without a segment
+            continue
+        if code in [0xD9, 0xDA]: # end of image or start of scan, no frame header ahead
+            return
+
+        length = struct.unpack(">H", (yield ("read", 2)))[0]
+        if code in JPEG_SOF_MARKERS:
+            data = yield ("read", length - 2)
+            meta["height"], meta["width"] = struct.unpack(">HH", data[1:5])
+            return
+        yield ("skip", length - 2)
+
+
+def ingest_upload(upload, dest_name: str):
+    """Stream an uploaded image to `dest_name` in a single pass.
+
+    The blake3 hash and the metadata of the image are computed from the same chunks as they are
+    written, so the upload is read exactly once and never decoded.
+
+    Args:
+        upload: the uploaded file.
+        dest_name: the path to spool the image to.
+
+    Returns:
+        the metadata of the image as parsed by `HeaderParser`, along with its `hash` and `size`.
+    """
+    hasher = blake3()
+    parser = HeaderParser()
+    size = 0
+    with open(dest_name, "wb") as f:
+        for chunk in upload.chunks():
+            f.write(chunk)
+            hasher.update(chunk)
+            parser.feed(chunk)
+            size += len(chunk)
+
+    return {**parser.meta, "hash": hasher.hexdigest(), "size": size}
+
+
+def inspect_file(file_name: str, chunk_size: int=1024 * 1024):
+    """Hash an image file on the disk and parse its metadata in a single pass.
+
+    Returns:
+        the metadata of the image as parsed by `HeaderParser`, along with its `hash` and `size`.
+    """
+    hasher = blake3()
+    parser = HeaderParser()
+    size = 0
+    with open(file_name, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            hasher.update(chunk)
+            parser.feed(chunk)
+            size += len(chunk)
+
+    return {**parser.meta, "hash": hasher.hexdigest(), "size": size}
@@ -0,0 +1,175 @@
+import os
+import time
+import fcntl
+import threading
+import traceback
+from contextlib import contextmanager
+from django.conf import settings
+from django.db import transaction, close_old_connections
+from utils.utils_time import get_timestamp
+
+# Registered job handlers, by the kind of job they run
+handlers = {}
+
+local_wakeup = threading.Event()
+local_workers = []
+local_workers_lock = threading.Lock()
+
+
+class JobDeferred(Exception):
+    """Raised by a job handler to run the job again later, without using up an attempt.
+
+    Attributes:
+        delay: the time to wait before running the job again, in seconds.
+    """
+    def __init__(self, delay: float):
+        super().__init__(f"Deferred for {delay} seconds")
+        self.delay = delay
+
+
+def job_handler(kind: str, on_failure=None):
+    """A decorator registering a function as the handler of a kind of background jobs.
+
+    The handler is called with the `ImageJob` to run. A handler raising an exception is retried with
+    an exponential backoff, and `on_failure` is called with the job once it runs out of attempts.
+    Handlers may be run more than once for the same job, so they must be idempotent.
+    """
+    def decorator(handle_fn):
+        handlers[kind] = (handle_fn, on_failure)
+        return handle_fn
+    return decorator
+
+
+def enqueue(kind: str, payload: dict, max_attempts: int=None):
+    """Queue a background job.
+
+    Depending on `settings.JOB_BROKER`, the job is run by the worker threads of the current process
+    (`local`), by `python manage.py run_jobs` workers only (`db`), or right away (`eager`).
+
+    Returns:
+        the queued `ImageJob`.
+    """
+    from ImagesApp.models import ImageJob
+
+    job = ImageJob.objects.create(
+        kind=kind,
+        payload=payload,
+        max_attempts=settings.JOB_MAX_ATTEMPTS if max_attempts is None else max_attempts
+    )
+
+    if settings.JOB_BROKER == "eager":
+        # Deferrals do not use up attempts, so the runs are bounded on their own; a job still deferred is left queued
+        for _ in range(job.max_attempts):
+            if job.state != "queued":
+                break
+            job.attempts += 1
+            run_job(job)
+    elif settings.JOB_BROKER == "local":
+        start_local_workers()
+        transaction.on_commit(local_wakeup.set)
+    return job
+
+
+def claim_job(kinds: list=None):
+    """Claim the next runnable job, for this worker only.
+
+    A claimed job holds a lease of `settings.JOB_LEASE` seconds. If its worker dies before finishing
+    it, the job becomes runnable again once the lease expires.
+
+    Returns:
+        the claimed `ImageJob`, or None if there is nothing to run.
+    """
+    from ImagesApp.models import ImageJob
+
+    with transaction.atomic():
+        now = get_timestamp()
+        jobs = ImageJob.objects.select_for_update(skip_locked=True).filter(state__in=["queued", "running"], run_after__lte=now)
+        if kinds is not None:
+            jobs = jobs.filter(kind__in=kinds)
+        job = jobs.order_by("id").first()
+        if job is None:
+            return None
+
+        job.state = "running"
+        job.attempts += 1
+        job.run_after = now + settings.JOB_LEASE
+        job.save(update_fields=["state", "attempts", "run_after"])
+    return job
+
+
+def run_job(job):
+    """Run a claimed job and record its outcome."""
+    handle_fn, on_failure = handlers[job.kind]
+    try:
+        handle_fn(job)
+    except JobDeferred as deferred:
+        job.state = "queued"
+        job.attempts -= 1
+        job.run_after = get_timestamp() + deferred.delay
+    except Exception:
+        job.error = traceback.format_exc()
+        if job.attempts >= job.max_attempts:
+            job.state = "failed"
+            job.finish_time = get_timestamp()
+            if on_failure is not None:
+                on_failure(job)
+        else:
+            job.state = "queued"
+            job.run_after = get_timestamp() + settings.JOB_RETRY_BACKOFF * 2 ** (job.attempts - 1)
+    else:
+        job.state = "done"
+        job.finish_time = get_timestamp()
+    job.save(update_fields=["state", "attempts", "run_after", "finish_time", "error"])
+
+
+def work(kinds: list=None, poll_interval: float=None, stop_event: threading.Event=None):
+    """Claim and run jobs until `stop_event` is set."""
+    poll_interval = settings.JOB_POLL_INTERVAL if poll_interval is None else poll_interval
+    while stop_event is None or not stop_event.is_set():
+        close_old_connections()
+        job = claim_job(kinds)
+        if job is None:
+            local_wakeup.wait(poll_interval)
+            local_wakeup.clear()
+            continue
+        run_job(job)
+
+
+def start_local_workers():
+    """Start the worker threads of the current process, once."""
+    with local_workers_lock:
+        if local_workers:
+            return
+        for _ in range(settings.JOB_LOCAL_WORKERS):
+            worker = threading.Thread(target=work, daemon=True)
+            worker.start()
+            local_workers.append(worker)
+
+
+@contextmanager
+def node_slot(name: str, slots: int, wait: float):
+    """Hold one of the `slots` slots named `name`, shared by every process on the node.
+
+    Slots are lock files under `settings.JOB_LOCK_DIR`, so a slot is released even if its holder dies.
+
+    Raises:
+        JobDeferred: if no slot is released within `wait` seconds.
+    """
+    os.makedirs(settings.JOB_LOCK_DIR, exist_ok=True)
+    deadline = time.monotonic() + wait
+    while True:
+        for index in range(slots):
+            lock = open(os.path.join(settings.JOB_LOCK_DIR, f"{name}.{index}.lock"), "a")
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock.close()
+                continue
+            try:
+                yield
+            finally:
+                lock.close()
+            return
+        if time.monotonic() >= deadline:
+            raise JobDeferred(wait)
+        time.sleep(min(0.5, wait))
@@ -0,0 +1,341 @@
+import os
+import re
+import abc
+import mmap
+import uuid
+import shutil
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, wait
+from django.conf import settings
+from qcloud_cos import CosConfig, CosS3Client
+from qcloud_cos.cos_exception import CosServiceError
+
+RANGE_PATTERN = re.compile(r"bytes=(\d*)-(\d*)")
+
+storage = None
+upload_pool = None
+upload_pool_lock = threading.Lock()
+
+
+def get_storage():
+    """Get the object storage of the current process, as configured by `STORAGE_BACKEND`."""
+    global storage
+    if storage is None:
+        if settings.STORAGE_BACKEND == "local":
+            storage = LocalStorage(settings.STORAGE_LOCAL_ROOT, part_size=settings.STORAGE_PART_SIZE)
+        elif settings.STORAGE_BACKEND == "cos":
+            client = CosS3Client(CosConfig(Region=settings.COS_REGION, SecretId=settings.COS_SECRET_ID, SecretKey=settings.COS_SECRET_KEY))
+            storage = CosStorage(client, part_size=settings.STORAGE_PART_SIZE)
+        else:
+            raise ValueError("Invalid storage backend")
+    return storage
+
+
+def get_upload_pool():
+    """Get the thread pool shared by all uploads of the current process."""
+    global upload_pool
+    with upload_pool_lock:
+        if upload_pool is None:
+            upload_pool = ThreadPoolExecutor(max_workers=settings.STORAGE_UPLOAD_THREADS, thread_name_prefix="upload")
+    return upload_pool
+
+
+def wait_puts(*puts):
+    """Wait for every pending put, even after one of them has failed.
+
+    Raises:
+        the error of the first failed put, if any.
+    """
+    error = None
+    for put in puts:
+        try:
+            put.wait()
+        except Exception as err:
+            error = error or err
+    if error is not None:
+        raise error
+
+
+def parse_range(range_header: str, size: int):
+    """Resolve a single byte range against the size of an object.
+
+    Returns:
+        the first and the last byte position of the range, both inclusive, or None if the range
+        is invalid and should be ignored.
+
+    Raises:
+        ValueError: the range cannot be satisfied.
+    """
+    first, last = RANGE_PATTERN.fullmatch(range_header).groups()
+
+    if first == "":
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - length, 0), size - 1
+
+    start = int(first)
+    end = size - 1 if last == "" else min(int(last), size - 1)
+    if last != "" and int(last) < start:
+        return None
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    return start, end
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class PendingPut:
+    """An object being put by the tasks of the upload pool.
+
+    Args:
+        futures: the futures of the tasks, e.g. one per part.
+        complete_fn: a callable taking the results of the tasks and completing the put.
+        abort_fn: a callable cleaning up after a failed task or a failed completion.
+    """
+    def __init__(self, futures: list, complete_fn=None, abort_fn=None):
+        self.futures = futures
+        self.complete_fn = complete_fn
+        self.abort_fn = abort_fn
+
+    def wait(self):
+        """Wait for the put to complete, in the calling thread, so no pool thread waits on another one."""
+        wait(self.futures)
+        try:
+            results = [future.result() for future in self.futures]
+            if self.complete_fn is not None:
+                self.complete_fn(results)
+        except Exception:
+            if self.abort_fn is not None:
+                self.abort_fn()
+            raise
+
+
+class ObjectStorage(abc.ABC):
+    """The interface of an object storage holding objects by bucket and key.
+
+    Attributes:
+        part_size: the size of the parts of a multipart upload, in bytes.
+    """
+    def __init__(self, part_size: int=8 << 20):
+        self.part_size = part_size
+
+    def put_file(self, bucket: str, key: str, path: str, content_type: str):
+        """Put a local file as an object, in parts if it is larger than `part_size`."""
+        with open(path, "rb") as f:
+            self.put_stream(bucket, key, f, content_type)
+
+    @abc.abstractmethod
+    def put_stream(self, bucket: str, key: str, f, content_type: str):
+        """Put an object read from a binary file object, one part at a time."""
+
+    def begin_put(self, bucket: str, key: str, path: str, content_type: str):
+        """Start putting a local file as an object on the upload pool, without waiting for it.
+
+        The file must be left in place until the put is waited for.
+
+        Returns:
+            the `PendingPut` of the object.
+        """
+        return PendingPut([get_upload_pool().submit(self.put_file, bucket, key, os.path.abspath(path), content_type)])
+
+    def get_file(self, bucket: str, key: str, dest_path: str):
+        """Save an object to a local file."""
+        chunks, _ = self.open_stream(bucket, key)
+        with open(dest_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    @abc.abstractmethod
+    def open_stream(self, bucket: str, key: str, range_header: str=None, chunk_size: int=64 << 10):
+        """Get an object as a stream, without saving it anywhere.
+
+        Args:
+            range_header: the byte range of the object to get, in the form of an HTTP `Range` header.
+            chunk_size: the size of the chunks of the stream, in bytes.
+
+        Returns:
+            an iterator over the chunks of the object, and a dict holding its `Content-Length`
+            and, for a range, its `Content-Range`.
+
+        Raises:
+            RangeNotSatisfiable: the range is out of the object.
+        """
+
+    @abc.abstractmethod
+    def presigned_url(self, bucket: str, key: str, expiry: int):
+        """Get a url to download an object from for `expiry` seconds."""
+
+    @abc.abstractmethod
+    def delete_many(self, bucket: str, keys: list):
+        """Delete objects of a bucket in a batch, ignoring the missing ones."""
+
+
+class CosStorage(ObjectStorage):
+    """The object storage of the Tencent COS server."""
+    MAX_DELETE_KEYS = 1000
+
+    def __init__(self, client: CosS3Client, **kwargs):
+        super().__init__(**kwargs)
+        self.client = client
+
+    def put_file(self, bucket: str, key: str, path: str, content_type: str):
+        self.begin_put(bucket, key, path, content_type).wait()
+
+    def begin_put(self, bucket: str, key: str, path: str, content_type: str):
+        """Start putting a local file as an object, as parallel multipart parts if it is larger than `part_size`."""
+        path = os.path.abspath(path)
+        pool = get_upload_pool()
+        size = os.path.getsize(path)
+        if size <= self.part_size:
+            return PendingPut([pool.submit(self.put_part, bucket, key, path, 0, size, content_type=content_type)])
+
+        upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+        futures = [
+            pool.submit(self.put_part, bucket, key, path, offset, self.part_size, upload_id=upload_id, part_number=i + 1)
+            for i, offset in enumerate(range(0, size, self.part_size))
+        ]
+
+        def complete(etags: list):
+            parts = [{"PartNumber": i + 1, "ETag": etag} for i, etag in enumerate(etags)]
+            self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Part": parts})
+
+        def abort():
+            self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+
+        return PendingPut(futures, complete, abort)
+
+    def put_part(self, bucket: str, key: str, path: str, offset: int, length: int, content_type: str=None, upload_id: str=None, part_number: int=None):
+        """Put a part of a local file, or the whole object if no multipart upload is given.
+
+        Returns:
+            the ETag of the part.
+        """
+        with open(path, "rb") as f:
+            f.seek(offset)
+            data = f.read(length)
+        if upload_id is None:
+            return self.client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)["ETag"]
+        return self.client.upload_part(Bucket=bucket, Key=key, Body=data, PartNumber=part_number, UploadId=upload_id)["ETag"]
+
+    def put_stream(self, bucket: str, key: str, f, content_type: str):
+        upload_id, parts = None, []
+        try:
+            while True:
+                data = f.read(self.part_size)
+                if upload_id is None:
+                    if len(data) < self.part_size:
+                        self.client.put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+                        return
+                    upload_id = self.client.create_multipart_upload(Bucket=bucket, Key=key, ContentType=content_type)["UploadId"]
+                if not data:
+                    break
+                response = self.client.upload_part(Bucket=bucket, Key=key, Body=data, PartNumber=len(parts) + 1, UploadId=upload_id)
+                parts.append({"PartNumber": len(parts) + 1, "ETag": response["ETag"]})
+            self.client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={"Part": parts})
+        except Exception:
+            if upload_id is not None:
+                self.client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def get_file(self, bucket: str, key: str, dest_path: str):
+        self.client.download_file(Bucket=bucket, Key=key, DestFilePath=dest_path)
+
+    def open_stream(self, bucket: str, key: str, range_header: str=None, chunk_size: int=64 << 10):
+        kwargs = {} if range_header is None else {"Range": range_header}
+        try:
+            response = self.client.get_object(Bucket=bucket, Key=key, **kwargs)
+        except CosServiceError as err:
+            if err.get_status_code() == 416:
+                raise RangeNotSatisfiable() from err
+            raise err
+        body = response.pop("Body")
+        return body.get_stream(chunk_size=chunk_size), response
+
+    def presigned_url(self, bucket: str, key: str, expiry: int):
+        return self.client.get_presigned_url(Method="GET", Bucket=bucket, Key=key, Expired=expiry)
+
+    def delete_many(self, bucket: str, keys: list):
+        for i in range(0, len(keys), self.MAX_DELETE_KEYS):
+            self.client.delete_objects(
+                Bucket=bucket,
+                Delete={"Object": [{"Key": key} for key in keys[i:i + self.MAX_DELETE_KEYS]], "Quiet": "true"}
+            )
+
+
+class LocalStorage(ObjectStorage):
+    """An object storage on the local disk, standing in for the COS server on a single machine.
+
+    Each object is a plain file at `root/bucket/key`, published with an atomic rename, and is
+    read through a memory map. Presigned urls are `file://` urls of the objects, which never expire.
+
+    Attributes:
+        root: the directory holding the buckets.
+    """
+    NAME_PATTERN = re.compile(r"[0-9A-Za-z_.-]+")
+
+    def __init__(self, root: str, **kwargs):
+        super().__init__(**kwargs)
+        self.root = root
+
+    def path(self, bucket: str, key: str):
+        for name in [bucket, key]:
+            if self.NAME_PATTERN.fullmatch(name) is None or name in [".", ".."]:
+                raise ValueError("Invalid bucket or key")
+        return os.path.join(self.root, bucket, key)
+
+    def put_stream(self, bucket: str, key: str, f, content_type: str):
+        path = self.path(bucket, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        part_path = f"{path}.{uuid.uuid4()}.part"
+        try:
+            with open(part_path, "wb") as part:
+                shutil.copyfileobj(f, part, self.part_size)
+            os.replace(part_path, path)
+        finally:
+            if os.path.exists(part_path):
+                os.remove(part_path)
+
+    def get_file(self, bucket: str, key: str, dest_path: str):
+        shutil.copyfile(self.path(bucket, key), dest_path)
+
+    def open_stream(self, bucket: str, key: str, range_header: str=None, chunk_size: int=64 << 10):
+        with open(self.path(bucket, key), "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            byte_range = None
+            if range_header is not None:
+                try:
+                    byte_range = parse_range(range_header, size)
+                except ValueError as err:
+                    raise RangeNotSatisfiable() from err
+            # An empty file cannot be mapped
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size > 0 else b""
+
+        if byte_range is None:
+            start, end, headers = 0, size - 1, {"Content-Length": str(size)}
+        else:
+            start, end = byte_range
+            headers = {"Content-Length": str(end - start + 1), "Content-Range": f"bytes {start}-{end}/{size}"}
+        return self.iter_chunks(data, start, end + 1, chunk_size), headers
+
+    @staticmethod
+    def iter_chunks(data, start: int, stop: int, chunk_size: int):
+        try:
+            for pos in range(start, stop, chunk_size):
+                yield data[pos:min(pos + chunk_size, stop)]
+        finally:
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+    def presigned_url(self, bucket: str, key: str, expiry: int):
+        return Path(os.path.abspath(self.path(bucket, key))).as_uri()
+
+    def delete_many(self, bucket: str, keys: list):
+        for key in keys:
+            try:
+                os.remove(self.path(bucket, key))
+            except FileNotFoundError:
+                pass